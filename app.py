@@ -1,9 +1,17 @@
+import threading
+
 from flask import Flask, jsonify
+from flask_jwt_extended import jwt_required, current_user
 from utils import db, bcrypt, jwt
+from utils.jobs import jobs
+from utils.serialization import FastJSONProvider
 from blueprints import auth, object_detection, text_audio_processing
+from blueprints.object_detection.detector import detector
+from blueprints.object_detection.utils import warmup_detector
 from settings import config
 
 app = Flask(__name__)
+app.json = FastJSONProvider(app)
 app.config.from_object(config['development'])
 
 db.init_app(app)
@@ -16,6 +24,20 @@ app.register_blueprint(auth, url_prefix='/auth')
 app.register_blueprint(object_detection, url_prefix='/object-detection')
 app.register_blueprint(text_audio_processing, url_prefix='/tap')
 
+if app.config['DETECTION_WARMUP_ON_BOOT']:
+    threading.Thread(target=warmup_detector, name='detector-warmup', daemon=True).start()
+
+
+@app.cli.command('backfill-detections')
+def backfill_detections():
+    """
+    Convert the labels of images stored before the detections table into
+    detection rows, so that the search finds them.
+    """
+    from blueprints.object_detection.utils import backfill_legacy_detections
+
+    print(f"Backfilled {backfill_legacy_detections()} image(s)")
+
 
 @app.get('/')
 def root():
@@ -28,5 +50,47 @@ def root():
     return jsonify({"message": "Welcome to OSAD API!"})
 
 
+@app.get('/ready')
+def ready():
+    """
+    This function is the readiness endpoint of the API.
+
+    Returns:
+        tuple: A JSON response with the readiness of each component, with HTTP
+               status code 200 when everything is ready or 503 otherwise.
+    """
+    components = {}
+    if app.config['DETECTION_WARMUP_ON_BOOT']:
+        # Without the boot warmup the detector is only loaded by the first detection request
+        components["object_detection"] = detector.ready
+    is_ready = all(components.values())
+    return jsonify({"ready": is_ready, "components": components}), 200 if is_ready else 503
+
+
+@app.get('/jobs/<job_id>')
+@jwt_required()
+def get_job(job_id):
+    """
+    This function returns the status of a background job, or its result once it has finished.
+
+    Args:
+        job_id (str): The id returned when the job was queued.
+
+    Returns:
+        tuple: The same JSON payload the synchronous route returns with HTTP status code 200 once
+               the job has finished, the job status with 202 while it is queued or running, 500 if
+               it failed, or 404 if the current user has no such job.
+    """
+    job = jobs.get(job_id)
+    if job is None or job["user_id"] != current_user.id:
+        return jsonify({"msg": "Job not found"}), 404
+
+    if job["status"] == "finished":
+        return jsonify(job["result"]), 200
+    if job["status"] == "failed":
+        return jsonify({"msg": "Job failed", "job_id": job_id, "status": "failed"}), 500
+    return jsonify({"job_id": job_id, "status": job["status"]}), 202
+
+
 if __name__ == '__main__':
     app.run()
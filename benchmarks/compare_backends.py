@@ -0,0 +1,106 @@
+"""
+Compare the detection backends against the eager fp32 baseline.
+
+For every backend this reports the latency of a forward pass and how far its
+output drifts from eager: the mean IoU of matched boxes and the share of
+eager detections found with the same label.
+
+Usage:
+    python benchmarks/compare_backends.py [--backends eager torchscript int8 onnx]
+                                          [--runs 10] [images ...]
+
+Compiled and exported models are cached in DETECTION_BACKEND_CACHE_DIR, so
+the first run of a backend also includes its one-time build.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from torchvision.ops import box_iou
+from torchvision.transforms.functional import pil_to_tensor
+
+from blueprints.object_detection.backends import BACKENDS
+from blueprints.object_detection.detector import Detector
+from blueprints.object_detection.utils import decode_image
+from settings import Config
+
+
+DEFAULT_IMAGES = [
+    os.path.join(Config.BASE_URL, "blueprints", "object_detection", "tests", name)
+    for name in ("test_img.jpeg", "test_img.png")
+]
+
+
+def match(baseline, candidate, iou_threshold=0.5):
+    """
+    Greedily match candidate boxes to baseline boxes with the same label
+    Returns:
+        (matched IoUs, number of baseline boxes)
+    """
+    ious = []
+    used = set()
+    for i in range(len(baseline["boxes"])):
+        best, best_j = 0.0, None
+        for j in range(len(candidate["boxes"])):
+            if j in used or candidate["labels"][j] != baseline["labels"][i]:
+                continue
+            iou = box_iou(baseline["boxes"][i : i + 1], candidate["boxes"][j : j + 1]).item()
+            if iou > best:
+                best, best_j = iou, j
+        if best_j is not None and best >= iou_threshold:
+            used.add(best_j)
+            ious.append(best)
+    return ious, len(baseline["boxes"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("images", nargs="*", default=DEFAULT_IMAGES)
+    parser.add_argument("--backends", nargs="+", default=list(BACKENDS), choices=list(BACKENDS))
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    baseline_detector = Detector(backend="eager", cache_dir=Config.DETECTION_BACKEND_CACHE_DIR)
+    min_size, max_size = baseline_detector.input_size
+    inputs = []
+    for path in args.images:
+        with open(path, "rb") as f:
+            img, _ = decode_image(f.read(), min_size, max_size)
+        inputs.append(baseline_detector.preprocess(pil_to_tensor(img)))
+
+    baseline = [baseline_detector.infer([image])[0] for image in inputs]
+
+    print(f"{'backend':<12} {'build s':>8} {'p50 ms':>8} {'p90 ms':>8} {'mean IoU':>9} {'label agr':>10}")
+    for name in args.backends:
+        start = time.perf_counter()
+        detector = Detector(backend=name, cache_dir=Config.DETECTION_BACKEND_CACHE_DIR)
+        detector.warmup()
+        build_time = time.perf_counter() - start
+
+        latencies = []
+        ious, total = [], 0
+        for image, expected in zip(inputs, baseline):
+            for _ in range(args.runs):
+                start = time.perf_counter()
+                prediction = detector.infer([image])[0]
+                latencies.append(1000 * (time.perf_counter() - start))
+            matched, count = match(expected, prediction)
+            ious.extend(matched)
+            total += count
+
+        latencies.sort()
+        p90 = latencies[min(len(latencies) - 1, int(0.9 * len(latencies)))]
+        mean_iou = statistics.mean(ious) if ious else float("nan")
+        agreement = len(ious) / total if total else 1.0
+        print(
+            f"{name:<12} {build_time:>8.1f} {statistics.median(latencies):>8.1f} "
+            f"{p90:>8.1f} {mean_iou:>9.3f} {agreement:>10.1%}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Compare the encoders of the list endpoint payloads.
+
+Builds rows shaped like the responses of GET /object-detection/images and
+GET /tap/audios-texts, then reports for every encoder the median time to
+encode a page and its size, relative to the json module that Flask uses
+by default. The orjson encoder is run with the options of FastJSONProvider,
+so its output is byte for byte what the API sends.
+
+Usage:
+    python benchmarks/serialization.py [--sizes 100 1000] [--runs 20]
+
+orjson and msgpack are skipped when they are not installed.
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask.json.provider import DefaultJSONProvider
+
+from utils.serialization import encode_default
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+LABELS = ["person", "car", "dog", "bicycle", "traffic light", "bus"]
+
+
+def image_rows(count):
+    start = datetime(2024, 1, 1)
+    return [
+        {
+            "id": i,
+            "url": f"/srv/osad/media/images/00/00/{i:064x}.jpeg",
+            "detected_as": LABELS[: i % len(LABELS) + 1],
+            "thumbnails": {
+                str(size): f"/object-detection/image/thumbnail?image_id={i}&size={size}&v={i:064x}"
+                for size in (200, 800)
+            },
+            "detected_on": start + timedelta(minutes=i),
+            "description": f"{i % len(LABELS) + 1} object(s) detected in the image",
+            "model": "fasterrcnn_resnet50_fpn_v2",
+            "inference_ms": 1234.56 + i,
+            "user_id": 1,
+        }
+        for i in range(1, count + 1)
+    ]
+
+
+def audio_text_rows(count):
+    start = datetime(2024, 1, 1)
+    return [
+        {
+            "id": i,
+            "text": "the quick brown fox jumps over the lazy dog " * 4,
+            "audio_url": f"/srv/osad/media/audio/00/00/{i:064x}.wav",
+            "processed_on": start + timedelta(minutes=i),
+        }
+        for i in range(1, count + 1)
+    ]
+
+
+def encoders():
+    default = DefaultJSONProvider.default
+    yield "json", lambda rows: json.dumps(rows, default=default, sort_keys=True, separators=(",", ":")).encode()
+    if orjson is not None:
+        options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS | orjson.OPT_SORT_KEYS
+        yield "orjson", lambda rows: orjson.dumps(rows, default=encode_default, option=options)
+    if msgpack is not None:
+        yield "msgpack", lambda rows: msgpack.packb(rows, default=encode_default, use_bin_type=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", nargs="+", type=int, default=[100, 1000])
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    print(f"{'payload':<20} {'encoder':<8} {'p50 ms':>8} {'speedup':>8} {'bytes':>10} {'size':>7}")
+    for name, build in (("images", image_rows), ("audios-texts", audio_text_rows)):
+        for size in args.sizes:
+            rows = build(size)
+            baseline = None
+            for encoder_name, encode in encoders():
+                latencies = []
+                for _ in range(args.runs):
+                    start = time.perf_counter()
+                    body = encode(rows)
+                    latencies.append(1000 * (time.perf_counter() - start))
+                result = (statistics.median(latencies), len(body))
+                baseline = baseline or result
+                print(
+                    f"{f'{name} x{size}':<20} {encoder_name:<8} {result[0]:>8.2f} "
+                    f"{baseline[0] / result[0]:>7.1f}x {result[1]:>10} {result[1] / baseline[1]:>7.0%}"
+                )
+
+
+if __name__ == "__main__":
+    main()
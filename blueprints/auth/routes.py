@@ -13,6 +13,7 @@ from flask_jwt_extended import (
 from .models import User
 from .utils import generate_password_reset_token
 from utils import jwt, redis_client, db, bcrypt, send_mail
+from utils.pagination import list_response
 
 
 INVALID_USER_MESSAGE = "Invalid user"
@@ -281,12 +282,24 @@ def admin_required(func):
 @admin_required
 def get_all_users():
     """
-    Retrieves all user records if the requester is an admin.
+    Retrieves the user records, a page at a time, if the requester is an admin.
 
     Returns:
-        tuple: A JSON response with all users' data and an HTTP status code.
+        tuple: A JSON response with the users' data, an HTTP status code and
+        the X-Next-Cursor header when there are more users.
     """
-    users = User.query.all()
-    user_data = [{"username": user.username, "email": user.email} for user in users]
-
-    return jsonify({"users": user_data}), 200
+    return list_response(
+        User.query,
+        User.id,
+        {
+            "id": User.id,
+            "username": User.username,
+            "email": User.email,
+            "firstname": User.firstname,
+            "lastname": User.lastname,
+            "phone": User.phone,
+            "is_admin": User.is_admin,
+        },
+        default_fields=["username", "email"],
+        envelope="users",
+    )
@@ -1,11 +1,32 @@
 from flask import Blueprint
 
-from .routes import detect_image, get_image, get_images, delete_image
+from .routes import (
+    detect_image,
+    detect_images,
+    detect_video,
+    get_image,
+    get_annotated_image,
+    get_image_file,
+    get_image_thumbnail,
+    get_images,
+    search_images,
+    delete_image,
+    get_detection_stats,
+    get_models,
+)
 
 
 object_detection = Blueprint("object_detection", __name__, static_folder="static")
 
 object_detection.post("/detect-image")(detect_image)
+object_detection.post("/detect-images")(detect_images)
+object_detection.post("/detect-video")(detect_video)
 object_detection.get("/image")(get_image)
+object_detection.get("/image/annotated")(get_annotated_image)
+object_detection.get("/image/file")(get_image_file)
+object_detection.get("/image/thumbnail")(get_image_thumbnail)
 object_detection.get("/images")(get_images)
+object_detection.get("/search")(search_images)
 object_detection.delete("/image")(delete_image)
+object_detection.get("/stats")(get_detection_stats)
+object_detection.get("/models")(get_models)
@@ -0,0 +1,170 @@
+import os
+import threading
+
+import torch
+
+
+class EagerBackend:
+    """
+    Runs the detector as a regular fp32 PyTorch module
+    """
+
+    name = "eager"
+
+    def __init__(self, model, cache_dir=None, tag=None):
+        self.model = model
+
+    def __call__(self, batch):
+        return self.model(batch)
+
+    def share_memory(self):
+        self.model.share_memory()
+
+
+class TorchScriptBackend(EagerBackend):
+    """
+    Runs a scripted and frozen copy of the detector.
+
+    The scripted module is built once and saved in the cache directory, later
+    processes load it from there.
+    """
+
+    name = "torchscript"
+
+    def __init__(self, model, cache_dir, tag):
+        path = os.path.join(cache_dir, f"{tag}-{self.name}.pt")
+        if os.path.exists(path):
+            self.model = torch.jit.load(path)
+        else:
+            self.model = self.build(model)
+            save_atomically(path, lambda tmp_path: torch.jit.save(self.model, tmp_path))
+        self.model.eval()
+
+    def build(self, model):
+        scripted = torch.jit.script(model)
+        try:
+            return torch.jit.freeze(scripted)
+        except RuntimeError:
+            # Some torchvision versions keep attributes freezing cannot inline
+            return scripted
+
+    def __call__(self, batch):
+        # Scripted detection models return (losses, detections)
+        return self.model(batch)[1]
+
+
+class QuantizedBackend(TorchScriptBackend):
+    """
+    Runs the detector with its Linear layers dynamically quantized to int8.
+
+    The box head's fully connected layers are where dynamic quantization
+    applies; the convolutional backbone stays fp32.
+    """
+
+    name = "int8"
+
+    def build(self, model):
+        quantized = torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+        return torch.jit.script(quantized)
+
+
+class OnnxBackend:
+    """
+    Runs an ONNX export of the detector with ONNX Runtime on the CPU.
+
+    The export is built once and saved in the cache directory. The exported
+    graph takes one image, so a batch is run image by image. Sessions are
+    created per process because they must not be shared across a fork.
+    """
+
+    name = "onnx"
+
+    def __init__(self, model, cache_dir, tag):
+        self.path = os.path.join(cache_dir, f"{tag}-{self.name}.onnx")
+        if not os.path.exists(self.path):
+            self.export(model)
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def export(self, model):
+        dummy = torch.rand(3, 480, 640)
+        save_atomically(
+            self.path,
+            lambda tmp_path: torch.onnx.export(
+                model,
+                ([dummy],),
+                tmp_path,
+                opset_version=11,
+                input_names=["image"],
+                output_names=["boxes", "labels", "scores"],
+                dynamic_axes={"image": {1: "height", 2: "width"}},
+            ),
+        )
+
+    @property
+    def session(self):
+        if self._session is None or self._pid != os.getpid():
+            with self._lock:
+                if self._session is None or self._pid != os.getpid():
+                    import onnxruntime
+
+                    options = onnxruntime.SessionOptions()
+                    options.intra_op_num_threads = torch.get_num_threads()
+                    self._session = onnxruntime.InferenceSession(
+                        self.path, options, providers=["CPUExecutionProvider"]
+                    )
+                    self._pid = os.getpid()
+        return self._session
+
+    def __call__(self, batch):
+        predictions = []
+        for image in batch:
+            boxes, labels, scores = self.session.run(None, {"image": image.numpy()})
+            predictions.append(
+                {
+                    "boxes": torch.from_numpy(boxes),
+                    "labels": torch.from_numpy(labels),
+                    "scores": torch.from_numpy(scores),
+                }
+            )
+        return predictions
+
+    def share_memory(self):
+        pass
+
+
+BACKENDS = {
+    backend.name: backend
+    for backend in (EagerBackend, TorchScriptBackend, QuantizedBackend, OnnxBackend)
+}
+
+
+def build_backend(name, model, cache_dir, tag):
+    """
+    Wrap the eager model in the inference backend called name
+    Args:
+        name: one of BACKENDS
+        model: eager detection model in eval mode
+        cache_dir: folder where compiled or exported models are kept
+        tag: identifies the model and its settings in cached file names
+    Returns:
+        callable taking a list of image tensors and returning a list of
+        prediction dicts
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown detection backend {name!r}, choose from {sorted(BACKENDS)}")
+    os.makedirs(cache_dir, exist_ok=True)
+    return BACKENDS[name](model, cache_dir, f"{tag}-torch{torch.__version__}")
+
+
+def save_atomically(path, save):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        save(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
@@ -0,0 +1,156 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class InferenceBatcher:
+    """
+    Gathers single-image inference requests into batches for the detector.
+
+    Callers submit one item and get a Future back. A background thread flushes
+    the pending items as one batch when ``max_batch_size`` is reached or the
+    oldest pending item has waited ``max_wait`` seconds. While every executor
+    slot is busy, requests keep accumulating, so batches grow under load and
+    stay small (low latency) when the server is quiet.
+
+    Args:
+        run_batch: callable taking a list of items and returning a list of
+            results in the same order
+        max_batch_size: largest number of items run in one batch
+        max_wait: seconds the oldest item may wait for the batch to fill
+        executor: concurrent.futures executor the batches run on
+        max_inflight: number of batches allowed to run at the same time
+    """
+
+    def __init__(self, run_batch, max_batch_size=8, max_wait=0.01, executor=None, max_inflight=1):
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait))
+        self.max_inflight = max(1, int(max_inflight))
+        self.executor = executor or ThreadPoolExecutor(
+            max_workers=max_inflight, thread_name_prefix="detector"
+        )
+        self._slots = threading.Semaphore(self.max_inflight)
+        self._pending = deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._batches = 0
+        self._items = 0
+        self._inflight = 0
+        self._max_batch_seen = 0
+        self._size_histogram = {}
+        self._total_wait = 0.0
+        self._max_wait_seen = 0.0
+
+    def submit(self, item):
+        """
+        Queue one item for inference
+        Args:
+            item: a single model input
+        Returns:
+            Future resolved with this item's result
+        """
+        future = Future()
+        with self._cond:
+            self._ensure_started()
+            self._pending.append((item, future, time.monotonic()))
+            self._cond.notify()
+        return future
+
+    def stats(self):
+        """
+        Snapshot of the queue and batching counters
+        Returns:
+            dict
+        """
+        with self._cond:
+            queue_depth = len(self._pending)
+        with self._lock:
+            return {
+                "queue_depth": queue_depth,
+                "inflight_batches": self._inflight,
+                "batches": self._batches,
+                "items": self._items,
+                "avg_batch_size": self._items / self._batches if self._batches else 0.0,
+                "max_batch_size_seen": self._max_batch_seen,
+                "batch_size_histogram": dict(sorted(self._size_histogram.items())),
+                "avg_queue_wait_ms": 1000 * self._total_wait / self._items if self._items else 0.0,
+                "max_queue_wait_ms": 1000 * self._max_wait_seen,
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": 1000 * self.max_wait,
+            }
+
+    def _ensure_started(self):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._loop, name="inference-batcher", daemon=True
+            )
+            self._thread.start()
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+
+            # Wait for a free executor slot before cutting the batch so that
+            # requests arriving while the model is busy join the next batch.
+            self._slots.acquire()
+
+            with self._cond:
+                deadline = self._pending[0][2] + self.max_wait
+                while len(self._pending) < self.max_batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                size = min(len(self._pending), self.max_batch_size)
+                batch = [self._pending.popleft() for _ in range(size)]
+
+            self._record(batch)
+            self._dispatch(batch)
+
+    def _record(self, batch):
+        now = time.monotonic()
+        waits = [now - queued_at for _, _, queued_at in batch]
+        size = len(batch)
+        with self._lock:
+            self._batches += 1
+            self._items += size
+            self._inflight += 1
+            self._max_batch_seen = max(self._max_batch_seen, size)
+            self._size_histogram[size] = self._size_histogram.get(size, 0) + 1
+            self._total_wait += sum(waits)
+            self._max_wait_seen = max(self._max_wait_seen, max(waits))
+
+    def _dispatch(self, batch):
+        items = [item for item, _, _ in batch]
+        futures = [future for _, future, _ in batch]
+
+        def resolve(batch_future):
+            with self._lock:
+                self._inflight -= 1
+            self._slots.release()
+            error = batch_future.exception()
+            if error is None:
+                results = batch_future.result()
+                if len(results) != len(futures):
+                    error = RuntimeError(
+                        f"Batch returned {len(results)} results for {len(futures)} inputs"
+                    )
+            for i, future in enumerate(futures):
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(results[i])
+
+        try:
+            batch_future = self.executor.submit(self.run_batch, items)
+        except Exception as e:
+            failed = Future()
+            failed.set_exception(e)
+            resolve(failed)
+            return
+        batch_future.add_done_callback(resolve)
@@ -0,0 +1,215 @@
+import threading
+from collections import OrderedDict
+
+from settings import Config
+
+
+# name of the torchvision.models.detection builder: (its weights enum,
+# name of its score threshold argument, (min_size, max_size) of its default
+# transform). torch and torchvision are only imported once a detector is
+# used, so processes that never detect, such as auth-only workers, start fast
+DETECTORS = {
+    "fasterrcnn_resnet50_fpn_v2": (
+        "FasterRCNN_ResNet50_FPN_V2_Weights",
+        "box_score_thresh",
+        (800, 1333),
+    ),
+    "fasterrcnn_mobilenet_v3_large_fpn": (
+        "FasterRCNN_MobileNet_V3_Large_FPN_Weights",
+        "box_score_thresh",
+        (800, 1333),
+    ),
+    "ssdlite320_mobilenet_v3_large": (
+        "SSDLite320_MobileNet_V3_Large_Weights",
+        "score_thresh",
+        (320, 320),
+    ),
+}
+
+
+class Detector:
+    """
+    Holds an object detection model and builds it on first use.
+
+    Nothing is loaded at import time. The model is constructed the first time
+    it is needed, or ahead of time by calling ``warmup`` at boot, which also
+    runs a dummy forward pass so the first real request does not pay the
+    allocator and kernel selection warmup cost.
+
+    Inference goes through ``infer``, which runs the configured backend
+    (eager, torchscript, int8 or onnx, see backends.py). The weights,
+    categories, preprocessing and input size come from the DETECTORS table
+    and never build the model, so a process that only decodes images for a
+    worker pool does not hold a copy of it.
+    """
+
+    def __init__(self, name="fasterrcnn_resnet50_fpn_v2", box_score_thresh=0.9, backend="eager", cache_dir=None):
+        self.name = name
+        self.box_score_thresh = box_score_thresh
+        self.backend_name = backend
+        self.cache_dir = cache_dir
+        self._lock = threading.Lock()
+        self._model = None
+        self._backend = None
+        self._preprocess = None
+        self._ready = threading.Event()
+
+    @property
+    def model(self):
+        self.load()
+        return self._model
+
+    @property
+    def backend(self):
+        self.load()
+        return self._backend
+
+    @property
+    def weights(self):
+        from torchvision.models import detection
+
+        return getattr(detection, DETECTORS[self.name][0]).DEFAULT
+
+    @property
+    def preprocess(self):
+        if self._preprocess is None:
+            self._preprocess = self.weights.transforms()
+        return self._preprocess
+
+    @property
+    def categories(self):
+        return self.weights.meta["categories"]
+
+    @property
+    def input_size(self):
+        """
+        (min_size, max_size) the model's transform resizes images to
+        """
+        return DETECTORS[self.name][2]
+
+    @property
+    def loaded(self):
+        return self._model is not None
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def load(self):
+        """
+        Build the model and load its weights if it has not been done yet
+        """
+        if self._model is not None:
+            return
+        with self._lock:
+            if self._model is not None:
+                return
+            import torch
+            from torchvision.models import detection
+            from .backends import build_backend
+
+            _, score_arg, _ = DETECTORS[self.name]
+            builder = getattr(detection, self.name)
+            model = builder(weights=self.weights, **{score_arg: self.box_score_thresh})
+            model.eval()
+            if torch.cuda.is_available():
+                model.cuda()
+            self._backend = build_backend(
+                self.backend_name,
+                model,
+                self.cache_dir,
+                f"{self.name}-{self.box_score_thresh}",
+            )
+            self._model = model
+
+    def infer(self, batch):
+        """
+        Run the detector backend on a batch of preprocessed images
+        Args:
+            batch: list of image tensors
+        Returns:
+            list of prediction dicts, one per image
+        """
+        import torch
+
+        with torch.inference_mode():
+            return self.backend(batch)
+
+    def warmup(self):
+        """
+        Load the model and run a dummy forward pass, then mark it ready
+        """
+        import torch
+
+        dummy = torch.zeros(3, 320, 320)
+        self.infer([self.preprocess(dummy)])
+        self._ready.set()
+
+    def mark_ready(self):
+        self._ready.set()
+
+
+class DetectorRegistry:
+    """
+    The named detectors requests can choose from.
+
+    Detectors are loaded lazily and at most ``max_loaded`` of them are kept
+    in memory; the least recently used one is dropped to make room. The
+    default detector counts toward ``max_loaded`` but is never dropped, and
+    neither is the detector just asked for, so with ``max_loaded`` 1 the
+    default one and the last other one picked are both kept.
+
+    Args:
+        default: name of the detector used when a request does not pick one
+        max_loaded: number of detectors kept in memory
+        detector_kwargs: passed to every Detector
+    """
+
+    def __init__(self, default, max_loaded=2, **detector_kwargs):
+        if default not in DETECTORS:
+            raise ValueError(f"Unknown detector {default!r}, choose from {sorted(DETECTORS)}")
+        self.default_name = default
+        self.max_loaded = max(1, max_loaded)
+        self.detector_kwargs = detector_kwargs
+        self._detectors = OrderedDict()
+        self._lock = threading.Lock()
+        self.default = self.get(default)
+
+    @property
+    def names(self):
+        return sorted(DETECTORS)
+
+    def loaded_names(self):
+        with self._lock:
+            return [name for name, detector in self._detectors.items() if detector.loaded]
+
+    def get(self, name=None):
+        """
+        Get the detector called name, the default one when name is None
+        Raises:
+            KeyError: when there is no detector with that name
+        """
+        name = name or self.default_name
+        if name not in DETECTORS:
+            raise KeyError(name)
+        with self._lock:
+            detector = self._detectors.get(name)
+            if detector is None:
+                detector = self._detectors[name] = Detector(name, **self.detector_kwargs)
+            self._detectors.move_to_end(name)
+            while len(self._detectors) > self.max_loaded:
+                evicted = next(n for n in self._detectors if n != self.default_name)
+                if evicted == name:
+                    break
+                del self._detectors[evicted]
+        return detector
+
+
+registry = DetectorRegistry(
+    Config.DETECTION_DEFAULT_MODEL,
+    max_loaded=Config.DETECTION_MAX_LOADED_MODELS,
+    box_score_thresh=Config.DETECTION_MIN_SCORE_THRESH,
+    backend=Config.DETECTION_BACKEND,
+    cache_dir=Config.DETECTION_BACKEND_CACHE_DIR,
+)
+detector = registry.default
@@ -1,15 +1,95 @@
 import os
+import ast
+import csv
+
 from utils import db
 
 
+def parse_legacy_labels(detected_as):
+    """
+    Labels of the detected_as column written before the detections table:
+    a PostgreSQL array literal such as '{dog,"traffic light"}', a Python or
+    JSON list, or a single label
+    """
+    if not detected_as:
+        return []
+    value = detected_as.strip()
+    if value.startswith("{") and value.endswith("}"):
+        inner = value[1:-1]
+        if not inner:
+            return []
+        return next(csv.reader([inner], quotechar='"', escapechar="\\", skipinitialspace=True))
+    if value.startswith("["):
+        try:
+            return [str(label) for label in ast.literal_eval(value)]
+        except (ValueError, SyntaxError, TypeError):
+            pass
+    return [value]
+
+
 class Image(db.Model):
     __tablename__ = "images"
+    __table_args__ = (db.Index("ix_images_user_id_detected_on", "user_id", "detected_on"),)
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    # Legacy label summary, the labels now live in the detections table
     detected_as = db.Column(db.String(80), nullable=True)
     description = db.Column(db.String(250), nullable=True)
+    model_name = db.Column(db.String(80), nullable=True)
+    inference_ms = db.Column(db.Float, nullable=True)
     url = db.Column(db.String(250), nullable=True)
     detected_on = db.Column(
         db.DateTime, nullable=True, default=db.func.current_timestamp()
     )
+    detections = db.relationship(
+        "Detection",
+        backref="image",
+        order_by="Detection.id",
+        cascade="all, delete-orphan",
+    )
+
+    @property
+    def labels(self):
+        if not self.detections and self.detected_as:
+            # Stored before the detections table and not backfilled yet
+            return parse_legacy_labels(self.detected_as)
+        return [detection.label for detection in self.detections]
+
+    @property
+    def boxes(self):
+        return [detection.to_dict() for detection in self.detections]
+
+
+class Detection(db.Model):
+    """
+    One object detected in an image
+    """
+
+    __tablename__ = "detections"
+    __table_args__ = (
+        # Covers the label searches: filter on user, label and score, read image_id
+        db.Index("ix_detections_user_id_label", "user_id", "label", "score", "image_id"),
+        db.Index("ix_detections_image_id", "image_id"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    image_id = db.Column(
+        db.Integer, db.ForeignKey("images.id", ondelete="CASCADE"), nullable=False
+    )
+    # Copied from the image so label lookups per user need no join
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    label = db.Column(db.String(80), nullable=False)
+    # Null for labels backfilled from images stored without scores and boxes
+    score = db.Column(db.Float, nullable=True)
+    x1 = db.Column(db.Float, nullable=True)
+    y1 = db.Column(db.Float, nullable=True)
+    x2 = db.Column(db.Float, nullable=True)
+    y2 = db.Column(db.Float, nullable=True)
+
+    def to_dict(self):
+        return {
+            "label": self.label,
+            "score": self.score,
+            "box": None if self.x1 is None else [self.x1, self.y1, self.x2, self.y2],
+        }
@@ -1,10 +1,40 @@
-from flask import request, jsonify, make_response
+import io
+import os
+import tempfile
+from datetime import datetime
+
+from flask import request, jsonify, make_response, send_file, url_for
+from PIL import ImageColor
 from flask_jwt_extended import jwt_required, current_user
+from werkzeug.datastructures import FileStorage
+from werkzeug.exceptions import RequestEntityTooLarge
 
+from settings import Config
 from utils import db
+from utils.jobs import wants_async, submit_job
+from utils.pagination import list_response
+from utils.conditional import conditional, request_value, bump_version
+from utils.storage import storage, send_media
+from blueprints.auth.routes import admin_required
 
-from .utils import detect_object
+from .utils import (
+    detect_object,
+    detect_objects,
+    detect_video_objects,
+    find_images,
+    labels_by_image,
+    boxes_by_image,
+    get_derivative,
+    derivative_cache,
+    render_annotated_image,
+    batchers,
+    worker_pool,
+    result_cache,
+    inflight_detections,
+    render_cache,
+)
 from .models import Image
+from .detector import registry
 
 
 @jwt_required()
@@ -20,38 +50,303 @@ def detect_image():
     if image.filename.split(".")[-1] not in ["jpg", "jpeg", "png"]:
         return jsonify({"msg": "Invalid image format. Provide a .jp(e)g or .png"}), 400
 
+    options, error = get_detection_options()
+    if error:
+        return jsonify({"msg": error}), 400
+
+    if wants_async():
+        # The upload stream is closed once the request ends, keep the bytes
+        image = FileStorage(io.BytesIO(image.read()), filename=image.filename)
+        return submit_job("detect-image", detect_image_payload, image, current_user.id, options)
+
+    return jsonify(detect_image_payload(image, current_user.id, options)), 200
+
+
+def get_detection_options():
+    """
+    Read the model, score_threshold and tiled detection options of the request
+    Returns:
+        (options dict, None) or (None, error message)
+    """
+    model_name = request.values.get("model") or registry.default_name
+    if model_name not in registry.names:
+        return None, f"Unknown model. Choose one of {', '.join(registry.names)}"
+
+    score_threshold = request.values.get("score_threshold", Config.DETECTION_DEFAULT_SCORE_THRESH)
+    try:
+        score_threshold = float(score_threshold)
+    except ValueError:
+        return None, "Invalid score_threshold"
+    if not Config.DETECTION_MIN_SCORE_THRESH <= score_threshold <= 1:
+        return None, f"score_threshold must be between {Config.DETECTION_MIN_SCORE_THRESH} and 1"
+
+    tiled = request.values.get("tiled", "").lower() in ("1", "true", "yes")
+
+    return {"model_name": model_name, "score_threshold": score_threshold, "tiled": tiled}, None
+
+
+def detect_image_payload(image, user_id, options):
+    """
+    Detect the objects in the image and build the detect-image response payload
+    """
+    results, image = detect_object(image, user_id, **options)
+    return {
+        "detected_objs": results,
+        "img_url": image.url,
+        "image_id": image.id,
+        "model": image.model_name,
+        "inference_ms": image.inference_ms,
+    }
+
+
+@jwt_required()
+def detect_images():
+    """
+    Detect the objects in many images sent in one request
+    """
+    images = request.files.getlist("images")
+
+    if not images:
+        return jsonify({"msg": "No images provided"}), 400
+
+    if len(images) > Config.DETECTION_MAX_FILES_PER_REQUEST:
+        return jsonify({"msg": f"Too many images. Send at most {Config.DETECTION_MAX_FILES_PER_REQUEST}"}), 400
+
+    options, error = get_detection_options()
+    if error:
+        return jsonify({"msg": error}), 400
+
+    if wants_async():
+        # The upload streams are closed once the request ends, keep the bytes
+        images = [FileStorage(io.BytesIO(image.read()), filename=image.filename) for image in images]
+        return submit_job("detect-images", detect_images_payload, images, current_user.id, options)
+
+    return jsonify(detect_images_payload(images, current_user.id, options)), 200
+
+
+def detect_images_payload(images, user_id, options):
+    """
+    Detect the objects in the images and build the detect-images response payload
+    """
+    return {"results": detect_objects(images, user_id, **options), "model": options["model_name"]}
+
+
+@jwt_required()
+def detect_video():
+    """
+    Detect and track the objects through a video
+    """
+    too_large = {"msg": f"Video too large. Send at most {Config.DETECTION_VIDEO_MAX_BYTES} bytes"}
+    # Checked before the form is parsed, which spools the whole body
+    if request.content_length is not None and request.content_length > Config.DETECTION_VIDEO_MAX_BYTES:
+        return jsonify(too_large), 413
+    cap_request_body(Config.DETECTION_VIDEO_MAX_BYTES)
+    try:
+        video = request.files.get("video")
+    except RequestEntityTooLarge:
+        return jsonify(too_large), 413
+
+    if not video:
+        return jsonify({"msg": "No video provided"}), 400
+
+    ext = video.filename.split(".")[-1].lower()
+    if ext not in ["mp4", "mov", "avi", "mkv", "webm"]:
+        return jsonify({"msg": "Invalid video format. Provide a .mp4, .mov, .avi, .mkv or .webm"}), 400
+
+    options, error = get_detection_options()
+    if error:
+        return jsonify({"msg": error}), 400
+    # Video frames are small enough for a single pass
+    options.pop("tiled")
+
+    try:
+        options["sample_fps"] = float(request.values.get("sample_fps", Config.DETECTION_VIDEO_SAMPLE_FPS))
+        options["change_threshold"] = float(
+            request.values.get("change_threshold", Config.DETECTION_VIDEO_CHANGE_THRESH)
+        )
+    except ValueError:
+        return jsonify({"msg": "Invalid sample_fps or change_threshold"}), 400
+    if not 0 <= options["sample_fps"] <= 60 or not 0 <= options["change_threshold"] <= 1:
+        return jsonify({"msg": "sample_fps must be between 0 and 60 and change_threshold between 0 and 1"}), 400
+    options["per_frame"] = request.values.get("results", "tracks") == "frames"
+
+    # The decoder reads from a file; the payload removes it once done
+    fd, path = tempfile.mkstemp(suffix=f".{ext}")
+    with os.fdopen(fd, "wb") as file:
+        video.save(file)
+
+    if wants_async():
+        response = submit_job("detect-video", detect_video_payload, path, options)
+        if response[1] != 202:
+            os.remove(path)
+        return response
+
+    from .video import VideoDecodeError
+
+    try:
+        payload = detect_video_payload(path, options)
+    except VideoDecodeError:
+        return jsonify({"msg": "Could not decode the video"}), 400
+    return jsonify(payload), 200
+
+
+class _CappedStream:
+    """
+    Request body stream raising RequestEntityTooLarge once more than limit
+    bytes were read
+    """
+
+    def __init__(self, stream, limit):
+        self._stream = stream
+        self._remaining = limit
+
+    def read(self, size=-1):
+        return self._count(self._stream.read(size))
+
+    def readline(self, size=-1):
+        return self._count(self._stream.readline(size))
 
-    results, file_path = detect_object(image, current_user.id)
+    def _count(self, data):
+        self._remaining -= len(data)
+        if self._remaining < 0:
+            raise RequestEntityTooLarge()
+        return data
 
-    return jsonify(detected_objs=results, img_url=file_path), 200
+
+def cap_request_body(max_bytes):
+    """
+    Limit the body of the current request to max_bytes while it is parsed.
+    Chunked uploads have no Content-Length to check upfront, and
+    MAX_CONTENT_LENGTH would apply the video limit to every route
+    """
+    request.environ["wsgi.input"] = _CappedStream(request.environ["wsgi.input"], max_bytes)
+
+
+def detect_video_payload(path, options):
+    """
+    Detect and track the objects in a video file and build the detect-video response payload
+    """
+    try:
+        return detect_video_objects(path, **options)
+    finally:
+        os.remove(path)
 
 
 @jwt_required()
+@conditional("images")
 def get_images():
     """
-    Get all the images of this user
+    Get the images of this user, a page at a time
     """
-    all_images = Image.query.filter_by(user_id=current_user.id).all()
-    image_list = [
+    return list_response(
+        Image.query.filter_by(user_id=current_user.id),
+        Image.id,
         {
-            "id": image.id,
-            "url": image.url,
-            "detected_as": image.detected_as,
-            "detected_on": image.detected_on,
-            "description": image.description,
-            "user_id": image.user_id,
+            "id": Image.id,
+            "url": Image.url,
+            "detected_on": Image.detected_on,
+            "description": Image.description,
+            "model": Image.model_name,
+            "inference_ms": Image.inference_ms,
+            "user_id": Image.user_id,
+        },
+        extras={"detected_as": labels_by_image, "thumbnails": thumbnail_urls},
+    )
+
+
+def thumbnail_urls(image_ids):
+    """
+    URLs of the derivatives of each image, by size
+    Returns:
+        dict of image id to {size: url}
+    """
+    rows = db.session.query(Image.id, Image.url).filter(Image.id.in_(image_ids))
+    return {
+        image_id: {
+            str(size): url_for(
+                "object_detection.get_image_thumbnail",
+                image_id=image_id,
+                size=size,
+                v=storage.digest(location),
+            )
+            for size in Config.DERIVATIVE_SIZES
         }
-        for image in all_images
-    ]
-    return jsonify(image_list), 200
+        for image_id, location in rows
+    }
 
 
 @jwt_required()
+@conditional("images")
+def search_images():
+    """
+    Search the images of this user by detected labels, scores and date
+    """
+    labels = []
+    for value in request.args.getlist("label"):
+        label, _, count = value.partition(":")
+        try:
+            count = int(count or 1)
+        except ValueError:
+            return jsonify({"msg": f"Invalid label filter {value!r}, use label or label:count"}), 400
+        if not label or count < 1:
+            return jsonify({"msg": f"Invalid label filter {value!r}, use label or label:count"}), 400
+        labels.append((label, count))
+
+    try:
+        min_score = get_arg("min_score", float)
+        max_score = get_arg("max_score", float)
+        since = get_arg("since", datetime.fromisoformat)
+        until = get_arg("until", datetime.fromisoformat)
+    except ValueError as e:
+        return jsonify({"msg": str(e)}), 400
+    if any(score is not None and not 0 <= score <= 1 for score in (min_score, max_score)):
+        return jsonify({"msg": "min_score and max_score must be between 0 and 1"}), 400
+
+    return list_response(
+        find_images(
+            current_user.id,
+            labels=labels,
+            min_score=min_score,
+            max_score=max_score,
+            since=since,
+            until=until,
+        ),
+        Image.id,
+        {
+            "id": Image.id,
+            "url": Image.url,
+            "detected_on": Image.detected_on,
+            "description": Image.description,
+            "model": Image.model_name,
+            "user_id": Image.user_id,
+        },
+        extras={"detected_as": labels_by_image, "boxes": boxes_by_image},
+        envelope="images",
+    )
+
+
+def get_arg(name, convert, default=None):
+    """
+    Read and convert a query parameter
+    Raises:
+        ValueError: naming the parameter when it cannot be converted
+    """
+    value = request.args.get(name)
+    if not value:
+        return default
+    try:
+        return convert(value)
+    except ValueError:
+        raise ValueError(f"Invalid {name}") from None
+
+
+@jwt_required()
+@conditional("images", params=("image_id",))
 def get_image():
     """
     Get the image of this user
     """
-    image_id = request.json.get("image_id")
+    image_id = request_value("image_id")
     image = (
         db.session.query(Image).filter_by(id=image_id, user_id=current_user.id).first()
     )
@@ -62,9 +357,17 @@ def get_image():
         jsonify(
             {
                 "id": image.id,
-                "detected_as": image.detected_as,
+                "detected_as": image.labels,
                 "description": image.description,
+                "boxes": image.boxes,
+                "model": image.model_name,
+                "inference_ms": image.inference_ms,
                 "url": image.url,
+                "file_url": url_for(
+                    "object_detection.get_image_file",
+                    image_id=image.id,
+                    v=storage.digest(image.url),
+                ),
                 "detected_on": image.detected_on,
                 "user_id": image.user_id,
             }
@@ -73,6 +376,79 @@ def get_image():
     )
 
 
+@jwt_required()
+def get_image_file():
+    """
+    Download the original file of an image of this user
+    """
+    image = (
+        db.session.query(Image)
+        .filter_by(id=request.args.get("image_id"), user_id=current_user.id)
+        .first()
+    )
+    if not image:
+        return jsonify({"msg": "Image not found"}), 404
+    if not storage.exists(image.url):
+        return jsonify({"msg": "Image file not found"}), 404
+
+    return send_media(image.url, version=request.args.get("v"))
+
+
+@jwt_required()
+def get_image_thumbnail():
+    """
+    Get a WebP copy of an image of this user scaled down to one of the configured sizes
+    """
+    size = request.args.get("size", type=int)
+    if size not in Config.DERIVATIVE_SIZES:
+        return jsonify({"msg": f"size must be one of {', '.join(map(str, Config.DERIVATIVE_SIZES))}"}), 400
+    image = (
+        db.session.query(Image)
+        .filter_by(id=request.args.get("image_id"), user_id=current_user.id)
+        .first()
+    )
+    if not image:
+        return jsonify({"msg": "Image not found"}), 404
+    if not storage.exists(image.url):
+        return jsonify({"msg": "Image file not found"}), 404
+
+    # Older images get their derivatives on first request
+    path = get_derivative(image.url, size)
+    digest = storage.digest(image.url)
+    response = send_file(path, mimetype="image/webp", etag=f"{digest}-{size}" if digest else True, conditional=True)
+    if digest is not None and request.args.get("v") == digest:
+        response.headers["Cache-Control"] = f"private, max-age={365 * 24 * 3600}, immutable"
+    else:
+        response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+@jwt_required()
+def get_annotated_image():
+    """
+    Get the image of this user with the detected boxes drawn on it
+    """
+    image_id = request.args.get("image_id")
+    image = (
+        db.session.query(Image).filter_by(id=image_id, user_id=current_user.id).first()
+    )
+    if not image:
+        return jsonify({"msg": "Image not found"}), 404
+
+    color = request.args.get("color", "blue")
+    try:
+        ImageColor.getrgb(color)
+        width = int(request.args.get("width", 2))
+        font_size = int(request.args.get("font_size", 30))
+    except ValueError:
+        return jsonify({"msg": "Invalid rendering options"}), 400
+    if not 1 <= width <= 20 or not 6 <= font_size <= 200:
+        return jsonify({"msg": "Invalid rendering options"}), 400
+
+    path = render_annotated_image(image, color=color, width=width, font_size=font_size)
+    return send_file(path)
+
+
 @jwt_required()
 def delete_image():
     """
@@ -84,6 +460,46 @@ def delete_image():
     )
     if not image:
         return jsonify({"msg": "Image not found"}), 404
+    storage.release(image.url)
     db.session.delete(image)
     db.session.commit()
+    bump_version("images", current_user.id)
+    render_cache.discard(str(image.id))
     return make_response("", 204)
+
+
+@jwt_required()
+@admin_required
+def get_detection_stats():
+    """
+    Get the inference batching and result cache statistics
+    """
+    cache = result_cache.stats() if result_cache is not None else {"backend": "none"}
+    cache["coalesced"] = inflight_detections.coalesced
+    return (
+        jsonify(
+            batchers={name: batcher.stats() for name, batcher in batchers.items()},
+            cache=cache,
+            render_cache=render_cache.stats(),
+            derivative_cache=derivative_cache.stats(),
+            workers=worker_pool.stats() if worker_pool is not None else None,
+        ),
+        200,
+    )
+
+
+@jwt_required()
+def get_models():
+    """
+    Get the detectors that can be picked with the model parameter
+    """
+    return (
+        jsonify(
+            models=registry.names,
+            default=registry.default_name,
+            loaded=registry.loaded_names(),
+            default_score_threshold=Config.DETECTION_DEFAULT_SCORE_THRESH,
+            min_score_threshold=Config.DETECTION_MIN_SCORE_THRESH,
+        ),
+        200,
+    )
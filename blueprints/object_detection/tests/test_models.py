@@ -3,7 +3,7 @@ from datetime import timedelta, datetime
 
 import unittest
 
-from blueprints.object_detection.models import Image
+from blueprints.object_detection.models import Image, Detection, parse_legacy_labels
 from blueprints.auth.models import User
 from utils import db
 from app import app
@@ -61,6 +61,65 @@ class ImageModelTestCase(unittest.TestCase):
             inserted_image.detected_on, datetime.now(), delta=timedelta(seconds=5)
         )
 
+    def test_store_detections(self):
+        """
+        Test the detections of an image are stored as rows and deleted with it.
+        """
+        from blueprints.object_detection.utils import store_image_in_database
+
+        user = User(username="testuser", email="test@example.com", password="password")
+        db.session.add(user)
+        db.session.commit()
+        boxes = [
+            {"label": "dog", "score": 0.98, "box": [1.0, 2.0, 30.0, 40.0]},
+            {"label": "person", "score": 0.91, "box": [5.0, 6.0, 70.0, 80.0]},
+        ]
+        image = store_image_in_database(
+            file_path="test.jpg", description="2 object(s)", user_id=user.id, boxes=boxes
+        )
+
+        self.assertEqual(image.labels, ["dog", "person"])
+        self.assertEqual(image.boxes, boxes)
+        self.assertEqual(
+            Detection.query.filter_by(user_id=user.id, label="dog").one().image_id,
+            image.id,
+        )
+
+        db.session.delete(image)
+        db.session.commit()
+        self.assertEqual(Detection.query.count(), 0)
+
+    def test_legacy_labels(self):
+        """
+        Test the labels of images stored before the detections table are read
+        from detected_as, and backfilled into detection rows.
+        """
+        from blueprints.object_detection.utils import labels_by_image, backfill_legacy_detections
+
+        self.assertEqual(parse_legacy_labels('{bird,"traffic light"}'), ["bird", "traffic light"])
+        self.assertEqual(parse_legacy_labels("['dog', 'cat']"), ["dog", "cat"])
+        self.assertEqual(parse_legacy_labels("test"), ["test"])
+        self.assertEqual(parse_legacy_labels(None), [])
+
+        user = User(username="testuser", email="test@example.com", password="password")
+        db.session.add(user)
+        db.session.commit()
+        image = Image(user_id=user.id, detected_as='{dog,"traffic light"}', url="test.jpg")
+        db.session.add(image)
+        db.session.commit()
+
+        self.assertEqual(image.labels, ["dog", "traffic light"])
+        self.assertEqual(labels_by_image([image.id]), {image.id: ["dog", "traffic light"]})
+
+        self.assertEqual(backfill_legacy_detections(), 1)
+        db.session.expire_all()
+        image = db.session.get(Image, image.id)
+        self.assertIsNone(image.detected_as)
+        self.assertEqual(image.labels, ["dog", "traffic light"])
+        self.assertEqual(image.boxes[0], {"label": "dog", "score": None, "box": None})
+        self.assertEqual(Detection.query.filter_by(user_id=user.id, label="dog").one().image_id, image.id)
+        self.assertEqual(backfill_legacy_detections(), 0)
+
 
 if __name__ == "__main__":
     unittest.main()
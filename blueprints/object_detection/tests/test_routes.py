@@ -1,3 +1,4 @@
+import io
 import os
 import unittest
 
@@ -5,6 +6,8 @@ from settings import Config
 
 from app import app
 from utils import db
+from blueprints.auth.models import User
+from blueprints.object_detection.models import Image
 
 
 class ObjectDetectionBlueprintTestCase(unittest.TestCase):
@@ -82,6 +85,52 @@ class ObjectDetectionBlueprintTestCase(unittest.TestCase):
         # Simulate invalid image
         pass
 
+    def test_detect_images(self):
+        """
+        Test the batch detect images route.
+        """
+        # Test missing images
+        response = self.client.post(
+            "/object-detection/detect-images",
+            headers={"Authorization": f"Bearer {self.access_token}"},
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json["msg"], "No images provided")
+
+        test_dir = os.path.dirname(__file__)
+        with open(os.path.join(test_dir, "test_img.jpeg"), "rb") as jpeg, open(
+            os.path.join(test_dir, "test_img.png"), "rb"
+        ) as png:
+            files = {
+                "images": [
+                    (jpeg, "test_img.jpeg"),
+                    (io.BytesIO(b"not an image"), "broken.png"),
+                    (io.BytesIO(b"text"), "notes.txt"),
+                    (png, "test_img.png"),
+                ]
+            }
+            response = self.client.post(
+                "/object-detection/detect-images",
+                data=files,
+                headers={"Authorization": f"Bearer {self.access_token}"},
+            )
+        self.assertEqual(response.status_code, 200)
+        results = response.json["results"]
+        self.assertEqual(
+            [result["filename"] for result in results],
+            ["test_img.jpeg", "broken.png", "notes.txt", "test_img.png"],
+        )
+        self.assertEqual(results[0]["detected_objs"]["detected_as"], ["bird"])
+        self.assertIn("error", results[1])
+        self.assertIn("error", results[2])
+        self.assertIn("detected_objs", results[3])
+        # Only the successful images are stored
+        self.assertEqual(Image.query.filter_by(user_id=1).count(), 2)
+
+        for result in (results[0], results[3]):
+            self.assertTrue(os.path.exists(result["img_url"]))
+            os.remove(result["img_url"])
+
     def test_get_images(self):
         """
         Test the get images route.
@@ -144,6 +193,60 @@ class ObjectDetectionBlueprintTestCase(unittest.TestCase):
         self.assertIsNotNone(response.json.get("url"))
         self.assertTrue(response.json.get("url").startswith(Config.BASE_URL))
 
+    def test_get_annotated_image(self):
+        """
+        Test the annotated image route.
+        """
+        from blueprints.object_detection.utils import render_cache
+
+        test_img_path = os.path.join(os.path.dirname(__file__), "test_img.jpeg")
+        with open(test_img_path, "rb") as image:
+            files = {"image": (image, "test_img.jpeg")}
+            response = self.client.post(
+                "/object-detection/detect-image",
+                data=files,
+                headers={"Authorization": f"Bearer {self.access_token}"},
+            )
+        self.assertEqual(response.status_code, 200)
+        image_id = response.json["image_id"]
+        img_url = response.json["img_url"]
+
+        # Raw boxes are stored with the image
+        response = self.client.get(
+            "/object-detection/image",
+            json={"image_id": image_id},
+            headers={"Authorization": f"Bearer {self.access_token}"},
+        )
+        self.assertEqual(response.json["boxes"][0]["label"], "bird")
+        self.assertEqual(len(response.json["boxes"][0]["box"]), 4)
+
+        # Rendered on first fetch, then served from the render cache
+        misses = render_cache.misses
+        for _ in range(2):
+            response = self.client.get(
+                f"/object-detection/image/annotated?image_id={image_id}&color=red&width=3",
+                headers={"Authorization": f"Bearer {self.access_token}"},
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.mimetype, "image/jpeg")
+            response.close()
+        self.assertEqual(render_cache.misses, misses + 1)
+
+        # Invalid options
+        response = self.client.get(
+            f"/object-detection/image/annotated?image_id={image_id}&color=notacolor",
+            headers={"Authorization": f"Bearer {self.access_token}"},
+        )
+        self.assertEqual(response.status_code, 400)
+
+        # Unknown image
+        response = self.client.get(
+            "/object-detection/image/annotated?image_id=999",
+            headers={"Authorization": f"Bearer {self.access_token}"},
+        )
+        self.assertEqual(response.status_code, 404)
+        os.remove(img_url)
+
     def test_delete_image(self):
         """
         Test the delete image route.
@@ -179,6 +282,444 @@ class ObjectDetectionBlueprintTestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 404)
         self.assertEqual(response.json["msg"], "Image not found")
 
+    def test_detect_image_cache(self):
+        """
+        Test that re-uploading the same image reuses the cached detection.
+        """
+        from blueprints.object_detection.utils import result_cache
+
+        test_img_path = os.path.join(os.path.dirname(__file__), "test_img.jpeg")
+        responses = []
+        for _ in range(2):
+            with open(test_img_path, "rb") as image:
+                files = {"image": (image, "test_img.jpeg")}
+                response = self.client.post(
+                    "/object-detection/detect-image",
+                    data=files,
+                    headers={"Authorization": f"Bearer {self.access_token}"},
+                )
+                self.assertEqual(response.status_code, 200)
+                responses.append(response.json)
+
+        hits_before = result_cache.stats()["hits"]
+        self.assertEqual(responses[0], responses[1])
+        # Each upload is still recorded for the user
+        self.assertEqual(Image.query.filter_by(user_id=1).count(), 2)
+
+        with open(test_img_path, "rb") as image:
+            files = {"image": (image, "test_img.jpeg")}
+            self.client.post(
+                "/object-detection/detect-image",
+                data=files,
+                headers={"Authorization": f"Bearer {self.access_token}"},
+            )
+        self.assertEqual(result_cache.stats()["hits"], hits_before + 1)
+        os.remove(responses[0]["img_url"])
+
+    def test_detect_image_async(self):
+        """
+        Test the async mode of the detect image route.
+        """
+        import time
+
+        test_img_path = os.path.join(os.path.dirname(__file__), "test_img.jpeg")
+        with open(test_img_path, "rb") as image:
+            files = {"image": (image, "test_img.jpeg")}
+            response = self.client.post(
+                "/object-detection/detect-image?async=true",
+                data=files,
+                headers={"Authorization": f"Bearer {self.access_token}"},
+            )
+        self.assertEqual(response.status_code, 202)
+        job_id = response.json["job_id"]
+        self.assertEqual(response.headers["Location"], f"/jobs/{job_id}")
+
+        for _ in range(600):
+            response = self.client.get(
+                f"/jobs/{job_id}",
+                headers={"Authorization": f"Bearer {self.access_token}"},
+            )
+            if response.status_code != 202:
+                break
+            time.sleep(0.1)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["detected_objs"]["detected_as"], ["bird"])
+        img_url = response.json["img_url"]
+        self.assertTrue(os.path.exists(img_url))
+        os.remove(img_url)
+
+        # Unknown jobs
+        response = self.client.get(
+            "/jobs/unknown",
+            headers={"Authorization": f"Bearer {self.access_token}"},
+        )
+        self.assertEqual(response.status_code, 404)
+
+    def test_detect_image_model_selection(self):
+        """
+        Test picking the detector and score threshold of the detect image route.
+        """
+        response = self.client.get(
+            "/object-detection/models",
+            headers={"Authorization": f"Bearer {self.access_token}"},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("ssdlite320_mobilenet_v3_large", response.json["models"])
+
+        test_img_path = os.path.join(os.path.dirname(__file__), "test_img.jpeg")
+        with open(test_img_path, "rb") as image:
+            files = {
+                "image": (image, "test_img.jpeg"),
+                "model": "fasterrcnn_mobilenet_v3_large_fpn",
+                "score_threshold": "0.5",
+            }
+            response = self.client.post(
+                "/object-detection/detect-image",
+                data=files,
+                headers={"Authorization": f"Bearer {self.access_token}"},
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["model"], "fasterrcnn_mobilenet_v3_large_fpn")
+        self.assertGreater(response.json["inference_ms"], 0)
+        image = Image.query.filter_by(id=response.json["image_id"]).first()
+        self.assertEqual(image.model_name, "fasterrcnn_mobilenet_v3_large_fpn")
+        self.assertIsNotNone(image.inference_ms)
+        os.remove(response.json["img_url"])
+
+        # Invalid options
+        for options in ({"model": "unknown"}, {"score_threshold": "2"}, {"score_threshold": "high"}):
+            with open(test_img_path, "rb") as image:
+                response = self.client.post(
+                    "/object-detection/detect-image",
+                    data={"image": (image, "test_img.jpeg"), **options},
+                    headers={"Authorization": f"Bearer {self.access_token}"},
+                )
+            self.assertEqual(response.status_code, 400)
+
+    def test_get_detection_stats(self):
+        """
+        Test the detection stats route.
+        """
+        # Normal users are not allowed
+        response = self.client.get(
+            "/object-detection/stats",
+            headers={"Authorization": f"Bearer {self.access_token}"},
+        )
+        self.assertEqual(response.status_code, 403)
+
+        user = User.query.filter_by(username="testuser").first()
+        user.is_admin = True
+        db.session.commit()
+
+        response = self.client.get(
+            "/object-detection/stats",
+            headers={"Authorization": f"Bearer {self.access_token}"},
+        )
+        self.assertEqual(response.status_code, 200)
+        stats = response.json["batchers"]["fasterrcnn_resnet50_fpn_v2"]
+        self.assertIn("queue_depth", stats)
+        self.assertIn("avg_batch_size", stats)
+        self.assertIn("batch_size_histogram", stats)
+        self.assertIn("hits", response.json["cache"])
+        self.assertIn("misses", response.json["cache"])
+
+    def test_get_images_pages(self):
+        """
+        Test the pagination, projection and streaming of the get images route.
+        """
+        from unittest import mock
+
+        from blueprints.object_detection.utils import store_image_in_database
+
+        user = User.query.filter_by(username="testuser").first()
+        images = [
+            store_image_in_database(
+                f"{i}.jpg", "1 object(s)", user.id,
+                boxes=[{"label": "cat", "score": 0.9, "box": [0.0, 0.0, 1.0, 1.0]}],
+            )
+            for i in range(5)
+        ]
+        headers = {"Authorization": f"Bearer {self.access_token}"}
+
+        response = self.client.get("/object-detection/images?limit=2&fields=id,detected_as", headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.json,
+            [{"id": images[0].id, "detected_as": ["cat"]}, {"id": images[1].id, "detected_as": ["cat"]}],
+        )
+        cursor = response.headers["X-Next-Cursor"]
+
+        response = self.client.get(f"/object-detection/images?limit=3&cursor={cursor}&fields=id", headers=headers)
+        self.assertEqual([image["id"] for image in response.json], [image.id for image in images[2:]])
+        self.assertNotIn("X-Next-Cursor", response.headers)
+
+        # Clients that do not paginate still get the whole list
+        with mock.patch.object(Config, "LIST_DEFAULT_LIMIT", 2):
+            response = self.client.get("/object-detection/images?fields=id", headers=headers)
+            self.assertEqual([image["id"] for image in response.json], [image.id for image in images])
+            self.assertNotIn("X-Next-Cursor", response.headers)
+            response = self.client.get(f"/object-detection/images?cursor={images[0].id}&fields=id", headers=headers)
+            self.assertEqual([image["id"] for image in response.json], [image.id for image in images[1:3]])
+
+        response = self.client.get("/object-detection/images?stream=1&fields=id,url", headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([image["url"] for image in response.json], [image.url for image in images])
+
+        response = self.client.get("/object-detection/images?fields=id,password", headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+    def test_get_image_file(self):
+        """
+        Test the image download route.
+        """
+        from utils.storage import storage
+        from blueprints.object_detection.utils import store_image_in_database
+
+        test_img_path = os.path.join(os.path.dirname(__file__), "test_img.png")
+        with open(test_img_path, "rb") as f:
+            data = f.read()
+        user = User.query.filter_by(username="testuser").first()
+        image = store_image_in_database(storage.put(data, "png", "images"), "0 object(s)", user.id, boxes=[])
+        headers = {"Authorization": f"Bearer {self.access_token}"}
+
+        response = self.client.get(f"/object-detection/image?image_id={image.id}", headers=headers)
+        file_url = response.json["file_url"]
+
+        response = self.client.get(file_url, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, data)
+        self.assertEqual(response.mimetype, "image/png")
+        self.assertIn("immutable", response.headers["Cache-Control"])
+        etag = response.headers["ETag"]
+
+        response = self.client.get(file_url, headers={**headers, "Range": "bytes=0-9"})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.data, data[:10])
+
+        response = self.client.get(file_url, headers={**headers, "If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+
+        # Without the content version the URL must be revalidated
+        response = self.client.get(f"/object-detection/image/file?image_id={image.id}", headers=headers)
+        self.assertEqual(response.headers["Cache-Control"], "private, no-cache")
+
+        response = self.client.get("/object-detection/image/file?image_id=999", headers=headers)
+        self.assertEqual(response.status_code, 404)
+
+        self.client.delete("/object-detection/image", json={"image_id": image.id}, headers=headers)
+
+    def test_get_image_thumbnail(self):
+        """
+        Test the image thumbnail route.
+        """
+        from PIL import Image as PILImage
+
+        from utils.storage import storage
+        from blueprints.object_detection.utils import store_image_in_database
+
+        test_img_path = os.path.join(os.path.dirname(__file__), "test_img.jpeg")
+        with open(test_img_path, "rb") as f:
+            location = storage.put(f.read(), "jpeg", "images")
+        user = User.query.filter_by(username="testuser").first()
+        image = store_image_in_database(location, "0 object(s)", user.id, boxes=[])
+        headers = {"Authorization": f"Bearer {self.access_token}"}
+        size = Config.DERIVATIVE_SIZES[0]
+
+        response = self.client.get("/object-detection/images", headers=headers)
+        thumbnail_url = response.json[0]["thumbnails"][str(size)]
+
+        response = self.client.get(thumbnail_url, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "image/webp")
+        self.assertIn("immutable", response.headers["Cache-Control"])
+        thumbnail = PILImage.open(io.BytesIO(response.data))
+        self.assertEqual(thumbnail.format, "WEBP")
+        self.assertLessEqual(max(thumbnail.size), size)
+
+        response = self.client.get(
+            f"/object-detection/image/thumbnail?image_id={image.id}&size=123", headers=headers
+        )
+        self.assertEqual(response.status_code, 400)
+
+        self.client.delete("/object-detection/image", json={"image_id": image.id}, headers=headers)
+
+    def test_conditional_get(self):
+        """
+        Test the get image routes answer conditional requests.
+        """
+        from blueprints.object_detection.utils import store_image_in_database
+
+        user = User.query.filter_by(username="testuser").first()
+        image = store_image_in_database("cat.jpg", "0 object(s)", user.id, boxes=[])
+        headers = {"Authorization": f"Bearer {self.access_token}"}
+
+        response = self.client.get("/object-detection/images", headers=headers)
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers["ETag"]
+        self.assertIn("Last-Modified", response.headers)
+
+        response = self.client.get(
+            "/object-detection/images", headers={**headers, "If-None-Match": etag}
+        )
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers["ETag"], etag)
+
+        # The image id is read from the query string
+        response = self.client.get(f"/object-detection/image?image_id={image.id}", headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["url"], "cat.jpg")
+        self.assertNotEqual(response.headers["ETag"], etag)
+
+        # Ids sent in the JSON body by older clients are part of the ETag too
+        other = store_image_in_database("dog.jpg", "0 object(s)", user.id, boxes=[])
+        response = self.client.get("/object-detection/image", json={"image_id": image.id}, headers=headers)
+        other_response = self.client.get("/object-detection/image", json={"image_id": other.id}, headers=headers)
+        self.assertEqual(other_response.json["url"], "dog.jpg")
+        self.assertNotEqual(response.headers["ETag"], other_response.headers["ETag"])
+        response = self.client.get(
+            "/object-detection/image",
+            json={"image_id": other.id},
+            headers={**headers, "If-None-Match": response.headers["ETag"]},
+        )
+        self.assertEqual(response.status_code, 200)
+
+        # A change within the same second still invalidates If-Modified-Since
+        response = self.client.get("/object-detection/images", headers=headers)
+        last_modified = response.headers["Last-Modified"]
+        response = self.client.get(
+            "/object-detection/images", headers={**headers, "If-Modified-Since": last_modified}
+        )
+        self.assertEqual(response.status_code, 304)
+        self.client.delete("/object-detection/image", json={"image_id": other.id}, headers=headers)
+        response = self.client.get(
+            "/object-detection/images", headers={**headers, "If-Modified-Since": last_modified}
+        )
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers["ETag"]
+
+        response = self.client.delete(
+            "/object-detection/image", json={"image_id": image.id}, headers=headers
+        )
+        self.assertEqual(response.status_code, 204)
+        response = self.client.get(
+            "/object-detection/images", headers={**headers, "If-None-Match": etag}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, [])
+
+    def test_detect_video_too_large(self):
+        """
+        Test videos over the size limit are refused before their body is parsed.
+        """
+        from unittest import mock
+
+        from werkzeug.exceptions import RequestEntityTooLarge
+        from blueprints.object_detection.routes import _CappedStream
+
+        headers = {"Authorization": f"Bearer {self.access_token}"}
+        with mock.patch.object(Config, "DETECTION_VIDEO_MAX_BYTES", 1024):
+            response = self.client.post(
+                "/object-detection/detect-video",
+                data={"video": (io.BytesIO(b"\0" * 4096), "clip.mp4")},
+                headers=headers,
+            )
+        self.assertEqual(response.status_code, 413)
+
+        # Chunked bodies are cut off while they are read
+        stream = _CappedStream(io.BytesIO(b"\0" * 4096), 1024)
+        self.assertEqual(len(stream.read(1000)), 1000)
+        with self.assertRaises(RequestEntityTooLarge):
+            stream.read(1000)
+
+    def test_detect_video(self):
+        """
+        Test a video is decoded and tracked end to end, and a corrupt one is refused.
+        """
+        import tempfile
+
+        from blueprints.object_detection.tests.test_utils import write_clip
+
+        headers = {"Authorization": f"Bearer {self.access_token}"}
+        fd, path = tempfile.mkstemp(suffix=".mp4")
+        os.close(fd)
+        try:
+            write_clip(path)
+            with open(path, "rb") as f:
+                clip = f.read()
+        finally:
+            os.remove(path)
+
+        response = self.client.post(
+            "/object-detection/detect-video",
+            data={"video": (io.BytesIO(clip), "clip.mp4"), "sample_fps": "0", "results": "frames"},
+            headers=headers,
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["frames_sampled"], 8)
+        self.assertEqual(len(response.json["frames"]), 8)
+        self.assertIn("tracks", response.json)
+
+        response = self.client.post(
+            "/object-detection/detect-video",
+            data={"video": (io.BytesIO(b"not a video" * 100), "clip.mp4")},
+            headers=headers,
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json["msg"], "Could not decode the video")
+
+    def test_search_images(self):
+        """
+        Test the search route.
+        """
+        from blueprints.object_detection.utils import store_image_in_database
+
+        user = User.query.filter_by(username="testuser").first()
+
+        def box(label, score):
+            return {"label": label, "score": score, "box": [0.0, 0.0, 10.0, 10.0]}
+
+        crowd = store_image_in_database(
+            "crowd.jpg", "4 object(s)", user.id,
+            boxes=[box("person", 0.95), box("person", 0.9), box("person", 0.85), box("car", 0.99)],
+        )
+        pair = store_image_in_database(
+            "pair.jpg", "3 object(s)", user.id,
+            boxes=[box("person", 0.95), box("person", 0.5), box("car", 0.9)],
+        )
+        dog = store_image_in_database("dog.jpg", "1 object(s)", user.id, boxes=[box("dog", 0.99)])
+        headers = {"Authorization": f"Bearer {self.access_token}"}
+
+        response = self.client.get(
+            "/object-detection/search?label=person:3&label=car&min_score=0.8", headers=headers
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([image["id"] for image in response.json["images"]], [crowd.id])
+
+        # The low scoring person does not count towards the two persons
+        response = self.client.get(
+            "/object-detection/search?label=person:2&min_score=0.8", headers=headers
+        )
+        self.assertEqual([image["id"] for image in response.json["images"]], [crowd.id])
+        response = self.client.get("/object-detection/search?label=person:2", headers=headers)
+        self.assertEqual([image["id"] for image in response.json["images"]], [crowd.id, pair.id])
+        self.assertEqual(response.json["images"][1]["boxes"][1], box("person", 0.5))
+
+        # Keyset pagination like the list endpoints
+        response = self.client.get("/object-detection/search?limit=2", headers=headers)
+        self.assertEqual([image["id"] for image in response.json["images"]], [crowd.id, pair.id])
+        cursor = response.headers["X-Next-Cursor"]
+        response = self.client.get(f"/object-detection/search?limit=2&cursor={cursor}", headers=headers)
+        self.assertEqual([image["id"] for image in response.json["images"]], [dog.id])
+        self.assertNotIn("X-Next-Cursor", response.headers)
+
+        response = self.client.get("/object-detection/search?label=dog&fields=id,detected_as", headers=headers)
+        self.assertEqual(response.json["images"], [{"id": dog.id, "detected_as": ["dog"]}])
+
+        for query in ["label=person:0", "min_score=high", "since=yesterday", "limit=0", f"limit={Config.LIST_MAX_LIMIT + 1}"]:
+            response = self.client.get(f"/object-detection/search?{query}", headers=headers)
+            self.assertEqual(response.status_code, 400)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1 +1,331 @@
-# If these functions do not work well, they'd be detected by the routes test
\ No newline at end of file
+import os
+import threading
+import time
+import unittest
+from typing import Dict, List, Tuple
+
+import torch
+
+from blueprints.object_detection.batching import InferenceBatcher
+
+
+class InferenceBatcherTestCase(unittest.TestCase):
+    def test_each_caller_gets_its_own_result(self):
+        batcher = InferenceBatcher(
+            lambda items: [item * 2 for item in items], max_batch_size=4, max_wait=0.05
+        )
+        futures = [batcher.submit(i) for i in range(10)]
+        self.assertEqual([f.result(timeout=5) for f in futures], [i * 2 for i in range(10)])
+
+        stats = batcher.stats()
+        self.assertEqual(stats["items"], 10)
+        self.assertLessEqual(stats["max_batch_size_seen"], 4)
+        self.assertEqual(stats["queue_depth"], 0)
+
+    def test_flushes_after_max_wait(self):
+        batcher = InferenceBatcher(lambda items: items, max_batch_size=100, max_wait=0.02)
+        start = time.monotonic()
+        self.assertEqual(batcher.submit("only").result(timeout=5), "only")
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(batcher.stats()["batch_size_histogram"], {1: 1})
+
+    def test_batches_grow_while_model_is_busy(self):
+        release = threading.Event()
+
+        def run_batch(items):
+            release.wait(5)
+            return items
+
+        batcher = InferenceBatcher(run_batch, max_batch_size=8, max_wait=0)
+        first = batcher.submit(0)
+        time.sleep(0.05)
+        rest = [batcher.submit(i) for i in range(1, 6)]
+        release.set()
+
+        self.assertEqual(first.result(timeout=5), 0)
+        self.assertEqual([f.result(timeout=5) for f in rest], [1, 2, 3, 4, 5])
+        self.assertEqual(batcher.stats()["max_batch_size_seen"], 5)
+
+    def test_errors_reach_every_caller(self):
+        def run_batch(items):
+            raise ValueError("boom")
+
+        batcher = InferenceBatcher(run_batch, max_batch_size=2, max_wait=0.05)
+        futures = [batcher.submit(i) for i in range(2)]
+        for future in futures:
+            with self.assertRaises(ValueError):
+                future.result(timeout=5)
+
+
+class TinyDetector:
+    """
+    Stand-in for Detector with a one layer model
+    """
+
+    def __init__(self):
+        self.backend = torch.nn.Conv2d(3, 1, 1, bias=False)
+        torch.nn.init.ones_(self.backend.weight)
+        self.ready = False
+
+    def preprocess(self, image):
+        return image
+
+    def infer(self, batch):
+        with torch.inference_mode():
+            return [self.backend(image.unsqueeze(0)).sum().item() for image in batch]
+
+    def mark_ready(self):
+        self.ready = True
+
+
+def run_tiny_batch(batch):
+    from blueprints.object_detection import workers
+
+    return [
+        {"sum": total, "pid": os.getpid(), "threads": torch.get_num_threads()}
+        for total in workers._worker_detector.infer(batch)
+    ]
+
+
+def crash_worker():
+    os._exit(1)
+
+
+class DetectorWorkerPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        from blueprints.object_detection.workers import DetectorWorkerPool
+
+        self.detector = TinyDetector()
+        self.pool = DetectorWorkerPool(2, threads_per_worker=1, detector=self.detector)
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def test_runs_batches_in_the_workers(self):
+        batcher = InferenceBatcher(
+            run_tiny_batch, max_batch_size=4, max_wait=0.05, executor=self.pool, max_inflight=2
+        )
+        futures = [batcher.submit(torch.full((3, 2, 2), float(i))) for i in range(6)]
+        results = [f.result(timeout=30) for f in futures]
+
+        self.assertEqual([result["sum"] for result in results], [12.0 * i for i in range(6)])
+        self.assertTrue(self.detector.ready)
+        self.assertNotIn(os.getpid(), {result["pid"] for result in results})
+        self.assertEqual({result["threads"] for result in results}, {1})
+
+    def test_replaces_a_broken_pool(self):
+        from concurrent.futures.process import BrokenProcessPool
+
+        with self.assertRaises(BrokenProcessPool):
+            self.pool.submit(crash_worker).result(timeout=30)
+
+        result = self.pool.submit(run_tiny_batch, [torch.ones(3, 2, 2)]).result(timeout=30)
+        self.assertEqual(result[0]["sum"], 12.0)
+        self.assertEqual(self.pool.stats()["restarts"], 1)
+
+
+class TinyScriptableDetector(torch.nn.Module):
+    """
+    Scriptable model returning (losses, detections) like torchvision's
+    """
+
+    def forward(self, images: List[torch.Tensor]) -> Tuple[Dict[str, torch.Tensor], List[Dict[str, torch.Tensor]]]:
+        losses: Dict[str, torch.Tensor] = {}
+        return losses, [{"scores": image.sum().reshape(1)} for image in images]
+
+
+class BackendsTestCase(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+
+        shutil.rmtree(self.cache_dir)
+
+    def test_rejects_unknown_backends(self):
+        from blueprints.object_detection.backends import build_backend
+
+        with self.assertRaises(ValueError):
+            build_backend("tensorrt", TinyScriptableDetector().eval(), self.cache_dir, "tiny")
+
+    def test_reuses_the_built_model(self):
+        from unittest import mock
+        from blueprints.object_detection.backends import build_backend, TorchScriptBackend
+
+        batch = [torch.ones(3, 2, 2)]
+        backend = build_backend("torchscript", TinyScriptableDetector().eval(), self.cache_dir, "tiny")
+        self.assertEqual(backend(batch)[0]["scores"].item(), 12.0)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+
+        # A second process loads the saved module instead of scripting again
+        with mock.patch.object(TorchScriptBackend, "build", side_effect=AssertionError("rebuilt")):
+            backend = build_backend("torchscript", TinyScriptableDetector().eval(), self.cache_dir, "tiny")
+        self.assertEqual(backend(batch)[0]["scores"].item(), 12.0)
+
+    def test_save_atomically_cleans_up_on_failure(self):
+        from blueprints.object_detection.backends import save_atomically
+
+        path = os.path.join(self.cache_dir, "model.pt")
+        with open(path, "wb") as f:
+            f.write(b"previous")
+
+        def save(tmp_path):
+            with open(tmp_path, "wb") as f:
+                f.write(b"partial")
+            raise RuntimeError("export failed")
+
+        with self.assertRaises(RuntimeError):
+            save_atomically(path, save)
+        self.assertEqual(os.listdir(self.cache_dir), ["model.pt"])
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), b"previous")
+
+
+class DecodeImageTestCase(unittest.TestCase):
+    def test_decodes_to_working_size(self):
+        from PIL import Image as PILImage
+
+        from blueprints.object_detection.utils import decode_image
+
+        path = os.path.join(os.path.dirname(__file__), "test_img.jpeg")
+        with open(path, "rb") as f:
+            data = f.read()
+        width, height = PILImage.open(path).size
+
+        img, (scale_x, scale_y) = decode_image(data, 64, 96)
+        self.assertLessEqual(max(img.size), 96)
+        self.assertLessEqual(min(img.size), 64)
+        self.assertEqual(img.mode, "RGB")
+        self.assertAlmostEqual(img.size[0] * scale_x, width, delta=1)
+        self.assertAlmostEqual(img.size[1] * scale_y, height, delta=1)
+
+    def test_small_images_are_not_upscaled(self):
+        from blueprints.object_detection.utils import decode_image
+
+        path = os.path.join(os.path.dirname(__file__), "test_img.png")
+        with open(path, "rb") as f:
+            img, scale = decode_image(f.read(), 10000, 20000)
+        self.assertEqual(scale, (1.0, 1.0))
+
+
+class IoUTrackerTestCase(unittest.TestCase):
+    def test_links_overlapping_boxes_into_tracks(self):
+        import torch
+        from blueprints.object_detection.video import IoUTracker
+
+        tracker = IoUTracker(iou_threshold=0.3, max_age=1.0)
+        tracker.update(0.0, ["car", "dog"], torch.tensor([0.9, 0.8]), torch.tensor([[0, 0, 10, 10], [50, 50, 60, 60]]))
+        tracker.update(0.5, ["car"], torch.tensor([0.95]), torch.tensor([[1, 1, 11, 11]]))
+        tracker.update(2.0, ["car"], torch.tensor([0.9]), torch.tensor([[2, 2, 12, 12]]))
+
+        tracks = tracker.tracks()
+        self.assertEqual([track["label"] for track in tracks], ["car", "dog"])
+        car, dog = tracks
+        self.assertEqual((car["first_seen"], car["last_seen"], car["frames"]), (0.0, 2.0, 3))
+        self.assertEqual(car["max_score"], 0.95)
+        # The dog was not seen for longer than max_age
+        self.assertIn(dog, tracker.closed)
+
+    def test_unchanged_frames_carry_the_last_boxes(self):
+        import torch
+        from blueprints.object_detection.video import IoUTracker
+
+        tracker = IoUTracker()
+        tracker.mark_inferred(0.0)
+        tracker.update(0.0, ["cat"], torch.tensor([0.9]), torch.tensor([[0, 0, 10, 10]]))
+        carried = tracker.carry(0.5)
+        self.assertEqual([(track["label"], score, box) for track, score, box in carried], [("cat", None, [0, 0, 10, 10])])
+        self.assertEqual(tracker.tracks()[0]["frames"], 2)
+
+
+def write_clip(path, num_frames=8, fps=4):
+    """
+    Write a tiny video of a white square moving across a black frame
+    """
+    from torchvision.io import write_video
+
+    frames = torch.zeros(num_frames, 64, 64, 3, dtype=torch.uint8)
+    for i in range(num_frames):
+        frames[i, 16:32, 4 * i : 4 * i + 16] = 255
+    write_video(path, frames, fps=fps)
+
+
+class SampledFramesTestCase(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+
+        fd, self.path = tempfile.mkstemp(suffix=".mp4")
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+
+    def test_samples_the_frames(self):
+        from blueprints.object_detection.video import iter_sampled_frames
+
+        write_clip(self.path)
+        frames = list(iter_sampled_frames(self.path, 0))
+        self.assertEqual(len(frames), 8)
+        self.assertEqual(tuple(frames[0][1].shape), (3, 64, 64))
+        # 2 of the clip's 4 frames per second
+        timestamps = [timestamp for timestamp, _ in iter_sampled_frames(self.path, 2)]
+        self.assertEqual(len(timestamps), 4)
+        self.assertEqual(timestamps, sorted(timestamps))
+
+    def test_corrupt_file_is_a_decode_error(self):
+        from blueprints.object_detection.video import iter_sampled_frames, VideoDecodeError
+
+        with open(self.path, "wb") as f:
+            f.write(b"not a video" * 100)
+        with self.assertRaises(VideoDecodeError):
+            list(iter_sampled_frames(self.path, 0))
+
+        # Cut short after its header: depending on where the cut falls, the
+        # frames before it are decoded or the file is refused, never anything else
+        write_clip(self.path, num_frames=32)
+        with open(self.path, "r+b") as f:
+            f.truncate(os.path.getsize(self.path) // 3)
+        try:
+            list(iter_sampled_frames(self.path, 0))
+        except VideoDecodeError:
+            pass
+
+
+class TilingTestCase(unittest.TestCase):
+    def test_tiles_cover_the_image(self):
+        from blueprints.object_detection.tiling import tile_grid
+
+        tiles = tile_grid(2000, 900, 800, 100)
+        self.assertEqual([tile[0] for tile in tiles[:3]], [0, 700, 1200])
+        self.assertEqual({tile[2] for tile in tiles}, {800, 1500, 2000})
+        self.assertEqual({(tile[1], tile[3]) for tile in tiles}, {(0, 800), (100, 900)})
+        self.assertEqual(tile_grid(500, 400, 800, 100), [(0, 0, 500, 400)])
+
+    def test_merges_duplicates_across_tiles(self):
+        import torch
+        from blueprints.object_detection.tiling import merge_predictions
+
+        def prediction(boxes, scores, labels):
+            return {
+                "boxes": torch.tensor(boxes, dtype=torch.float32),
+                "scores": torch.tensor(scores),
+                "labels": torch.tensor(labels),
+            }
+
+        merged = merge_predictions(
+            [
+                # A car across the border of two tiles, and a dog in the first one
+                (prediction([[650, 10, 800, 60], [100, 100, 120, 120]], [0.9, 0.8], [3, 18]), (0, 0), (1, 1)),
+                (prediction([[0, 10, 40, 60]], [0.7], [3]), (700, 0), (1, 1)),
+                # The downscaled pass sees the whole car
+                (prediction([[325, 5, 395, 30]], [0.95], [3]), (0, 0), (2, 2)),
+            ],
+            iou_threshold=0.5,
+        )
+        self.assertEqual(merged["labels"].tolist(), [3, 18])
+        self.assertEqual(merged["boxes"][0].tolist(), [650, 10, 790, 60])
+
+
+if __name__ == "__main__":
+    unittest.main()
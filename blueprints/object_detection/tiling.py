@@ -0,0 +1,73 @@
+import torch
+from torchvision.ops import batched_nms
+
+
+def tile_grid(width, height, tile_size, overlap):
+    """
+    Overlapping tiles covering an image, the last row and column aligned
+    with the image edges
+    Args:
+        width, height: size of the image
+        tile_size: side of a tile
+        overlap: pixels shared by neighbouring tiles
+    Returns:
+        list of (left, top, right, bottom) boxes
+    """
+    stride = max(1, tile_size - overlap)
+
+    def starts(length):
+        if length <= tile_size:
+            return [0]
+        return list(range(0, length - tile_size, stride)) + [length - tile_size]
+
+    return [
+        (left, top, min(left + tile_size, width), min(top + tile_size, height))
+        for top in starts(height)
+        for left in starts(width)
+    ]
+
+
+def merge_predictions(predictions, iou_threshold, containment_threshold=0.8):
+    """
+    Merge the predictions of overlapping tiles into image coordinates
+
+    Duplicates of an object seen by several tiles are removed with a
+    per-label NMS. An object cut by a tile border also leaves a partial box
+    that barely overlaps the full one in IoU terms, so boxes mostly contained
+    in a better scored box of the same label are dropped as well.
+    Args:
+        predictions: list of (prediction dict, (offset_x, offset_y), (scale_x, scale_y))
+            mapping each tile's boxes to image coordinates
+        iou_threshold: NMS IoU threshold
+        containment_threshold: share of a box's area inside a better box
+            above which it is dropped
+    Returns:
+        prediction dict with boxes, scores and labels, best scores first
+    """
+    boxes, scores, labels = [], [], []
+    for prediction, (offset_x, offset_y), (scale_x, scale_y) in predictions:
+        boxes.append(
+            prediction["boxes"] * torch.tensor([scale_x, scale_y, scale_x, scale_y])
+            + torch.tensor([offset_x, offset_y, offset_x, offset_y])
+        )
+        scores.append(prediction["scores"])
+        labels.append(prediction["labels"])
+    if not boxes:
+        return {"boxes": torch.zeros((0, 4)), "scores": torch.zeros(0), "labels": torch.zeros(0, dtype=torch.int64)}
+    boxes, scores, labels = torch.cat(boxes), torch.cat(scores), torch.cat(labels)
+
+    keep = batched_nms(boxes, scores, labels, iou_threshold)
+    boxes, scores, labels = boxes[keep], scores[keep], labels[keep]
+
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    top_left = torch.max(boxes[:, None, :2], boxes[None, :, :2])
+    bottom_right = torch.min(boxes[:, None, 2:], boxes[None, :, 2:])
+    intersection = (bottom_right - top_left).clamp(min=0).prod(dim=2)
+    contained = (intersection / areas[:, None].clamp(min=1e-6)).tolist()
+    same_label = (labels[:, None] == labels[None, :]).tolist()
+    kept = []
+    for i in range(len(boxes)):
+        if not any(same_label[i][j] and contained[i][j] > containment_threshold for j in kept):
+            kept.append(i)
+    kept = torch.tensor(kept, dtype=torch.int64)
+    return {"boxes": boxes[kept], "scores": scores[kept], "labels": labels[kept]}
@@ -1,108 +1,809 @@
-import os
-import warnings
-from uuid import uuid4
-
-import torch
-from torchvision.models.detection import (
-    fasterrcnn_resnet50_fpn_v2,
-    FasterRCNN_ResNet50_FPN_V2_Weights,
-)
-from torchvision.utils import draw_bounding_boxes
-from torchvision.transforms.functional import to_pil_image
-from torchvision import transforms as T
+import io
+import json
+import time
+import hashlib
+import functools
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-from PIL import Image as PILImage
+from PIL import Image as PILImage, ImageDraw, ImageFont
+from sqlalchemy import insert, func, inspect, text, bindparam
+from sqlalchemy.orm import selectinload
 
 from settings import Config
-from utils import db
-from .models import Image as DBModelImage
+from utils import db, redis_client
+from utils.caching import LRUCache, RedisCache, SingleFlight, DiskCache
+from utils.conditional import bump_version
+from utils.storage import storage
+from .models import Image as DBModelImage, Detection, parse_legacy_labels
+from .batching import InferenceBatcher
+from .detector import detector, registry
+from .workers import DetectorWorkerPool
+
+
+def run_detector(model_name, batch):
+    """
+    Run a detector on a batch of preprocessed images
+    Args:
+        model_name: name of the detector in the registry
+        batch: list of image tensors
+    Returns:
+        list of prediction dicts, one per image, each with its share of the
+        batch's inference time in inference_ms
+    """
+    detector = registry.get(model_name)
+    start = time.perf_counter()
+    predictions = detector.infer(batch)
+    inference_ms = 1000 * (time.perf_counter() - start) / max(1, len(batch))
+    detector.mark_ready()
+    for prediction in predictions:
+        prediction["inference_ms"] = inference_ms
+    return predictions
+
+
+worker_pool = None
+if Config.DETECTION_WORKERS > 0:
+    import torch
+
+    # Worker processes are forked, which does not mix with an initialized CUDA context
+    if not torch.cuda.is_available():
+        worker_pool = DetectorWorkerPool(
+            Config.DETECTION_WORKERS, threads_per_worker=Config.DETECTION_WORKER_THREADS
+        )
+
+batchers = {}
+batchers_lock = threading.Lock()
 
 
-weights = FasterRCNN_ResNet50_FPN_V2_Weights.DEFAULT
-model = fasterrcnn_resnet50_fpn_v2(box_score_thresh=0.9, weights=weights)
-model.eval()
-cuda = torch.cuda.is_available()
-if cuda:
-    model.cuda()
-    weights.cuda()
-preprocess = weights.transforms()
+def get_batcher(model_name):
+    """
+    Get the inference batcher of a detector, each detector batches separately
+    """
+    with batchers_lock:
+        if model_name not in batchers:
+            batchers[model_name] = InferenceBatcher(
+                functools.partial(run_detector, model_name),
+                max_batch_size=Config.DETECTION_BATCH_MAX_SIZE,
+                max_wait=Config.DETECTION_BATCH_MAX_WAIT_MS / 1000,
+                executor=worker_pool,
+                max_inflight=worker_pool.num_workers if worker_pool else 1,
+            )
+        return batchers[model_name]
+
+
+def warmup_detector():
+    """
+    Load and warm up the default detector, in the worker pool when one is configured
+    """
+    if worker_pool is not None:
+        worker_pool.start()
+    else:
+        detector.warmup()
 
 
-def detect_object(image, user_id):
+if Config.DETECTION_CACHE_BACKEND == "redis":
+    result_cache = RedisCache(redis_client, "detection-cache", ttl=Config.DETECTION_CACHE_TTL)
+elif Config.DETECTION_CACHE_BACKEND == "memory":
+    result_cache = LRUCache(Config.DETECTION_CACHE_MAX_BYTES)
+else:
+    result_cache = None
+inflight_detections = SingleFlight()
+
+
+def detect_object(image, user_id, model_name=None, score_threshold=None, tiled=False):
     """
     Detect the object in the image
+
+    Uploads are keyed by the sha256 of their bytes. A cached result is reused
+    without running the model, and concurrent identical uploads share a
+    single inference.
+    Args:
+        image: FileStorage
+        user_id: integer
+        model_name: detector from the registry, the default one when None
+        score_threshold: minimum score of the kept boxes, the configured
+            default when None
+        tiled: run the detector on overlapping tiles at full resolution,
+            see run_tiled_detection
+    Returns:
+        (results dict, Image db object)
     """
+    model_name = model_name or registry.default_name
+    if score_threshold is None:
+        score_threshold = Config.DETECTION_DEFAULT_SCORE_THRESH
     img_extension = image.filename.split(".")[-1]
-    img = PILImage.open(image).convert("RGB")
-    img = T.ToTensor()(img)
-    batch = [preprocess(img)]
+    data = image.read()
+    key = cache_key(hashlib.sha256(data).hexdigest(), model_name, score_threshold, tiled)
+    run = run_tiled_detection if tiled else run_detection
 
-    predictions = model(batch)[0]
-    labels = [weights.meta["categories"][i] for i in predictions["labels"]]
-    num_detected = len(labels)
+    detection, shared = inflight_detections.call(
+        key,
+        lambda: get_cached_detection(key)
+        or run(data, key, model_name, score_threshold),
+    )
+    if shared:
+        # Waited on a concurrent identical upload, no inference ran for this one
+        detection = {**detection, "inference_ms": None}
+
+    results = {
+        "detected_as": detection["detected_as"],
+        "description": detection["description"],
+    }
+    image_db_obj = store_image_in_database(
+        file_path=storage.put(data, img_extension, "images"),
+        user_id=user_id,
+        description=results["description"],
+        boxes=detection["boxes"],
+        model_name=detection["model_name"],
+        inference_ms=detection["inference_ms"],
+    )
+
+    return results, image_db_obj
+
+
+def cache_key(digest, model_name, score_threshold, tiled=False):
+    """
+    Key of a detection result: the upload's sha256 and the detection options
+    """
+    key = f"{digest}:{model_name}:{score_threshold}"
+    return f"{key}:tiled" if tiled else key
+
+
+def get_cached_detection(key):
+    """
+    Look up a previous detection of the same image bytes with the same options
+    Args:
+        key: from cache_key
+    Returns:
+        dict with detected_as, description, boxes, model_name and
+        inference_ms, which is None as no inference ran, or None
+    """
+    if result_cache is None:
+        return None
+    detection = result_cache.get(key)
+    if detection is None:
+        return None
+    # No inference ran for this request
+    return {**detection, "inference_ms": None}
+
+
+def run_detection(data, key, model_name, score_threshold):
+    """
+    Run the detector on the image and cache the result
+    Args:
+        data: bytes of the uploaded image
+        key: from cache_key
+        model_name: detector from the registry
+        score_threshold: minimum score of the kept boxes
+    Returns:
+        dict with detected_as, description, boxes, model_name and inference_ms
+    """
+    scale, prediction = queue_detection(data, model_name)
+    return finish_detection(scale, prediction.result(), key, model_name, score_threshold)
+
+
+def run_tiled_detection(data, key, model_name, score_threshold):
+    """
+    Run the detector on overlapping full resolution tiles of a large image
+
+    The detector resizes its input to about a megapixel, which wipes out
+    small objects in large aerial photos. Here the image is cut into
+    DETECTION_TILE_SIZE tiles overlapping by DETECTION_TILE_OVERLAP pixels,
+    each seen at full resolution, plus one downscaled pass over the whole
+    image for objects larger than a tile. Tiles are cropped and converted
+    to tensors lazily, and only enough of them to fill the batcher's
+    in-flight batches are queued at a time, so the float tensors held in
+    memory depend on the tile size and not on the image size. Boxes are
+    mapped back to the image and merged with NMS across tile borders.
+    Args:
+        data: bytes of the uploaded image
+        key: from cache_key
+        model_name: detector from the registry
+        score_threshold: minimum score of the kept boxes
+    Returns:
+        dict with detected_as, description, boxes, model_name and inference_ms
+    """
+    from torchvision.transforms.functional import pil_to_tensor
+    from .tiling import tile_grid, merge_predictions
 
-    img_uint8 = (img * 255).byte()
-    with warnings.catch_warnings():
-        # Ignore warnings that contain "boxes doesn't contain any box. No box was drawn" in their message
-        warnings.filterwarnings("ignore", category=UserWarning, message=".*boxes doesn't contain any box. No box was drawn.*")
-        box = draw_bounding_boxes(
-            img_uint8,
-            boxes=predictions["boxes"],
-            labels=labels,
-            colors="blue",
-            width=2,
-            font="arial",
-            font_size=30,
+    detector = registry.get(model_name)
+    batcher = get_batcher(model_name)
+    img = PILImage.open(io.BytesIO(data)).convert("RGB")
+    tiles = tile_grid(*img.size, Config.DETECTION_TILE_SIZE, Config.DETECTION_TILE_OVERLAP)
+    window = batcher.max_batch_size * batcher.max_inflight
+
+    collected = []
+    inflight = deque()
+    inference_ms = 0.0
+
+    def collect(offset, scale, future):
+        nonlocal inference_ms
+        prediction = future.result()
+        inference_ms += prediction["inference_ms"]
+        keep = prediction["scores"] >= score_threshold
+        collected.append(
+            ({name: prediction[name][keep] for name in ("boxes", "scores", "labels")}, offset, scale)
         )
-    img = to_pil_image(box.detach())
 
-    results = {
+    if len(tiles) > 1:
+        scale, future = queue_detection(data, model_name)
+        inflight.append(((0, 0), scale, future))
+    for tile in tiles:
+        tensor = detector.preprocess(pil_to_tensor(img.crop(tile)))
+        inflight.append((tile[:2], (1.0, 1.0), batcher.submit(tensor)))
+        while len(inflight) >= window:
+            collect(*inflight.popleft())
+    while inflight:
+        collect(*inflight.popleft())
+
+    merged = merge_predictions(collected, Config.DETECTION_TILE_NMS_IOU)
+    merged["inference_ms"] = inference_ms
+    return finish_detection((1.0, 1.0), merged, key, model_name, score_threshold)
+
+
+def queue_detection(data, model_name):
+    """
+    Decode the image at the model's working size and queue it on the inference batcher
+    Args:
+        data: bytes of the uploaded image
+        model_name: detector from the registry
+    Returns:
+        (scale, Future of the predictions), where scale maps the boxes back
+        to the original image coordinates
+    """
+    from torchvision.transforms.functional import pil_to_tensor
+
+    detector = registry.get(model_name)
+    img, scale = decode_image(data, *detector.input_size)
+    tensor = detector.preprocess(pil_to_tensor(img))
+
+    return scale, get_batcher(model_name).submit(tensor)
+
+
+def detect_video_objects(path, model_name=None, score_threshold=None, sample_fps=None, change_threshold=None, per_frame=False):
+    """
+    Detect and track the objects of a video file, see video.detect_video
+    """
+    from .video import detect_video
+
+    model_name = model_name or registry.default_name
+    if score_threshold is None:
+        score_threshold = Config.DETECTION_DEFAULT_SCORE_THRESH
+    if sample_fps is None:
+        sample_fps = Config.DETECTION_VIDEO_SAMPLE_FPS
+    if change_threshold is None:
+        change_threshold = Config.DETECTION_VIDEO_CHANGE_THRESH
+
+    result = detect_video(
+        path,
+        registry.get(model_name),
+        get_batcher(model_name),
+        score_threshold,
+        sample_fps,
+        change_threshold,
+        per_frame,
+    )
+    result["model"] = model_name
+    return result
+
+
+def decode_image(data, min_size, max_size):
+    """
+    Decode an image straight to the size the detector resizes it to
+
+    JPEGs are decoded in draft mode, which lets libjpeg scale the image down
+    by 1/2, 1/4 or 1/8 while decoding, so a large photo is never fully
+    decoded. The rest of the way is a regular resize of the small image.
+    Args:
+        data: bytes of the image
+        min_size: target length of the shorter side
+        max_size: limit for the longer side
+    Returns:
+        (PIL Image, (scale_x, scale_y)) where the scales map coordinates of
+        the returned image back to the original one
+    """
+    img = PILImage.open(io.BytesIO(data))
+    width, height = img.size
+    ratio = min(min_size / min(width, height), max_size / max(width, height))
+    if ratio >= 1:
+        return img.convert("RGB"), (1.0, 1.0)
+
+    target = (max(1, round(width * ratio)), max(1, round(height * ratio)))
+    img.draft("RGB", target)
+    img = img.convert("RGB")
+    if img.size != target:
+        img = img.resize(target, PILImage.BILINEAR)
+
+    return img, (width / target[0], height / target[1])
+
+
+def finish_detection(scale, predictions, key, model_name, score_threshold):
+    """
+    Keep the raw boxes of the uploaded image and cache the result
+
+    Boxes are not drawn here; annotated copies are rendered on first fetch
+    by render_annotated_image.
+    Args:
+        scale: (scale_x, scale_y) from the model input to the original image
+        predictions: prediction dict of the detector
+        key: from cache_key
+        model_name: detector that made the predictions
+        score_threshold: minimum score of the kept boxes
+    Returns:
+        dict with detected_as, description, boxes, model_name and inference_ms
+    """
+    keep = predictions["scores"] >= score_threshold
+    categories = registry.get(model_name).categories
+    labels = [categories[i] for i in predictions["labels"][keep]]
+    num_detected = len(labels)
+    boxes = predictions["boxes"][keep] * predictions["boxes"].new_tensor([scale[0], scale[1], scale[0], scale[1]])
+    scores = predictions["scores"][keep].tolist()
+
+    detection = {
         "detected_as": labels,
         "description": f"{num_detected} object(s) detected in the image",
+        "boxes": [
+            {"label": label, "score": round(score, 4), "box": [round(v, 1) for v in box]}
+            for label, score, box in zip(labels, scores, boxes.tolist())
+        ],
+        "model_name": model_name,
+        "inference_ms": round(predictions["inference_ms"], 2),
     }
+    if result_cache is not None:
+        result_cache.set(key, detection)
+
+    return detection
 
-    file_path = store_image_in_database(
-        image=img,
-        img_extension=img_extension,
-        user_id=user_id,
-        detected_as=labels,
-        description=results["description"],
-    )
 
-    return results, file_path
+render_cache = DiskCache(Config.RENDER_CACHE_DIR, Config.RENDER_CACHE_MAX_BYTES)
+inflight_renders = SingleFlight()
 
 
-def store_image_in_database(image, img_extension, detected_as, description, user_id):
+def render_annotated_image(image, color="blue", width=2, font_size=30):
     """
-    Store the image in the database
+    Get the annotated copy of a stored image, rendering it on first fetch
+
+    Renders are kept in an evictable disk cache, in a directory per image
+    so they can be dropped with it, keyed by the rendering options.
     Args:
-        image: PIL Image
-        img_extension: string
-        detected_as: list
-        description: string
+        image: Image db object
+        color: box and label color
+        width: box line width
+        font_size: label font size
+    Returns:
+        path of the rendered file
+    """
+    img_extension = image.url.split(".")[-1]
+    options = hashlib.sha256(f"{color}:{width}:{font_size}".encode()).hexdigest()[:16]
+    name = f"{image.id}/{options}.{img_extension}"
+
+    def render():
+        cached = render_cache.get(name)
+        if cached is not None:
+            return cached
+        with storage.open(image.url) as f:
+            img = PILImage.open(f).convert("RGB")
+        # Labels backfilled from before the detections table have no box
+        boxed = [detection for detection in image.boxes if detection["box"] is not None]
+        draw_boxes(
+            img,
+            [detection["box"] for detection in boxed],
+            [detection["label"] for detection in boxed],
+            color=color,
+            width=width,
+            font_size=font_size,
+        )
+        return render_cache.put(name, img.save)
+
+    return inflight_renders.do(name, render)
+
+
+derivative_cache = DiskCache(Config.DERIVATIVE_CACHE_DIR, Config.DERIVATIVE_CACHE_MAX_BYTES)
+inflight_derivatives = SingleFlight()
+derivative_executor = ThreadPoolExecutor(
+    max_workers=Config.DERIVATIVE_WORKERS, thread_name_prefix="derivatives"
+)
+
+
+def get_derivative(location, size):
+    """
+    Get the WebP copy of a stored image fitting in size x size, creating it
+    on first use
+
+    Derivatives are kept in an evictable disk cache keyed by the content
+    hash of the original, so identical uploads share them.
+    Args:
+        location: storage location of the original image
+        size: one of DERIVATIVE_SIZES
+    Returns:
+        path of the derivative file
+    """
+    digest = storage.digest(location) or hashlib.sha256(location.encode()).hexdigest()
+    name = f"{digest}-{size}.webp"
+
+    def create():
+        cached = derivative_cache.get(name)
+        if cached is not None:
+            return cached
+        with storage.open(location) as f:
+            img = PILImage.open(f)
+            # Let JPEGs decode straight at a fraction of their size
+            img.draft("RGB", (size, size))
+            img = img.convert("RGB")
+        img.thumbnail((size, size))
+        return derivative_cache.put(
+            name,
+            lambda tmp_path: img.save(tmp_path, "WEBP", quality=Config.DERIVATIVE_WEBP_QUALITY),
+        )
+
+    return inflight_derivatives.do(name, create)
+
+
+def schedule_derivatives(location):
+    """
+    Create the derivatives of a newly stored image in the background
+    """
+    for size in Config.DERIVATIVE_SIZES:
+        derivative_executor.submit(get_derivative, location, size)
+
+
+@functools.lru_cache(maxsize=32)
+def load_font(font_size, name="arial"):
+    """
+    Load a TrueType font once per process, falling back to PIL's default font
+    """
+    try:
+        return ImageFont.truetype(name, font_size)
+    except OSError:
+        return ImageFont.load_default()
+
+
+def draw_boxes(img, boxes, labels, color="blue", width=2, font_size=30):
+    """
+    Draw labelled boxes on a PIL image in place
+    Args:
+        img: PIL Image
+        boxes: list of [x1, y1, x2, y2]
+        labels: list of strings
+    """
+    draw = ImageDraw.Draw(img)
+    font = load_font(font_size)
+    margin = width + 1
+    for box, label in zip(boxes, labels):
+        draw.rectangle(box, outline=color, width=width)
+        draw.text((box[0] + margin, box[1] + margin), label, fill=color, font=font)
+
+
+def detect_objects(images, user_id, model_name=None, score_threshold=None, tiled=False):
+    """
+    Detect the objects in many images
+
+    Images are queued on the batcher a window at a time so they share
+    batched forward passes while only one window of decoded images is held
+    in memory. All the Image rows are written in a single transaction.
+    Args:
+        images: list of FileStorage
         user_id: integer
+        model_name: detector from the registry, the default one when None
+        score_threshold: minimum score of the kept boxes, the configured
+            default when None
+        tiled: run each image through run_tiled_detection
     Returns:
-        file_path: string
+        list of per-file result dicts, in the order of the images. Each has
+        the filename and either detected_objs and img_url, or an error
     """
-    base_url = Config.BASE_URL
-    upload_folder = os.path.join(
-        base_url, "blueprints", "object_detection", "static", "images"
+    model_name = model_name or registry.default_name
+    if score_threshold is None:
+        score_threshold = Config.DETECTION_DEFAULT_SCORE_THRESH
+    results = [{"filename": image.filename} for image in images]
+    pending = []
+    for result, image in zip(results, images):
+        img_extension = image.filename.split(".")[-1]
+        if img_extension not in ["jpg", "jpeg", "png"]:
+            result["error"] = "Invalid image format. Provide a .jp(e)g or .png"
+            continue
+        data = image.read()
+        key = cache_key(hashlib.sha256(data).hexdigest(), model_name, score_threshold, tiled)
+        pending.append((result, img_extension, data, key))
+
+    window = Config.DETECTION_BATCH_MAX_SIZE
+    detections = {}
+    errors = {}
+    for start in range(0, len(pending), window):
+        queued = []
+        for result, img_extension, data, key in pending[start:start + window]:
+            if key in detections or key in errors:
+                continue
+            detection = get_cached_detection(key)
+            if detection is not None:
+                detections[key] = detection
+                continue
+            if tiled:
+                # The tiles of each image already fill the batches
+                try:
+                    detections[key] = run_tiled_detection(data, key, model_name, score_threshold)
+                except Exception:
+                    errors[key] = "Could not process the image"
+                continue
+            try:
+                scale, prediction = queue_detection(data, model_name)
+            except Exception:
+                errors[key] = "Could not decode the image"
+                continue
+            queued.append((key, scale, prediction))
+            # Mark it so duplicates later in the window reuse this inference
+            detections[key] = None
+        for key, scale, prediction in queued:
+            try:
+                detections[key] = finish_detection(
+                    scale, prediction.result(), key, model_name, score_threshold
+                )
+            except Exception:
+                del detections[key]
+                errors[key] = "Could not process the image"
+
+    stored = []
+    inferred = set()
+    for result, img_extension, data, key in pending:
+        if key in errors:
+            result["error"] = errors[key]
+            continue
+        detection = detections[key]
+        if key in inferred:
+            # A duplicate upload reuses the first one's inference
+            detection = {**detection, "inference_ms": None}
+        inferred.add(key)
+        result["detected_objs"] = {
+            "detected_as": detection["detected_as"],
+            "description": detection["description"],
+        }
+        result["img_url"] = storage.put(data, img_extension, "images")
+        result["image"] = store_image_in_database(
+            file_path=result["img_url"],
+            user_id=user_id,
+            description=detection["description"],
+            boxes=detection["boxes"],
+            model_name=detection["model_name"],
+            inference_ms=detection["inference_ms"],
+            commit=False,
+        )
+        stored.append((result["image"], detection["boxes"]))
+    store_detections(stored)
+    for result in results:
+        if "image" in result:
+            result["image_id"] = result.pop("image").id
+    locations = {image.url for image, _ in stored}
+    db.session.commit()
+    if stored:
+        bump_version("images", user_id)
+    for location in locations:
+        schedule_derivatives(location)
+
+    return results
+
+
+def find_images(user_id, labels=None, min_score=None, max_score=None, since=None, until=None):
+    """
+    Find the images of a user by the objects detected in them
+
+    Each label filter is a subquery over the (user_id, label, score,
+    image_id) index that groups the matching detections by image, so a
+    selective label never scans the user's other detections. The images
+    are then read by primary key, paginated by list_response like the other
+    list endpoints.
+    Args:
+        user_id: integer
+        labels: list of (label, minimum count); an image must match all of them
+        min_score, max_score: score range of the counted detections. Without
+            labels, an image matches when any of its detections is in range
+        since, until: datetime range of detected_on
+    Returns:
+        query of the matching images
+    """
+
+    def in_score_range(query):
+        if min_score is not None:
+            query = query.filter(Detection.score >= min_score)
+        if max_score is not None:
+            query = query.filter(Detection.score <= max_score)
+        return query
+
+    query = DBModelImage.query.filter(DBModelImage.user_id == user_id)
+    for label, count in labels or []:
+        matching = (
+            in_score_range(
+                db.session.query(Detection.image_id).filter(
+                    Detection.user_id == user_id, Detection.label == label
+                )
+            )
+            .group_by(Detection.image_id)
+            .having(func.count() >= count)
+        )
+        query = query.filter(DBModelImage.id.in_(matching))
+    if not labels and (min_score is not None or max_score is not None):
+        matching = in_score_range(
+            db.session.query(Detection.image_id).filter(Detection.user_id == user_id)
+        )
+        query = query.filter(DBModelImage.id.in_(matching))
+    if since is not None:
+        query = query.filter(DBModelImage.detected_on >= since)
+    if until is not None:
+        query = query.filter(DBModelImage.detected_on < until)
+    return query
+
+
+def boxes_by_image(image_ids):
+    """
+    Detections of each image as {label, score, box} dicts, read in one query
+    on the image_id index
+    Returns:
+        dict of image id to list of detections
+    """
+    boxes = {image_id: [] for image_id in image_ids}
+    rows = Detection.query.filter(Detection.image_id.in_(image_ids)).order_by(Detection.id)
+    for detection in rows:
+        boxes[detection.image_id].append(detection.to_dict())
+    return boxes
+
+
+def labels_by_image(image_ids):
+    """
+    Detected labels of each image, read in one query on the image_id index
+    Returns:
+        dict of image id to list of labels
+    """
+    labels = {image_id: [] for image_id in image_ids}
+    rows = (
+        db.session.query(Detection.image_id, Detection.label)
+        .filter(Detection.image_id.in_(image_ids))
+        .order_by(Detection.id)
     )
-    if not os.path.exists(upload_folder):
-        os.makedirs(upload_folder)
+    for image_id, label in rows:
+        labels[image_id].append(label)
+
+    # Images stored before the detections table, not backfilled yet
+    unlabelled = [image_id for image_id, image_labels in labels.items() if not image_labels]
+    if unlabelled:
+        legacy = db.session.query(DBModelImage.id, DBModelImage.detected_as).filter(
+            DBModelImage.id.in_(unlabelled), DBModelImage.detected_as.isnot(None)
+        )
+        for image_id, detected_as in legacy:
+            labels[image_id] = parse_legacy_labels(detected_as)
+    return labels
 
-    file_path = os.path.join(
-        upload_folder, str(uuid4()) + "." + img_extension
+
+def backfill_legacy_detections(batch_size=500):
+    """
+    Turn the labels of images stored before the detections table into
+    detection rows, so that they are found by the search
+
+    The boxes and scores of the former boxes JSON column are used when the
+    images table still has it; older images only had their labels, which
+    become rows without score or box. detected_as is cleared once converted,
+    so the backfill can be stopped and run again.
+    Args:
+        batch_size: images converted per transaction
+    Returns:
+        number of images converted
+    """
+    inspector = inspect(db.engine)
+    has_boxes = "boxes" in {column["name"] for column in inspector.get_columns("images")}
+    if db.engine.dialect.name == "postgresql":
+        # Tables created while the score and box were required
+        for column in inspector.get_columns("detections"):
+            if column["name"] in ("score", "x1", "y1", "x2", "y2") and not column["nullable"]:
+                db.session.execute(text(f"ALTER TABLE detections ALTER COLUMN {column['name']} DROP NOT NULL"))
+        db.session.commit()
+    boxes_query = text("SELECT id, boxes FROM images WHERE id IN :ids").bindparams(
+        bindparam("ids", expanding=True)
     )
-    image.save(file_path)
+    converted = 0
+    while True:
+        images = (
+            DBModelImage.query.filter(DBModelImage.detected_as.isnot(None))
+            .options(selectinload(DBModelImage.detections))
+            .order_by(DBModelImage.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not images:
+            return converted
+
+        legacy_boxes = {}
+        if has_boxes:
+            for image_id, boxes in db.session.execute(boxes_query, {"ids": [image.id for image in images]}):
+                legacy_boxes[image_id] = json.loads(boxes) if isinstance(boxes, str) else boxes
+
+        rows = []
+        for image in images:
+            if not image.detections:
+                boxes = legacy_boxes.get(image.id) or [
+                    {"label": label, "score": None, "box": [None] * 4}
+                    for label in parse_legacy_labels(image.detected_as)
+                ]
+                rows.extend(
+                    {
+                        "image_id": image.id,
+                        "user_id": image.user_id,
+                        "label": box["label"],
+                        "score": box["score"],
+                        "x1": box["box"][0],
+                        "y1": box["box"][1],
+                        "x2": box["box"][2],
+                        "y2": box["box"][3],
+                    }
+                    for box in boxes
+                )
+            image.detected_as = None
+        if rows:
+            db.session.execute(insert(Detection), rows)
+        db.session.commit()
+        for user_id in {image.user_id for image in images}:
+            bump_version("images", user_id)
+        converted += len(images)
+
+
+def store_image_in_database(
+    file_path, description, user_id, boxes=None, model_name=None, inference_ms=None, commit=True
+):
+    """
+    Store the image and its detections in the database
+    Args:
+        file_path: storage location of the image, from the storage.put
+            that took the row's reference
+        description: string
+        user_id: integer
+        boxes: list of {label, score, box} dicts
+        model_name: detector that made the detection
+        inference_ms: the image's share of the detector's batch time, None
+            when the detection came from the cache
+        commit: store the detections and commit the session. Pass False to
+            batch several images in one transaction, then call
+            store_detections with every image and its boxes
+    Returns:
+        image_db_obj: Image
+    """
     image_db_obj = DBModelImage(
         user_id=user_id,
-        detected_as=detected_as,
         description=description,
+        model_name=model_name,
+        inference_ms=inference_ms,
         url=file_path,
         detected_on=db.func.current_timestamp(),
     )
     db.session.add(image_db_obj)
-    db.session.commit()
+    if commit:
+        store_detections([(image_db_obj, boxes)])
+        db.session.commit()
+        bump_version("images", user_id)
+        schedule_derivatives(file_path)
 
-    return file_path
+    return image_db_obj
+
+
+def store_detections(images):
+    """
+    Bulk insert the detections of freshly added images in a single statement
+    Args:
+        images: list of (Image db object, list of {label, score, box} dicts)
+    """
+    db.session.flush()
+    rows = [
+        {
+            "image_id": image.id,
+            "user_id": image.user_id,
+            "label": detection["label"],
+            "score": detection["score"],
+            "x1": detection["box"][0],
+            "y1": detection["box"][1],
+            "x2": detection["box"][2],
+            "y2": detection["box"][3],
+        }
+        for image, boxes in images
+        for detection in boxes or []
+    ]
+    if rows:
+        db.session.execute(insert(Detection), rows)
+    for image, _ in images:
+        db.session.expire(image, ["detections"])
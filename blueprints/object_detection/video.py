@@ -0,0 +1,237 @@
+from collections import deque
+
+import torch
+import torch.nn.functional as F
+from torchvision.io import VideoReader
+from torchvision.ops import box_iou
+from torchvision.transforms import functional as TF
+
+# What VideoReader raises on a corrupt or truncated file: torchvision's own
+# RuntimeError, and PyAV's errors, which subclass ValueError or OSError
+DECODER_ERRORS = (RuntimeError, ValueError, OSError)
+
+
+class VideoDecodeError(RuntimeError):
+    """
+    The video file could not be decoded
+    """
+
+
+def iter_sampled_frames(path, sample_fps):
+    """
+    Decode a video one frame at a time, yielding about sample_fps frames per second
+    Args:
+        path: path of the video file
+        sample_fps: frames per second to keep, 0 keeps every frame
+    Yields:
+        (timestamp in seconds, uint8 CHW frame tensor)
+    Raises:
+        VideoDecodeError: the file is not a video or is cut short
+    """
+    try:
+        frames = iter(VideoReader(path, "video"))
+    except DECODER_ERRORS as e:
+        raise VideoDecodeError(str(e)) from e
+    next_time = 0.0
+    while True:
+        try:
+            frame = next(frames)
+        except StopIteration:
+            break
+        except DECODER_ERRORS as e:
+            raise VideoDecodeError(str(e)) from e
+        if frame["pts"] + 1e-6 < next_time:
+            continue
+        if sample_fps:
+            next_time = frame["pts"] + 1 / sample_fps
+        yield frame["pts"], frame["data"]
+
+
+def frame_signature(frame, size=32):
+    """
+    Tiny grayscale thumbnail used to tell whether a frame changed
+    """
+    gray = frame.float().mean(0, keepdim=True)[None]
+    return F.interpolate(gray, size=(size, size), mode="area")[0, 0] / 255
+
+
+def resize_frame(frame, min_size, max_size):
+    """
+    Resize a frame to the detector's working size
+    Returns:
+        (resized frame, (scale_x, scale_y)) mapping the resized frame back
+        to the original one
+    """
+    height, width = frame.shape[-2:]
+    ratio = min(min_size / min(width, height), max_size / max(width, height))
+    if ratio >= 1:
+        return frame, (1.0, 1.0)
+    target = (max(1, round(height * ratio)), max(1, round(width * ratio)))
+    return TF.resize(frame, list(target), antialias=True), (width / target[1], height / target[0])
+
+
+class IoUTracker:
+    """
+    Greedy IoU tracker carrying boxes from frame to frame.
+
+    A detection joins the live track of the same label it overlaps most
+    (IoU >= iou_threshold), otherwise it starts a new track. Tracks unseen
+    for max_age seconds are closed, so memory depends on the number of
+    objects on screen, not on the length of the clip.
+    """
+
+    def __init__(self, iou_threshold=0.3, max_age=2.0):
+        self.iou_threshold = iou_threshold
+        self.max_age = max_age
+        self.live = []
+        self.closed = []
+        self._next_id = 1
+        self._last_inferred = None
+
+    def update(self, timestamp, labels, scores, boxes):
+        """
+        Match the detections of one frame to the live tracks
+        Returns:
+            list of (track, score, box) for the frame's detections
+        """
+        matched = []
+        used = set()
+        candidates = list(self.live)
+        if candidates and len(boxes):
+            ious = box_iou(boxes, torch.tensor([track["box"] for track in candidates])).tolist()
+        for i, (label, score, box) in enumerate(zip(labels, scores.tolist(), boxes.tolist())):
+            best, best_j = self.iou_threshold, None
+            for j, track in enumerate(candidates):
+                if j not in used and track["label"] == label and ious[i][j] >= best:
+                    best, best_j = ious[i][j], j
+            if best_j is None:
+                track = {
+                    "id": self._next_id,
+                    "label": label,
+                    "first_seen": timestamp,
+                    "frames": 0,
+                    "max_score": 0.0,
+                }
+                self._next_id += 1
+                self.live.append(track)
+            else:
+                track = candidates[best_j]
+                used.add(best_j)
+            track["box"] = [round(v, 1) for v in box]
+            track["last_seen"] = timestamp
+            track["frames"] += 1
+            track["max_score"] = round(max(track["max_score"], score), 4)
+            matched.append((track, score, track["box"]))
+
+        still_live = []
+        for track in self.live:
+            if timestamp - track["last_seen"] > self.max_age:
+                self.closed.append(track)
+            else:
+                still_live.append(track)
+        self.live = still_live
+        return matched
+
+    def carry(self, timestamp):
+        """
+        Extend the tracks seen on the last inferred frame to an unchanged frame
+        Returns:
+            list of (track, score, box)
+        """
+        carried = []
+        for track in self.live:
+            if track["last_seen"] == self._last_inferred:
+                track["frames"] += 1
+                carried.append((track, None, track["box"]))
+        return carried
+
+    def mark_inferred(self, timestamp):
+        self._last_inferred = timestamp
+
+    def tracks(self):
+        return sorted(self.closed + self.live, key=lambda track: track["id"])
+
+
+def detect_video(path, detector, batcher, score_threshold, sample_fps, change_threshold, per_frame):
+    """
+    Detect and track objects through a video
+
+    Frames are decoded as a stream and sampled at sample_fps. A sampled
+    frame whose content barely changed since the last inferred frame is not
+    run through the detector; the tracker carries the previous boxes to it.
+    Inferred frames go through the batcher a window at a time so they share
+    batched forward passes.
+    Args:
+        path: path of the video file
+        detector: Detector from the registry
+        batcher: the detector's InferenceBatcher
+        score_threshold: minimum score of the kept boxes
+        sample_fps: frames per second to look at, 0 for every frame
+        change_threshold: mean absolute pixel difference (0-1) below which a
+            frame counts as unchanged
+        per_frame: also return the objects of every sampled frame
+    Returns:
+        dict with the tracks, frame counters and, when per_frame is set, the
+        per-frame objects
+    """
+    tracker = IoUTracker()
+    min_size, max_size = detector.input_size
+    categories = detector.categories
+    frames = []
+    stats = {"frames_sampled": 0, "frames_inferred": 0, "duration": 0.0}
+    pending = deque()
+    last_signature = None
+
+    def resolve(entry):
+        timestamp, scale, future = entry
+        if future is None:
+            objects = tracker.carry(timestamp)
+        else:
+            predictions = future.result()
+            keep = predictions["scores"] >= score_threshold
+            labels = [categories[i] for i in predictions["labels"][keep].tolist()]
+            boxes = predictions["boxes"][keep] * torch.tensor([scale[0], scale[1], scale[0], scale[1]])
+            tracker.mark_inferred(timestamp)
+            objects = tracker.update(timestamp, labels, predictions["scores"][keep], boxes)
+        if per_frame:
+            frames.append(
+                {
+                    "time": round(timestamp, 3),
+                    "inferred": future is not None,
+                    "objects": [
+                        {
+                            "track_id": track["id"],
+                            "label": track["label"],
+                            "score": round(score, 4) if score is not None else None,
+                            "box": box,
+                        }
+                        for track, score, box in objects
+                    ],
+                }
+            )
+
+    for timestamp, frame in iter_sampled_frames(path, sample_fps):
+        stats["frames_sampled"] += 1
+        stats["duration"] = round(timestamp, 3)
+        signature = frame_signature(frame)
+        changed = (
+            last_signature is None
+            or (signature - last_signature).abs().mean().item() >= change_threshold
+        )
+        if changed:
+            last_signature = signature
+            stats["frames_inferred"] += 1
+            resized, scale = resize_frame(frame, min_size, max_size)
+            pending.append((timestamp, scale, batcher.submit(detector.preprocess(resized))))
+        else:
+            pending.append((timestamp, None, None))
+        while len(pending) > batcher.max_batch_size:
+            resolve(pending.popleft())
+
+    while pending:
+        resolve(pending.popleft())
+
+    result = dict(stats, tracks=tracker.tracks())
+    if per_frame:
+        result["frames"] = frames
+    return result
@@ -0,0 +1,124 @@
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from .detector import detector as default_detector
+
+# Detector warmed up by the worker, set when it is forked
+_worker_detector = None
+
+
+def _init_worker(num_threads, detector):
+    """
+    Configure torch threading in a freshly forked worker
+    """
+    import torch
+
+    global _worker_detector
+    _worker_detector = detector
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Already fixed for this process
+        pass
+
+
+def _warmup_worker():
+    import torch
+
+    dummy = torch.zeros(3, 320, 320)
+    _worker_detector.infer([_worker_detector.preprocess(dummy)])
+    return os.getpid()
+
+
+class DetectorWorkerPool:
+    """
+    Pool of forked processes running detector inference.
+
+    The parent builds the default model once and moves its weights to
+    shared memory before forking, so every worker maps the same weights
+    instead of loading its own copy. Other registry models are only built
+    in the workers, each loading its own copy on first use; the parent
+    reads their input size and preprocessing from the DETECTORS table.
+    The parent never runs a forward pass itself: torch disables intra-op
+    parallelism in children forked after parallel work has started.
+
+    The pool is started on the first ``submit`` (or an explicit ``start``) and
+    can be used anywhere a concurrent.futures executor is expected. A worker
+    that dies, for example killed when out of memory, fails the batches in
+    flight and breaks the executor; the next ``submit`` forks a new one, like
+    TTSWorkerPool replaces its dead workers.
+
+    Args:
+        num_workers: number of worker processes
+        threads_per_worker: torch intra-op threads in each worker, 0 for
+            an even split of the machine's cores
+        detector: detector warmed up in the workers, the default one when None
+    """
+
+    def __init__(self, num_workers, threads_per_worker=0, detector=None):
+        self.num_workers = num_workers
+        self.threads_per_worker = threads_per_worker or max(
+            1, (os.cpu_count() or 1) // num_workers
+        )
+        self.detector = detector or default_detector
+        self._executor = None
+        self._lock = threading.Lock()
+        self.restarts = 0
+
+    def start(self):
+        """
+        Load the model, fork the workers and warm each of them up
+        """
+        if self._executor is not None:
+            return
+        with self._lock:
+            if self._executor is not None:
+                return
+            self.detector.backend.share_memory()
+            self._executor = self._fork()
+        self.detector.mark_ready()
+
+    def submit(self, fn, *args, **kwargs):
+        self.start()
+        executor = self._executor
+        try:
+            return executor.submit(fn, *args, **kwargs)
+        except BrokenProcessPool:
+            self._replace(executor)
+            return self._executor.submit(fn, *args, **kwargs)
+
+    def stats(self):
+        return {
+            "workers": self.num_workers,
+            "threads_per_worker": self.threads_per_worker,
+            "restarts": self.restarts,
+        }
+
+    def _fork(self):
+        import torch.multiprocessing as mp
+
+        executor = ProcessPoolExecutor(
+            max_workers=self.num_workers,
+            mp_context=mp.get_context("fork"),
+            initializer=_init_worker,
+            initargs=(self.threads_per_worker, self.detector),
+        )
+        wait([executor.submit(_warmup_worker) for _ in range(self.num_workers)])
+        return executor
+
+    def _replace(self, broken):
+        with self._lock:
+            if self._executor is not broken:
+                # Another caller already replaced it
+                return
+            broken.shutdown(wait=False)
+            self._executor = self._fork()
+            self.restarts += 1
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
@@ -1,6 +1,14 @@
 from flask import Blueprint
 
-from .routes import process_audio, process_text, get_audio_text, get_all_audio_texts, delete_audio_text
+from .routes import (
+    process_audio,
+    process_text,
+    get_audio_text,
+    get_audio_file,
+    get_all_audio_texts,
+    delete_audio_text,
+    get_tap_stats,
+)
 
 
 text_audio_processing = Blueprint("text_audio_processing", __name__, static_folder="static")
@@ -9,5 +17,7 @@ text_audio_processing = Blueprint("text_audio_processing", __name__, static_fold
 text_audio_processing.post("/process-text")(process_text)
 text_audio_processing.post("/process-audio")(process_audio)
 text_audio_processing.get("/audio-text")(get_audio_text)
+text_audio_processing.get("/audio-text/file")(get_audio_file)
 text_audio_processing.get("/audios-texts")(get_all_audio_texts)
 text_audio_processing.delete("/audio-text")(delete_audio_text)
+text_audio_processing.get("/stats")(get_tap_stats)
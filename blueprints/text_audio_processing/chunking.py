@@ -0,0 +1,171 @@
+import shutil
+import tempfile
+import threading
+import subprocess
+from collections import deque
+
+import numpy as np
+import speech_recognition as sr
+from pydub import AudioSegment
+
+
+# Formats ffmpeg can decode from a pipe; others, such as m4a, need to seek
+STREAMABLE_FORMATS = ("wav", "aiff", "flac", "mp3")
+FRAME_SECONDS = 0.03
+
+
+def decode_pcm(data, audio_format, sample_rate, spool_max_bytes):
+    """
+    Decode audio bytes with ffmpeg to 16 bit mono PCM
+
+    The PCM is written to a spooled file that stays in memory for short
+    clips and moves to disk past spool_max_bytes, so an hour long recording
+    is never held in memory once decoded.
+    Args:
+        data: bytes of the audio file
+        audio_format: file extension of the audio
+        sample_rate: sample rate of the PCM
+        spool_max_bytes: PCM size above which it is spooled to disk
+    Returns:
+        file object positioned at the start of the PCM
+    Raises:
+        RuntimeError: ffmpeg could not decode the audio
+    """
+    pcm = tempfile.SpooledTemporaryFile(max_size=spool_max_bytes)
+    output = ["-f", "s16le", "-acodec", "pcm_s16le", "-ac", "1", "-ar", str(sample_rate), "pipe:1"]
+
+    if audio_format in STREAMABLE_FORMATS:
+        _run_ffmpeg(["-i", "pipe:0", *output], data, pcm)
+    else:
+        with tempfile.NamedTemporaryFile(suffix=f".{audio_format}") as source:
+            source.write(data)
+            source.flush()
+            _run_ffmpeg(["-i", source.name, *output], None, pcm)
+    pcm.seek(0)
+    return pcm
+
+
+def _run_ffmpeg(args, stdin_data, output):
+    process = subprocess.Popen(
+        [AudioSegment.converter, "-v", "error", *args],
+        stdin=subprocess.PIPE if stdin_data is not None else subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+
+    def feed():
+        try:
+            process.stdin.write(stdin_data)
+        except BrokenPipeError:
+            # ffmpeg gave up on the input, its exit status tells why
+            pass
+        finally:
+            process.stdin.close()
+
+    if stdin_data is not None:
+        threading.Thread(target=feed, daemon=True).start()
+    shutil.copyfileobj(process.stdout, output, 64 * 1024)
+    error = process.stderr.read()
+    if process.wait() != 0:
+        raise RuntimeError(f"Could not decode the audio: {error.decode(errors='replace').strip()}")
+
+
+def split_on_silence(pcm, sample_rate, max_seconds, min_seconds, min_silence_seconds, silence_thresh_db):
+    """
+    Split 16 bit mono PCM into chunks at pauses in the speech, reading it
+    sequentially
+
+    A chunk ends in the middle of the first pause of at least
+    min_silence_seconds once it is min_seconds long, or at the last pause
+    seen when it reaches max_seconds (mid-speech if there was none). Chunks
+    with no frame louder than the threshold are dropped. At most one chunk
+    is held in memory.
+    Args:
+        pcm: file object of the PCM
+        sample_rate: sample rate of the PCM
+        max_seconds, min_seconds: bounds of the chunk durations
+        min_silence_seconds: shortest pause a chunk may end on
+        silence_thresh_db: frames quieter than this, in dBFS, are silent
+    Yields:
+        (start sample, PCM bytes) of each chunk with sound
+    """
+    frame = max(1, int(sample_rate * FRAME_SECONDS))
+    max_length = int(max_seconds * sample_rate)
+    min_length = int(min_seconds * sample_rate)
+    min_silence = int(min_silence_seconds * sample_rate)
+    threshold = 32768 * 10 ** (silence_thresh_db / 20)
+
+    buffer = bytearray()
+    start = 0
+    silence = 0
+    cut = None
+    voiced = False
+    while True:
+        block = pcm.read(frame * 2 * 100)
+        if not block:
+            break
+        samples = np.frombuffer(block, dtype=np.int16, count=len(block) // 2)
+        for offset in range(0, len(samples), frame):
+            piece = samples[offset : offset + frame]
+            buffer += piece.tobytes()
+            if np.sqrt(np.mean(piece.astype(np.float32) ** 2)) < threshold:
+                silence += len(piece)
+            else:
+                silence = 0
+                voiced = True
+
+            length = len(buffer) // 2
+            if silence >= min_silence:
+                cut = length - silence // 2
+            if (silence >= min_silence and length >= min_length) or length >= max_length:
+                at = cut if cut is not None else min(length, max_length)
+                if voiced:
+                    yield start, bytes(buffer[: 2 * at])
+                del buffer[: 2 * at]
+                start += at
+                silence = min(silence, len(buffer) // 2)
+                voiced = len(buffer) // 2 > silence
+                cut = None
+    if buffer and voiced:
+        yield start, bytes(buffer)
+
+
+def transcribe_chunks(chunks, sample_rate, recognize, executor, max_inflight):
+    """
+    Recognize chunks of PCM in parallel and put their transcripts in order
+    Args:
+        chunks: iterable of (start sample, PCM bytes), see split_on_silence
+        sample_rate: sample rate of the PCM
+        recognize: callable taking an sr.AudioData and returning its text
+        executor: concurrent.futures executor running recognize
+        max_inflight: chunks read ahead of the oldest unfinished one,
+            bounding the PCM held in memory
+    Returns:
+        list of {start, end, text} segments, times in seconds. Chunks where
+        no speech was recognized are left out
+    """
+    segments = []
+    inflight = deque()
+
+    def collect(start, length, future):
+        try:
+            text = future.result()
+        except sr.UnknownValueError:
+            text = ""
+        if text:
+            segments.append(
+                {
+                    "start": round(start / sample_rate, 2),
+                    "end": round((start + length) / sample_rate, 2),
+                    "text": text,
+                }
+            )
+
+    for start, data in chunks:
+        audio_data = sr.AudioData(data, sample_rate, 2)
+        inflight.append((start, len(data) // 2, executor.submit(recognize, audio_data)))
+        while len(inflight) >= max_inflight:
+            collect(*inflight.popleft())
+    while inflight:
+        collect(*inflight.popleft())
+    return segments
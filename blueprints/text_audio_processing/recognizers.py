@@ -0,0 +1,140 @@
+import os
+import json
+import threading
+
+import speech_recognition as sr
+
+
+class GoogleRecognizer:
+    """
+    Sends the audio to the Google Web Speech API
+    """
+
+    name = "google"
+
+    def __init__(self, model=None, language="en-US"):
+        self.language = language
+
+    def __call__(self, audio_data):
+        return sr.Recognizer().recognize_google(audio_data, language=self.language)
+
+
+class LocalRecognizer:
+    """
+    Base of the offline engines.
+
+    The acoustic model is loaded on first use and kept for the life of the
+    process, so its load time is paid once per worker instead of per request.
+    Job workers are threads (see utils/jobs.py) and share the process's copy.
+    A process forked after the load, such as a server worker forked from the
+    parent that loaded it, loads its own copy rather than sharing native
+    state across the fork.
+    """
+
+    def __init__(self, model, language="en-US"):
+        self.model_path = model
+        self.language = language
+        self._model = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def model(self):
+        if self._model is None or self._pid != os.getpid():
+            with self._lock:
+                if self._model is None or self._pid != os.getpid():
+                    self._model = self.load()
+                    self._pid = os.getpid()
+        return self._model
+
+    def load(self):
+        raise NotImplementedError
+
+
+class VoskRecognizer(LocalRecognizer):
+    """
+    Recognizes with a Vosk (Kaldi) model, STT_MODEL being the model folder.
+    The model is shared by concurrent requests, each of which gets its own
+    lightweight recognizer
+    """
+
+    name = "vosk"
+    sample_rate = 16000
+
+    def load(self):
+        import vosk
+
+        return vosk.Model(self.model_path) if self.model_path else vosk.Model(lang=self.language.lower())
+
+    def __call__(self, audio_data):
+        import vosk
+
+        recognizer = vosk.KaldiRecognizer(self.model, self.sample_rate)
+        recognizer.AcceptWaveform(audio_data.get_raw_data(convert_rate=self.sample_rate, convert_width=2))
+        return json.loads(recognizer.FinalResult())["text"]
+
+
+class WhisperRecognizer(LocalRecognizer):
+    """
+    Recognizes with an openai-whisper model, STT_MODEL being its name (e.g.
+    "base.en") or checkpoint path. The model is not safe to run from several
+    threads, so requests of a process take turns
+    """
+
+    name = "whisper"
+    sample_rate = 16000
+
+    def __init__(self, model, language="en-US"):
+        super().__init__(model or "base", language)
+        self._infer_lock = threading.Lock()
+
+    def load(self):
+        import whisper
+
+        return whisper.load_model(self.model_path, device="cpu")
+
+    def __call__(self, audio_data):
+        import numpy as np
+
+        raw = audio_data.get_raw_data(convert_rate=self.sample_rate, convert_width=2)
+        samples = np.frombuffer(raw, dtype=np.int16).astype(np.float32) / 32768.0
+        model = self.model
+        with self._infer_lock:
+            result = model.transcribe(samples, language=self.language.split("-")[0], fp16=False)
+        return result["text"].strip()
+
+
+class StubRecognizer:
+    """
+    Recognizes nothing and needs no model or network: the transcript gives
+    the number of samples of the audio. For tests and offline development
+    """
+
+    name = "stub"
+
+    def __init__(self, model=None, language="en-US"):
+        pass
+
+    def __call__(self, audio_data):
+        return f"{len(audio_data.frame_data) // audio_data.sample_width} samples"
+
+
+RECOGNIZERS = {
+    recognizer.name: recognizer
+    for recognizer in (GoogleRecognizer, VoskRecognizer, WhisperRecognizer, StubRecognizer)
+}
+
+
+def build_recognizer(name, model=None, language="en-US"):
+    """
+    Create the speech recognition backend called name
+    Args:
+        name: one of RECOGNIZERS
+        model: model folder, name or path of the local engines
+        language: language of the speech, e.g. "en-US"
+    Returns:
+        callable taking an sr.AudioData and returning its text
+    """
+    if name not in RECOGNIZERS:
+        raise ValueError(f"Unknown speech recognition backend {name!r}, choose from {sorted(RECOGNIZERS)}")
+    return RECOGNIZERS[name](model, language)
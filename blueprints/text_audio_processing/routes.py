@@ -1,8 +1,16 @@
-from flask import request, jsonify, make_response
+import io
+
+from flask import request, jsonify, make_response, url_for
 from flask_jwt_extended import jwt_required, current_user
+from werkzeug.datastructures import FileStorage
 
 from utils import db
-from .utils import audio_processer, text_processer
+from utils.jobs import wants_async, submit_job
+from utils.pagination import list_response
+from utils.conditional import conditional, request_value, bump_version
+from utils.storage import storage, send_media
+from blueprints.auth.routes import admin_required
+from .utils import audio_processer, text_processer, tts_pool, tts_cache, inflight_speech
 from .models import AudioText
 
 
@@ -12,9 +20,15 @@ def process_text():
     Process the text and produce its audio equivalent
     """
     text = request.json.get("text")
-    audio_url, text_value = text_processer(text, current_user.id)
 
-    return jsonify(text=text_value, audio_url=audio_url), 200
+    if wants_async():
+        return submit_job("process-text", process_text_payload, text, current_user.id)
+
+    try:
+        payload = process_text_payload(text, current_user.id)
+    except TimeoutError:
+        return jsonify(msg="Text to speech is busy, try again later"), 503
+    return jsonify(payload), 200
 
 
 @jwt_required()
@@ -28,17 +42,41 @@ def process_audio():
     if audio_format not in ["wav", "aiff", "flac", "mp3", "m4a"]:
         return jsonify(error="Unsupported audio format"), 400
 
-    text_value, audio_url = audio_processer(audio, current_user.id)
+    if wants_async():
+        # The upload stream is closed once the request ends, keep the bytes
+        audio = FileStorage(io.BytesIO(audio.read()), filename=audio.filename)
+        return submit_job("process-audio", process_audio_payload, audio, current_user.id)
+
+    try:
+        payload = process_audio_payload(audio, current_user.id)
+    except RuntimeError:
+        return jsonify(error="Could not decode the audio"), 400
+    return jsonify(payload), 200
 
-    return jsonify(text=text_value, audio_url=audio_url), 200
+
+def process_text_payload(text, user_id):
+    """
+    Synthesize the text and build the process-text response payload
+    """
+    audio_url, text_value = text_processer(text, user_id)
+    return {"text": text_value, "audio_url": audio_url}
+
+
+def process_audio_payload(audio, user_id):
+    """
+    Transcribe the audio and build the process-audio response payload
+    """
+    text_value, audio_url, segments = audio_processer(audio, user_id)
+    return {"text": text_value, "audio_url": audio_url, "segments": segments}
 
 
 @jwt_required()
+@conditional("audio_texts", params=("audio_text_id",))
 def get_audio_text():
     """
     Get the text and audio details from the database
     """
-    audio_text_id = request.json.get("audio_text_id")
+    audio_text_id = request_value("audio_text_id")
     audio_text = (
         db.session.query(AudioText)
         .filter_by(id=audio_text_id, user_id=current_user.id)
@@ -52,6 +90,11 @@ def get_audio_text():
             "id": audio_text.id,
             "text": audio_text.text_value,
             "audio_url": audio_text.audio_url,
+            "file_url": url_for(
+                "text_audio_processing.get_audio_file",
+                audio_text_id=audio_text.id,
+                v=storage.digest(audio_text.audio_url),
+            ),
             "processed_on": audio_text.processed_on,
         }
     )
@@ -60,21 +103,39 @@ def get_audio_text():
 
 
 @jwt_required()
+def get_audio_file():
+    """
+    Download the audio file of an audio text of this user
+    """
+    audio_text = (
+        db.session.query(AudioText)
+        .filter_by(id=request.args.get("audio_text_id"), user_id=current_user.id)
+        .first()
+    )
+    if not audio_text:
+        return jsonify(msg="Audio text not found"), 404
+    if not storage.exists(audio_text.audio_url):
+        return jsonify(msg="Audio file not found"), 404
+
+    return send_media(audio_text.audio_url, version=request.args.get("v"))
+
+
+@jwt_required()
+@conditional("audio_texts")
 def get_all_audio_texts():
     """
-    Get all the text and audio details from the database
+    Get the text and audio details of this user from the database, a page at a time
     """
-    all_audio_texts = AudioText.query.filter_by(user_id=current_user.id).all()
-    audio_text_list = [
+    return list_response(
+        AudioText.query.filter_by(user_id=current_user.id),
+        AudioText.id,
         {
-            "id": audio_text.id,
-            "text": audio_text.text_value,
-            "audio_url": audio_text.audio_url,
-            "processed_on": audio_text.processed_on,
-        }
-        for audio_text in all_audio_texts
-    ]
-    return jsonify(audio_text_list), 200
+            "id": AudioText.id,
+            "text": AudioText.text_value,
+            "audio_url": AudioText.audio_url,
+            "processed_on": AudioText.processed_on,
+        },
+    )
 
 
 @jwt_required()
@@ -88,6 +149,19 @@ def delete_audio_text():
     ).first()
     if not audio_text:
         return jsonify(msg="Audio Text not found"), 404
+    storage.release(audio_text.audio_url)
     db.session.delete(audio_text)
     db.session.commit()
+    bump_version("audio_texts", current_user.id)
     return make_response("", 204)
+
+
+@jwt_required()
+@admin_required
+def get_tap_stats():
+    """
+    Get the text to speech worker and cache statistics
+    """
+    cache = tts_cache.stats()
+    cache["coalesced"] = inflight_speech.coalesced
+    return jsonify(tts_workers=tts_pool.stats(), tts_cache=cache), 200
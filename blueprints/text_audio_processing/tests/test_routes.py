@@ -3,6 +3,7 @@ import unittest
 
 from app import app
 from utils import db
+from blueprints.auth.models import User
 from blueprints.text_audio_processing.models import AudioText
 
 
@@ -74,6 +75,36 @@ class TextAudioBlueprintRoutesTestCase(unittest.TestCase):
         # Clear test audio from static folder
         os.remove(response.json.get("audio_url"))
 
+    def test_process_text_cache(self):
+        headers = {"Authorization": f"Bearer {self.access_token}"}
+        first = self.client.post("/tap/process-text", json={"text": "Your order is ready"}, headers=headers)
+        second = self.client.post("/tap/process-text", json={"text": "  Your order   is ready "}, headers=headers)
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.status_code, 200)
+        # The repeated prompt reuses the audio, each request still gets its row
+        self.assertEqual(first.json["audio_url"], second.json["audio_url"])
+        self.assertEqual(AudioText.query.filter_by(audio_url=first.json["audio_url"]).count(), 2)
+
+        user = User.query.filter_by(username="testuser").first()
+        user.is_admin = True
+        db.session.commit()
+        response = self.client.get("/tap/stats", headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertGreaterEqual(response.json["tts_cache"]["hits"], 1)
+        self.assertIn("hit_rate", response.json["tts_cache"])
+        self.assertIn("restarts", response.json["tts_workers"])
+
+        # Once the audio is deleted with its last row, the text is synthesized again
+        for audio_text in AudioText.query.filter_by(audio_url=first.json["audio_url"]).all():
+            self.client.delete("/tap/audio-text", json={"audio_text_id": audio_text.id}, headers=headers)
+        self.assertFalse(os.path.exists(first.json["audio_url"]))
+        third = self.client.post("/tap/process-text", json={"text": "Your order is ready"}, headers=headers)
+        self.assertEqual(third.status_code, 200)
+        self.assertEqual(third.json["audio_url"], first.json["audio_url"])
+        self.assertTrue(os.path.exists(third.json["audio_url"]))
+
+        os.remove(third.json["audio_url"])
+
     def test_process_audio(self):
         response = self.process_audio_response # request made in setUp. Needed for other test
         self.assertEqual(response.status_code, 200)
@@ -1 +1,206 @@
-# If these funcs don't work well, they'd be detected by the routes test
\ No newline at end of file
+# If these funcs don't work well, they'd be detected by the routes test
+import io
+import os
+import sys
+import time
+import wave
+import types
+import subprocess
+import threading
+import unittest
+from unittest.mock import patch
+
+from werkzeug.datastructures import FileStorage
+
+from app import app
+from utils import db
+from blueprints.auth.models import User
+from blueprints.text_audio_processing.models import AudioText
+from blueprints.text_audio_processing.tts import TTSWorkerPool
+from blueprints.text_audio_processing.recognizers import StubRecognizer
+from blueprints.text_audio_processing.utils import audio_processer
+
+
+class FakeEngine:
+    """
+    Stands in for a pyttsx3 engine: writes the text as the audio, hangs on
+    "hang" and fails on "fail"
+    """
+
+    def save_to_file(self, text, path):
+        self.job = (text, path)
+
+    def runAndWait(self):
+        text, path = self.job
+        if text == "hang":
+            time.sleep(60)
+        if text == "fail":
+            raise ValueError("engine error")
+        with open(path, "wb") as f:
+            f.write(text.encode())
+
+
+class TTSWorkerPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        # Workers are forked, so they import the fake module too
+        patcher = patch.dict(sys.modules, {"pyttsx3": types.SimpleNamespace(init=FakeEngine)})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.pool = TTSWorkerPool(2, timeout=1)
+        self.addCleanup(self.pool.shutdown)
+
+    def test_concurrent_requests_share_the_workers(self):
+        results = []
+        threads = [
+            threading.Thread(target=lambda i=i: results.append(self.pool.synthesize(f"text {i}")))
+            for i in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(results), sorted(f"text {i}".encode() for i in range(8)))
+
+    def test_hung_worker_is_restarted(self):
+        with self.assertRaises(TimeoutError):
+            self.pool.synthesize("hang")
+        self.assertEqual(self.pool.restarts, 1)
+        with self.assertRaises(RuntimeError):
+            self.pool.synthesize("fail")
+        self.assertEqual(self.pool.synthesize("after"), b"after")
+        self.assertEqual(self.pool._idle.qsize(), 2)
+
+    def test_context_is_created_on_start(self):
+        # Without fork, as on Windows, asking for it raises ValueError
+        with patch("multiprocessing.get_all_start_methods", return_value=["spawn"]), patch(
+            "multiprocessing.get_context", side_effect=ValueError("cannot find context for 'fork'")
+        ) as get_context:
+            pool = TTSWorkerPool(2, timeout=1)
+            self.assertIsNone(pool._context)
+            get_context.assert_not_called()
+
+            get_context.side_effect = None
+            pool._spawn = lambda: None
+            pool.start()
+            get_context.assert_called_once_with("spawn")
+
+    def test_import_does_not_create_a_context(self):
+        code = (
+            "import multiprocessing\n"
+            "def get_context(method=None):\n"
+            "    raise ValueError(method)\n"
+            "multiprocessing.get_context = get_context\n"
+            "import blueprints.text_audio_processing.utils\n"
+        )
+        root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+        result = subprocess.run([sys.executable, "-c", code], cwd=root, capture_output=True, text=True)
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+def tone(num_frames):
+    """
+    16 bit PCM of a loud square wave
+    """
+    return (b"\x10\x27\xf0\xd8" * (num_frames // 2 + 1))[: 2 * num_frames]
+
+
+def make_wav(num_frames, rate=16000):
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(tone(num_frames))
+    return buffer.getvalue()
+
+
+class AudioPipelineTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        user = User(username="testuser", email="test@example.com", password="password")
+        db.session.add(user)
+        db.session.commit()
+        self.user_id = user.id
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    @patch("blueprints.text_audio_processing.utils.recognizer", StubRecognizer())
+    def test_concurrent_uploads_keep_their_own_audio(self):
+        uploads = {f"{100 * (i + 1)} samples": make_wav(100 * (i + 1)) for i in range(16)}
+        results = {}
+        errors = []
+
+        def process(expected, data):
+            try:
+                with app.app_context():
+                    audio = FileStorage(io.BytesIO(data), filename="upload.wav")
+                    results[expected] = audio_processer(audio, self.user_id)[:2]
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=process, args=item) for item in uploads.items()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        for expected, (text, location) in results.items():
+            # Each upload was recognized and stored from its own bytes
+            self.assertEqual(text, expected)
+            with open(location, "rb") as f:
+                self.assertEqual(f.read(), uploads[expected])
+            self.assertEqual(AudioText.query.filter_by(audio_url=location).one().text_value, expected)
+            os.remove(location)
+        self.assertFalse(os.path.exists("temp_audio_file"))
+
+
+class RecognizerTestCase(unittest.TestCase):
+    def test_backend_is_selected_by_name(self):
+        import speech_recognition as sr
+        from blueprints.text_audio_processing.recognizers import build_recognizer
+
+        recognizer = build_recognizer("stub")
+        self.assertEqual(recognizer(sr.AudioData(bytes(320), 8000, 2)), "160 samples")
+        with self.assertRaises(ValueError):
+            build_recognizer("unknown")
+
+
+class ChunkingTestCase(unittest.TestCase):
+    def split(self, pcm, **options):
+        from blueprints.text_audio_processing.chunking import split_on_silence
+
+        options = {"max_seconds": 30, "min_seconds": 1, "min_silence_seconds": 0.5, "silence_thresh_db": -40, **options}
+        return list(split_on_silence(io.BytesIO(pcm), 16000, **options))
+
+    def test_splits_on_pauses(self):
+        chunks = self.split(tone(32000) + bytes(2 * 16000) + tone(32000) + bytes(2 * 32000))
+        self.assertEqual(len(chunks), 2)
+        (first_start, first), (second_start, second) = chunks
+        self.assertEqual(first_start, 0)
+        # Cut inside the pause, the trailing silence is dropped
+        self.assertTrue(32000 < second_start < 48000)
+        self.assertEqual(first_start + len(first) // 2, second_start)
+        self.assertLess(second_start + len(second) // 2, 16000 * 7)
+
+    def test_long_speech_is_cut_at_the_maximum(self):
+        chunks = self.split(tone(48000), max_seconds=1)
+        self.assertEqual([(start, len(data) // 2) for start, data in chunks], [(0, 16000), (16000, 16000), (32000, 16000)])
+
+    def test_segments_are_transcribed_in_order(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from blueprints.text_audio_processing.chunking import transcribe_chunks
+
+        chunks = [(16000 * i, tone(8000 * (i + 1))) for i in range(6)]
+        with ThreadPoolExecutor(3) as executor:
+            segments = transcribe_chunks(chunks, 16000, StubRecognizer(), executor, max_inflight=2)
+        self.assertEqual([segment["text"] for segment in segments], [f"{8000 * (i + 1)} samples" for i in range(6)])
+        self.assertEqual((segments[1]["start"], segments[1]["end"]), (1.0, 2.0))
+
+
+if __name__ == "__main__":
+    unittest.main()
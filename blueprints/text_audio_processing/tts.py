@@ -0,0 +1,173 @@
+import os
+import queue
+import tempfile
+import threading
+import multiprocessing as mp
+
+
+def _tts_worker(conn, extension, voice, rate):
+    """
+    Worker process loop: initialize one engine and synthesize the texts
+    received on the pipe until it is closed or sent None
+    """
+    import pyttsx3
+
+    engine = pyttsx3.init()
+    if voice:
+        engine.setProperty("voice", voice)
+    if rate:
+        engine.setProperty("rate", rate)
+    while True:
+        try:
+            text = conn.recv()
+        except EOFError:
+            break
+        if text is None:
+            break
+        fd, path = tempfile.mkstemp(suffix=f".{extension}")
+        os.close(fd)
+        try:
+            engine.save_to_file(text, path)
+            engine.runAndWait()
+            with open(path, "rb") as f:
+                conn.send(("ok", f.read()))
+        except Exception as e:
+            conn.send(("error", repr(e)))
+        finally:
+            os.remove(path)
+
+
+def _start_method():
+    """
+    "fork" where the platform has it, so workers start without importing the
+    app again, "spawn" elsewhere, such as on Windows
+    """
+    return "fork" if "fork" in mp.get_all_start_methods() else "spawn"
+
+
+class _Worker:
+    def __init__(self, context, args):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_tts_worker, args=(child_conn, *args), name="tts-worker", daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(timeout=1)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+class TTSWorkerPool:
+    """
+    Pool of long-lived processes each owning one initialized pyttsx3 engine.
+
+    pyttsx3 engines are slow to start and not safe to share between
+    threads, so each worker process initializes its engine once and then
+    synthesizes one text at a time. Callers wait for an idle worker, send it
+    the text over the worker's pipe and receive the audio bytes back. A
+    worker that does not answer within the timeout is killed and replaced,
+    so a stuck driver costs one request instead of a worker.
+
+    Workers are started on first use, like DetectorWorkerPool's, and the
+    start method is only picked then, so creating a pool at import time
+    works on platforms without fork.
+
+    Args:
+        num_workers: number of worker processes
+        timeout: seconds a synthesis may take before its worker is restarted
+        extension: audio format written by the engines
+        voice: id of the engines' voice, the driver's default when None
+        rate: speech rate in words per minute, the driver's default when None
+    """
+
+    def __init__(self, num_workers, timeout, extension="mp3", voice=None, rate=None):
+        self.num_workers = max(1, num_workers)
+        self.timeout = timeout
+        self.extension = extension
+        self.voice = voice
+        self.rate = rate
+        self._context = None
+        self._idle = None
+        self._lock = threading.Lock()
+        self.restarts = 0
+
+    def start(self):
+        """
+        Start the worker processes
+        """
+        if self._idle is not None:
+            return
+        with self._lock:
+            if self._idle is not None:
+                return
+            self._context = mp.get_context(_start_method())
+            idle = queue.Queue()
+            for _ in range(self.num_workers):
+                idle.put(self._spawn())
+            self._idle = idle
+
+    def synthesize(self, text):
+        """
+        Synthesize the text to speech
+        Args:
+            text: text to be spoken
+        Returns:
+            bytes of the audio, in the pool's extension
+        Raises:
+            TimeoutError: no worker became idle, or the synthesis did not
+                finish, within the timeout
+            RuntimeError: the engine failed
+        """
+        self.start()
+        try:
+            worker = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise TimeoutError("No text to speech worker available") from None
+
+        try:
+            worker.conn.send(text)
+            if not worker.conn.poll(self.timeout):
+                raise TimeoutError("Text to speech timed out")
+            status, result = worker.conn.recv()
+        except (TimeoutError, EOFError, OSError) as e:
+            # Hung or dead worker: replace it
+            worker.stop()
+            self.restarts += 1
+            self._idle.put(self._spawn())
+            if isinstance(e, TimeoutError):
+                raise
+            raise RuntimeError("Text to speech worker died") from e
+
+        self._idle.put(worker)
+        if status != "ok":
+            raise RuntimeError(f"Text to speech failed: {result}")
+        return result
+
+    def stats(self):
+        return {
+            "workers": self.num_workers,
+            "idle_workers": self._idle.qsize() if self._idle is not None else 0,
+            "restarts": self.restarts,
+        }
+
+    def _spawn(self):
+        return _Worker(self._context, (self.extension, self.voice, self.rate))
+
+    def shutdown(self):
+        if self._idle is None:
+            return
+        while True:
+            try:
+                self._idle.get_nowait().stop()
+            except queue.Empty:
+                break
+        self._idle = None
@@ -1,58 +1,77 @@
-import os
-import shutil
-from uuid import uuid4
-import pyttsx3
-import speech_recognition as sr
-from pydub import AudioSegment
+import hashlib
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
 
 from settings import Config
 from .models import AudioText
-from utils import db
+from .tts import TTSWorkerPool
+from .recognizers import build_recognizer
+from .chunking import decode_pcm, split_on_silence, transcribe_chunks
+from utils import db, redis_client
+from utils.conditional import bump_version
+from utils.caching import RedisCache, SingleFlight
+from utils.storage import storage
 
 
-base_url = Config.BASE_URL
-audio_folder = os.path.join(
-    base_url, "blueprints", "text_audio_processing", "static", "audio"
-)
-if not os.path.exists(audio_folder):
-    os.makedirs(audio_folder)
+tts_pool = TTSWorkerPool(Config.TTS_WORKERS, Config.TTS_TIMEOUT, voice=Config.TTS_VOICE, rate=Config.TTS_RATE)
+# Storage location of the speech of each text, see speech_location
+tts_cache = RedisCache(redis_client, "tts-cache", ttl=Config.TTS_CACHE_TTL)
+inflight_speech = SingleFlight()
+recognizer = build_recognizer(Config.STT_BACKEND, Config.STT_MODEL, Config.STT_LANGUAGE)
+recognition_executor = ThreadPoolExecutor(max_workers=Config.STT_WORKERS, thread_name_prefix="stt")
+
+# Every recognizer takes 16 kHz speech
+STT_SAMPLE_RATE = 16000
 
 
 def audio_processer(audio, user_id):
     """
     Process the audio and produce its text equivalent
+
+    Each request works on its own copy of the upload. The audio is decoded
+    once to PCM, spooled to disk when long, and split on pauses into chunks
+    of at most STT_CHUNK_MAX_SECONDS that are recognized in parallel, so an
+    hour long recording takes about as long as its chunks divided by
+    STT_WORKERS and only a few chunks are in memory at a time. The original
+    bytes are written to storage once.
     Args:
-        audio: url of the audio
+        audio: FileStorage of the uploaded audio
         user_id: id of the user
     Returns:
-        (audio, text) db objects
+        (text, storage location of the audio, list of {start, end, text} segments)
     """
-    audio.save("temp_audio_file")
-    audio_format = audio.filename.split(".")[-1]
-    if audio_format not in ["wav", "aiff", "flac"]:
-        # change audio format to wav
-        audio = AudioSegment.from_file("temp_audio_file", format=audio_format)
-        with open("temp_audio_file", "wb") as f:
-            audio.export(f, format="wav")
-        audio_format = "wav"
-
-    with open("temp_audio_file", "rb") as audio:
-        # Convert audio to text
-        r = sr.Recognizer()
-        with sr.AudioFile(audio) as source:
-            audio_data = r.record(source)
-            text = r.recognize_google(audio_data)
-
-        # Save audio
-        audio.seek(0)
-        audio_save_to_path = os.path.join(audio_folder, str(uuid4()) + "." + audio_format)
-        with open(audio_save_to_path, "wb") as f:
-            shutil.copyfileobj(audio, f)
+    data = audio.read()
+    audio_format = audio.filename.split(".")[-1].lower()
+
+    with decode_pcm(data, audio_format, STT_SAMPLE_RATE, Config.STT_SPOOL_MAX_BYTES) as pcm:
+        chunks = split_on_silence(
+            pcm,
+            STT_SAMPLE_RATE,
+            Config.STT_CHUNK_MAX_SECONDS,
+            Config.STT_CHUNK_MIN_SECONDS,
+            Config.STT_MIN_SILENCE_MS / 1000,
+            Config.STT_SILENCE_THRESH_DB,
+        )
+        segments = transcribe_chunks(
+            chunks, STT_SAMPLE_RATE, transcribe, recognition_executor, 2 * Config.STT_WORKERS
+        )
+    text = " ".join(segment["text"] for segment in segments)
+    audio_save_to_path = storage.put(data, audio_format, "audio")
 
     save_audio_and_text(text, audio_save_to_path, user_id)
 
-    os.remove("temp_audio_file")
-    return text, audio_save_to_path
+    return text, audio_save_to_path, segments
+
+
+def transcribe(audio_data):
+    """
+    Recognize the speech in decoded audio with the STT_BACKEND recognizer
+    Args:
+        audio_data: sr.AudioData
+    Returns:
+        text
+    """
+    return recognizer(audio_data)
 
 
 def text_processer(text, user_id):
@@ -65,10 +84,7 @@ def text_processer(text, user_id):
         (audio, text) db objects
     """
 
-    audio_full_path = os.path.join(audio_folder, str(uuid4()) + ".mp3")
-    engine = pyttsx3.init()
-    engine.save_to_file(text, audio_full_path)
-    engine.runAndWait()
+    audio_full_path = speech_location(text)
 
     # Store audio in the database
     save_audio_and_text(text, audio_full_path, user_id)
@@ -76,17 +92,56 @@ def text_processer(text, user_id):
     return audio_full_path, text
 
 
+def speech_cache_name(text):
+    """
+    Name of the cached speech of a text: a hash of the text, normalized so
+    that spacing and Unicode forms do not matter, and of the voice settings
+    """
+    normalized = " ".join(unicodedata.normalize("NFKC", text).split())
+    key = "\0".join([normalized, str(tts_pool.voice), str(tts_pool.rate), tts_pool.extension])
+    return f"{hashlib.sha256(key.encode()).hexdigest()}.{tts_pool.extension}"
+
+
+def speech_location(text):
+    """
+    Storage location of the speech of a text, holding a reference for the
+    row about to be saved
+
+    The same prompts are sent over and over, so the TTS cache maps each
+    text and voice settings to the location of the audio synthesized for
+    them, which is stored once in the media storage. A hit only takes a
+    reference on that blob; once the last row using it is deleted the blob
+    is gone, taking the reference fails and the text is synthesized again.
+    Concurrent misses for the same text share one synthesis.
+    Args:
+        text: text to be spoken
+    Returns:
+        storage location of the audio
+    """
+    name = speech_cache_name(text)
+    location = tts_cache.get(name)
+    if location is not None and storage.acquire(location):
+        return location
+
+    audio = inflight_speech.do(name, lambda: tts_pool.synthesize(text))
+    location = storage.put(audio, tts_pool.extension, "audio")
+    tts_cache.set(name, location)
+    return location
+
+
 def save_audio_and_text(text, audio_path, user_id):
     """
     Save the audio and text in the database
     Args:
         text: text to be saved
-        audio_path: path of the audio
+        audio_path: storage location of the audio, from the storage.put
+            that took the row's reference
         user_id: id of the user
     """
 
     audio_text = AudioText(text_value=text, audio_url=audio_path, user_id=user_id)
     db.session.add(audio_text)
     db.session.commit()
+    bump_version("audio_texts", user_id)
 
     return
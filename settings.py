@@ -14,6 +14,62 @@ class Config:
     JWT_REFRESH_TOKEN_EXPIRES = timedelta(seconds=int(os.getenv('JWT_REFRESH_TOKEN_EXPIRES'))) or timedelta(days=30)
     SQLALCHEMY_DATABASE_URI = os.getenv('SQLALCHEMY_DATABASE_URI')
     BASE_URL = os.getenv('BASE_URL', os.path.dirname(__file__))
+    JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))
+    JOB_QUEUE_SIZE = int(os.getenv('JOB_QUEUE_SIZE', 32))
+    JOB_RESULT_TTL = int(os.getenv('JOB_RESULT_TTL', 60 * 60 * 24))
+    STT_BACKEND = os.getenv('STT_BACKEND', 'google')
+    STT_MODEL = os.getenv('STT_MODEL') or None
+    STT_LANGUAGE = os.getenv('STT_LANGUAGE', 'en-US')
+    STT_WORKERS = int(os.getenv('STT_WORKERS', 4))
+    STT_CHUNK_MAX_SECONDS = float(os.getenv('STT_CHUNK_MAX_SECONDS', 30))
+    STT_CHUNK_MIN_SECONDS = float(os.getenv('STT_CHUNK_MIN_SECONDS', 5))
+    STT_MIN_SILENCE_MS = int(os.getenv('STT_MIN_SILENCE_MS', 500))
+    STT_SILENCE_THRESH_DB = float(os.getenv('STT_SILENCE_THRESH_DB', -40))
+    STT_SPOOL_MAX_BYTES = int(os.getenv('STT_SPOOL_MAX_BYTES', 16 * 1024 * 1024))
+    TTS_WORKERS = int(os.getenv('TTS_WORKERS', 2))
+    TTS_TIMEOUT = float(os.getenv('TTS_TIMEOUT', 30))
+    TTS_VOICE = os.getenv('TTS_VOICE') or None
+    TTS_RATE = int(os.getenv('TTS_RATE', 0)) or None
+    TTS_CACHE_TTL = int(os.getenv('TTS_CACHE_TTL', 60 * 60 * 24 * 7))
+    STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'local')
+    STORAGE_ROOT = os.getenv('STORAGE_ROOT', os.path.join(BASE_URL, 'media'))
+    STORAGE_S3_BUCKET = os.getenv('STORAGE_S3_BUCKET')
+    STORAGE_S3_PREFIX = os.getenv('STORAGE_S3_PREFIX', '')
+    STORAGE_S3_ENDPOINT_URL = os.getenv('STORAGE_S3_ENDPOINT_URL')
+    MEDIA_ACCEL_REDIRECT_PREFIX = os.getenv('MEDIA_ACCEL_REDIRECT_PREFIX')
+    MEDIA_PRESIGNED_URL_TTL = int(os.getenv('MEDIA_PRESIGNED_URL_TTL', 3600))
+    USE_X_SENDFILE = os.getenv('USE_X_SENDFILE', '0') == '1'
+    LIST_DEFAULT_LIMIT = int(os.getenv('LIST_DEFAULT_LIMIT', 100))
+    LIST_MAX_LIMIT = int(os.getenv('LIST_MAX_LIMIT', 1000))
+    LIST_STREAM_CHUNK_SIZE = int(os.getenv('LIST_STREAM_CHUNK_SIZE', 500))
+    DETECTION_WARMUP_ON_BOOT = os.getenv('DETECTION_WARMUP_ON_BOOT', '0') == '1'
+    DETECTION_DEFAULT_MODEL = os.getenv('DETECTION_DEFAULT_MODEL', 'fasterrcnn_resnet50_fpn_v2')
+    DETECTION_MAX_LOADED_MODELS = int(os.getenv('DETECTION_MAX_LOADED_MODELS', 2))
+    DETECTION_DEFAULT_SCORE_THRESH = float(os.getenv('DETECTION_DEFAULT_SCORE_THRESH', 0.9))
+    DETECTION_MIN_SCORE_THRESH = float(os.getenv('DETECTION_MIN_SCORE_THRESH', 0.3))
+    DETECTION_BACKEND = os.getenv('DETECTION_BACKEND', 'eager')
+    DETECTION_BACKEND_CACHE_DIR = os.getenv('DETECTION_BACKEND_CACHE_DIR', os.path.join(BASE_URL, 'model_cache'))
+    DETECTION_BATCH_MAX_SIZE = int(os.getenv('DETECTION_BATCH_MAX_SIZE', 8))
+    DETECTION_BATCH_MAX_WAIT_MS = float(os.getenv('DETECTION_BATCH_MAX_WAIT_MS', 10))
+    DETECTION_WORKERS = int(os.getenv('DETECTION_WORKERS', 0))
+    DETECTION_WORKER_THREADS = int(os.getenv('DETECTION_WORKER_THREADS', 0))
+    DETECTION_MAX_FILES_PER_REQUEST = int(os.getenv('DETECTION_MAX_FILES_PER_REQUEST', 500))
+    DETECTION_TILE_SIZE = int(os.getenv('DETECTION_TILE_SIZE', 800))
+    DETECTION_TILE_OVERLAP = int(os.getenv('DETECTION_TILE_OVERLAP', 128))
+    DETECTION_TILE_NMS_IOU = float(os.getenv('DETECTION_TILE_NMS_IOU', 0.5))
+    DETECTION_VIDEO_SAMPLE_FPS = float(os.getenv('DETECTION_VIDEO_SAMPLE_FPS', 2))
+    DETECTION_VIDEO_CHANGE_THRESH = float(os.getenv('DETECTION_VIDEO_CHANGE_THRESH', 0.02))
+    DETECTION_VIDEO_MAX_BYTES = int(os.getenv('DETECTION_VIDEO_MAX_BYTES', 200 * 1024 * 1024))
+    DETECTION_CACHE_BACKEND = os.getenv('DETECTION_CACHE_BACKEND', 'memory')
+    DETECTION_CACHE_MAX_BYTES = int(os.getenv('DETECTION_CACHE_MAX_BYTES', 16 * 1024 * 1024))
+    DETECTION_CACHE_TTL = int(os.getenv('DETECTION_CACHE_TTL', 60 * 60 * 24 * 7))
+    RENDER_CACHE_DIR = os.getenv('RENDER_CACHE_DIR', os.path.join(BASE_URL, 'cache', 'rendered'))
+    RENDER_CACHE_MAX_BYTES = int(os.getenv('RENDER_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+    DERIVATIVE_SIZES = [int(size) for size in os.getenv('DERIVATIVE_SIZES', '200,800').split(',') if size]
+    DERIVATIVE_WEBP_QUALITY = int(os.getenv('DERIVATIVE_WEBP_QUALITY', 80))
+    DERIVATIVE_WORKERS = int(os.getenv('DERIVATIVE_WORKERS', 2))
+    DERIVATIVE_CACHE_DIR = os.getenv('DERIVATIVE_CACHE_DIR', os.path.join(BASE_URL, 'cache', 'derivatives'))
+    DERIVATIVE_CACHE_MAX_BYTES = int(os.getenv('DERIVATIVE_CACHE_MAX_BYTES', 512 * 1024 * 1024))
 
 class DevelopmentConfig(Config):
     DEBUG = True
@@ -95,6 +95,35 @@ class AppTestCase(unittest.TestCase):
             app.blueprints["text_audio_processing"].__class__.__name__, "Blueprint"
         )
 
+    def test_readiness_endpoint(self):
+        """
+        Test the readiness endpoint.
+
+        Without the boot warmup the detector is not waited for. With it, the
+        endpoint reports 503 until the detector has been warmed up and 200 afterwards.
+        """
+        from blueprints.object_detection.detector import detector
+
+        warmup_on_boot = app.config["DETECTION_WARMUP_ON_BOOT"]
+        app.config["DETECTION_WARMUP_ON_BOOT"] = False
+        response = self.app.get("/ready")
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("object_detection", response.json["components"])
+
+        app.config["DETECTION_WARMUP_ON_BOOT"] = True
+        try:
+            response = self.app.get("/ready")
+            self.assertIn(response.status_code, (200, 503))
+            self.assertEqual(response.json["ready"], detector.ready)
+
+            detector.warmup()
+            response = self.app.get("/ready")
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.json["ready"])
+            self.assertTrue(response.json["components"]["object_detection"])
+        finally:
+            app.config["DETECTION_WARMUP_ON_BOOT"] = warmup_on_boot
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,12 +1,19 @@
 import os
+import json
 import unittest
 import unittest
+from datetime import datetime
 from unittest.mock import patch
 
 import redis
 from dotenv import load_dotenv
 
 from utils import send_mail, create_email_message, db
+from utils.caching import LRUCache, SingleFlight
+from utils.storage import MediaStorage, MediaBlob, LocalBackend, S3Backend
+from utils.serialization import FastJSONProvider
+from flask import jsonify
+from flask.json.provider import DefaultJSONProvider
 from app import app
 
 load_dotenv()
@@ -71,5 +78,268 @@ class UtilitiesTestCase(unittest.TestCase):
             self.assertTrue(redis_client)
 
 
+class CachingTestCase(unittest.TestCase):
+    def test_lru_cache_evicts_by_size(self):
+        """
+        Test that the least recently used entries are evicted once the size budget is exceeded
+        """
+        evicted = []
+        cache = LRUCache(max_bytes=10, on_evict=lambda key, value: evicted.append(key))
+        cache.set("a", 1, size=4)
+        cache.set("b", 2, size=4)
+        self.assertEqual(cache.get("a"), 1)
+        cache.set("c", 3, size=4)
+
+        self.assertEqual(evicted, ["b"])
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+        stats = cache.stats()
+        self.assertEqual(stats["hits"], 2)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["size_bytes"], 8)
+
+    def test_disk_cache_groups_and_eviction(self):
+        """
+        Test that discard only removes its group and eviction spares files being written
+        """
+        import shutil
+        import tempfile
+
+        from utils.caching import DiskCache
+
+        def write(data):
+            def to(path):
+                with open(path, "wb") as f:
+                    f.write(data)
+
+            return to
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        cache = DiskCache(directory, max_bytes=10)
+        cache.put("1/a.png", write(b"1234"))
+        cache.put("12/a.png", write(b"1234"))
+        cache.discard("1")
+        self.assertIsNone(cache.get("1/a.png"))
+        self.assertIsNotNone(cache.get("12/a.png"))
+        self.assertEqual(cache.stats()["size_bytes"], 4)
+
+        # Another writer's temporary file is not an eviction candidate
+        tmp_path = os.path.join(directory, "12", "b.0123.tmp.png")
+        with open(tmp_path, "wb") as f:
+            f.write(b"12345678")
+        os.utime(tmp_path, (0, 0))
+        cache.put("12/c.png", write(b"123456789"))
+        self.assertTrue(os.path.exists(tmp_path))
+        self.assertIsNone(cache.get("12/a.png"))
+        self.assertIsNotNone(cache.get("12/c.png"))
+
+    def test_single_flight_coalesces_concurrent_calls(self):
+        """
+        Test that concurrent calls with the same key run the function once
+        """
+        import threading
+        import time
+
+        calls = []
+        flight = SingleFlight()
+
+        def work():
+            calls.append(1)
+            time.sleep(0.1)
+            return "result"
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(flight.call("key", work)))
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        # Only the caller that ran the function is told its result is its own
+        self.assertEqual(sorted(results), [("result", False)] + [("result", True)] * 4)
+        self.assertEqual(flight.coalesced, 4)
+        self.assertEqual(flight.do("key", work), "result")
+
+
+class FlakyRedis:
+    """
+    In-memory stand-in for the redis client, failing while ``down`` is set
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.down = False
+
+    def set(self, key, value, ex=None):
+        if self.down:
+            raise redis.ConnectionError("down")
+        self.data[key] = value
+
+    def get(self, key):
+        return self.data.get(key)
+
+
+class JobQueueTestCase(unittest.TestCase):
+    def test_redis_errors_do_not_leak_slots(self):
+        import threading
+
+        from utils.jobs import JobQueue, JobQueueFull
+
+        client = FlakyRedis()
+        queue = JobQueue(client, max_workers=1, max_queued=0)
+        self.addCleanup(queue._executor.shutdown)
+
+        client.down = True
+        for _ in range(3):
+            with self.assertRaises(redis.ConnectionError):
+                queue.submit(app, 1, "test", lambda: None)
+
+        client.down = False
+        started, release = threading.Event(), threading.Event()
+
+        def work():
+            started.set()
+            release.wait(5)
+            return {"done": True}
+
+        job_id = queue.submit(app, 1, "test", work)
+        started.wait(5)
+        # The only slot is taken by the running job
+        with self.assertRaises(JobQueueFull):
+            queue.submit(app, 1, "test", lambda: None)
+        release.set()
+        queue._executor.shutdown(wait=True)
+        self.assertEqual(queue.get(job_id)["result"], {"done": True})
+
+
+class FakeS3Client:
+    """
+    In-memory stand-in for the boto3 S3 client methods the storage uses
+    """
+
+    class NotFound(Exception):
+        response = {"Error": {"Code": "404"}}
+
+    def __init__(self):
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[(Bucket, Key)] = bytes(Body)
+
+    def head_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise self.NotFound()
+        return {"ContentLength": len(self.objects[(Bucket, Key)])}
+
+    def get_object(self, Bucket, Key):
+        import io
+
+        return {"Body": io.BytesIO(self.objects[(Bucket, Key)])}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+
+
+class StorageTestCase(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        shutil.rmtree(self.root)
+
+    def check_deduplication(self, storage):
+        first = storage.put(b"same bytes", "jpg", "images")
+        second = storage.put(b"same bytes", "jpg", "images")
+        other = storage.put(b"other bytes", "jpg", "images")
+        db.session.commit()
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, other)
+        blob = db.session.get(MediaBlob, storage.backend.key(first))
+        self.assertEqual(blob.refcount, 2)
+
+        storage.release(first)
+        db.session.commit()
+        self.assertTrue(storage.exists(first))
+        with storage.open(first) as f:
+            self.assertEqual(f.read(), b"same bytes")
+
+        # The file is only deleted once the last release is committed
+        storage.release(second)
+        db.session.rollback()
+        self.assertTrue(storage.exists(first))
+        storage.release(second)
+        self.assertTrue(storage.exists(first))
+        db.session.commit()
+        self.assertFalse(storage.exists(first))
+        self.assertIsNone(db.session.get(MediaBlob, storage.backend.key(first)))
+        self.assertFalse(storage.acquire(first))
+
+        # Stored again by the next put of the same bytes
+        self.assertEqual(storage.put(b"same bytes", "jpg", "images"), first)
+        db.session.commit()
+        self.assertTrue(storage.exists(first))
+        self.assertTrue(storage.acquire(other))
+        db.session.commit()
+        self.assertEqual(db.session.get(MediaBlob, storage.backend.key(other)).refcount, 2)
+
+    def test_local_storage(self):
+        storage = MediaStorage(LocalBackend(self.root))
+        self.check_deduplication(storage)
+
+        location = storage.put(b"bytes", "png", "images")
+        relative = os.path.relpath(location, self.root).split(os.sep)
+        # Sharded by the first bytes of the content hash
+        self.assertEqual(relative[0], "images")
+        self.assertEqual(relative[1], relative[3][:2])
+        self.assertEqual(relative[2], relative[3][2:4])
+        self.assertEqual(storage.local_path(location), location)
+
+    def test_s3_storage(self):
+        client = FakeS3Client()
+        storage = MediaStorage(S3Backend(client, "bucket", prefix="media"))
+        self.check_deduplication(storage)
+
+        location = storage.put(b"bytes", "png", "images")
+        self.assertTrue(location.startswith("s3://bucket/media/images/"))
+        self.assertIsNone(storage.local_path(location))
+        self.assertEqual(list(client.objects.values()).count(b"bytes"), 1)
+
+
+class SerializationTestCase(unittest.TestCase):
+    def test_json_decodes_like_the_default_provider(self):
+        payload = {"id": 1, "detected_on": datetime(2024, 2, 29, 3, 4, 5), "labels": ["cat", "dog"], "text": "é"}
+        self.assertIsInstance(app.json, FastJSONProvider)
+        self.assertEqual(json.loads(app.json.dumps(payload)), json.loads(DefaultJSONProvider(app).dumps(payload)))
+
+    def test_msgpack_is_negotiated(self):
+        import msgpack
+
+        with app.test_request_context(headers={"Accept": "application/msgpack"}):
+            response = jsonify(id=1, detected_on=datetime(2024, 2, 29, 3, 4, 5))
+        self.assertEqual(response.mimetype, "application/msgpack")
+        self.assertIn("Accept", response.vary)
+        self.assertEqual(msgpack.unpackb(response.data), {"id": 1, "detected_on": "Thu, 29 Feb 2024 03:04:05 GMT"})
+
+        with app.test_request_context(headers={"Accept": "*/*"}):
+            response = jsonify(id=1)
+        self.assertEqual(response.mimetype, "application/json")
+        self.assertEqual(response.get_json(), {"id": 1})
+
+
 if __name__ == "__main__":
     unittest.main()
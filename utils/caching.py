@@ -0,0 +1,305 @@
+import os
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from uuid import uuid4
+
+
+class LRUCache:
+    """
+    Thread-safe in-process LRU cache bounded by the total size of its values.
+
+    Args:
+        max_bytes: budget for the summed ``size`` of all entries
+        on_evict: optional callable(key, value) run for every evicted entry
+    """
+
+    def __init__(self, max_bytes, on_evict=None):
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, size=None):
+        if size is None:
+            size = len(json.dumps(value))
+        evicted = []
+        with self._lock:
+            if key in self._entries:
+                self._size -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self._size += size
+            while self._size > self.max_bytes and len(self._entries) > 1:
+                old_key, (old_value, old_size) = self._entries.popitem(last=False)
+                self._size -= old_size
+                evicted.append((old_key, old_value))
+        if self.on_evict is not None:
+            for old_key, old_value in evicted:
+                self.on_evict(old_key, old_value)
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._size -= entry[1]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "backend": "memory",
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "size_bytes": self._size,
+                "max_bytes": self.max_bytes,
+            }
+
+
+class RedisCache:
+    """
+    JSON value cache stored in Redis and shared by every API worker.
+
+    Redis' own maxmemory policy does the size based eviction; entries also
+    expire after ``ttl`` seconds. Hit and miss counters are kept in Redis so
+    they cover all workers.
+
+    Args:
+        client: redis client created with decode_responses=True
+        prefix: namespace for the keys of this cache
+        ttl: entry lifetime in seconds
+    """
+
+    def __init__(self, client, prefix, ttl=None):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def get(self, key):
+        value = self.client.get(f"{self.prefix}:{key}")
+        self.client.hincrby(f"{self.prefix}:stats", "misses" if value is None else "hits", 1)
+        return None if value is None else json.loads(value)
+
+    def set(self, key, value, size=None):
+        self.client.set(f"{self.prefix}:{key}", json.dumps(value), ex=self.ttl)
+
+    def delete(self, key):
+        self.client.delete(f"{self.prefix}:{key}")
+
+    def stats(self):
+        counters = self.client.hgetall(f"{self.prefix}:stats")
+        hits = int(counters.get("hits", 0))
+        misses = int(counters.get("misses", 0))
+        lookups = hits + misses
+        return {
+            "backend": "redis",
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+        }
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls that share a key.
+
+    The first caller for a key runs the function; callers arriving while it
+    is still running wait for and share its result (or exception).
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        return self.call(key, fn)[0]
+
+    def call(self, key, fn):
+        """
+        Like ``do``, also telling whether the result came from another caller
+        Returns:
+            (result, shared), shared being False for the caller that ran fn
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            return future.result(), True
+
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+def _is_cached_file(entry):
+    # put writes to "<name>.<random>.tmp<ext>" before renaming into place
+    return entry.is_file() and not os.path.splitext(entry.name)[0].endswith(".tmp")
+
+
+class DiskCache:
+    """
+    Directory of derived files (renders, thumbnails...) bounded by total size.
+
+    Files are evicted least recently used first; reading a file refreshes its
+    modification time. Files are written to a temporary name and renamed into
+    place so readers never see a partial file. A name may put its file in a
+    subdirectory, ``group/name``, so that ``discard`` removes a whole group
+    without listing the rest of the cache.
+
+    Args:
+        directory: folder holding the cached files
+        max_bytes: budget for the total size of the files
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._size = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def get(self, name):
+        """
+        Path of a cached file, or None when it is not cached
+        """
+        path = self.path(name)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return path
+
+    def put(self, name, write):
+        """
+        Create a cached file
+        Args:
+            name: file name inside the cache directory
+            write: callable receiving the temporary path to write the file to
+        Returns:
+            path of the cached file
+        """
+        path = self.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._lock:
+            self._ensure_size()
+        root, ext = os.path.splitext(path)
+        tmp_path = f"{root}.{uuid4().hex}.tmp{ext}"
+        try:
+            write(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        with self._lock:
+            self._size += os.path.getsize(path)
+            if self._size > self.max_bytes:
+                self._evict()
+        return path
+
+    def discard(self, group):
+        """
+        Remove the cached files put under group/
+        """
+        directory = self.path(group)
+        with self._lock:
+            try:
+                entries = [entry for entry in os.scandir(directory) if _is_cached_file(entry)]
+            except FileNotFoundError:
+                return
+            for entry in entries:
+                try:
+                    size = entry.stat().st_size
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    continue
+                if self._size is not None:
+                    self._size -= size
+            try:
+                os.rmdir(directory)
+            except OSError:
+                # A file is being written to it
+                pass
+
+    def stats(self):
+        with self._lock:
+            self._ensure_size()
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "size_bytes": self._size,
+                "max_bytes": self.max_bytes,
+            }
+
+    def _ensure_size(self):
+        if self._size is None:
+            self._size = sum(entry.stat().st_size for entry in self._entries())
+
+    def _entries(self):
+        """
+        The cached files, in the directory and its group subdirectories.
+        Files still being written by ``put`` are left out, so eviction
+        never removes them from under their writer.
+        """
+        entries = []
+        if not os.path.isdir(self.directory):
+            return entries
+        for entry in os.scandir(self.directory):
+            if entry.is_dir():
+                try:
+                    entries.extend(sub for sub in os.scandir(entry.path) if _is_cached_file(sub))
+                except FileNotFoundError:
+                    continue
+            elif _is_cached_file(entry):
+                entries.append(entry)
+        return entries
+
+    def _evict(self):
+        # Rescan so files added by other processes are accounted for
+        entries = sorted(self._entries(), key=lambda entry: entry.stat().st_mtime)
+        self._size = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if self._size <= self.max_bytes:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            self._size -= size
@@ -0,0 +1,111 @@
+import time
+import hashlib
+from functools import wraps
+from uuid import uuid4
+
+from flask import request, make_response
+from flask_jwt_extended import current_user
+from werkzeug.http import http_date
+
+from .utilities import redis_client
+from .serialization import negotiated_mimetype
+
+
+def request_value(name):
+    """
+    Read a parameter from the query string, falling back to the JSON body
+    sent by older clients
+    """
+    value = request.args.get(name)
+    if value is None:
+        value = (request.get_json(silent=True) or {}).get(name)
+    return value
+
+
+def _version_key(resource, user_id):
+    return f"version:{resource}:{user_id}"
+
+
+# Last-Modified has a one second granularity: every change moves it at
+# least one second past the previous one, so that an If-Modified-Since
+# read in the same second as a write never matches the new version
+_bump_script = redis_client.register_script(
+    """
+    local previous = tonumber(redis.call("HGET", KEYS[1], "modified") or "0")
+    local modified = math.max(tonumber(ARGV[2]), previous + 1)
+    redis.call("HSET", KEYS[1], "tag", ARGV[1], "modified", modified)
+    return modified
+    """
+)
+
+
+def bump_version(resource, user_id):
+    """
+    Record that the user's rows of a resource changed, invalidating the
+    ETags handed out for them
+    """
+    _bump_script(keys=[_version_key(resource, user_id)], args=[uuid4().hex[:16], int(time.time())])
+
+
+def get_version(resource, user_id):
+    """
+    (tag, modified timestamp) of the user's rows of a resource
+    """
+    key = _version_key(resource, user_id)
+    version = redis_client.hgetall(key)
+    if not version:
+        # First use, or Redis lost it: start a fresh tag so old ETags never match
+        redis_client.hsetnx(key, "tag", uuid4().hex[:16])
+        redis_client.hsetnx(key, "modified", int(time.time()))
+        version = redis_client.hgetall(key)
+    return version["tag"], int(version["modified"])
+
+
+def conditional(resource, params=()):
+    """
+    Answer conditional GETs of a per-user resource from its version counter.
+
+    The ETag is derived from the user's version of the resource, the
+    query string, the values of params and the negotiated body format, so
+    a matching If-None-Match (or an If-Modified-Since not older than the
+    last change) gets a 304 without the view running or any row being
+    loaded. Writes to the resource must call bump_version.
+    Args:
+        resource: name of the resource passed to bump_version
+        params: parameters the view reads with request_value, which older
+            clients send in the JSON body instead of the query string
+    """
+
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            tag, modified = get_version(resource, current_user.id)
+            mimetype = negotiated_mimetype()
+            values = "\0".join(f"{name}={request_value(name)}" for name in params)
+            variant = hashlib.sha256(
+                b"\0".join([request.query_string, values.encode(), mimetype.encode()])
+            ).hexdigest()[:16]
+            etag = f"{resource}-{tag}-{variant}"
+            headers = {
+                "ETag": f'"{etag}"',
+                "Last-Modified": http_date(modified),
+                "Cache-Control": "private, no-cache",
+                "Vary": "Accept",
+            }
+
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains(etag)
+            else:
+                since = request.if_modified_since
+                not_modified = since is not None and since.timestamp() >= modified
+            if not_modified:
+                return make_response("", 304, headers)
+
+            response = make_response(fn(*args, **kwargs))
+            if response.status_code == 200:
+                response.headers.update(headers)
+            return response
+
+        return wrapper
+
+    return decorator
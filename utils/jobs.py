@@ -0,0 +1,132 @@
+import json
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+
+from flask import request, jsonify, current_app, url_for
+from flask_jwt_extended import current_user
+
+from settings import Config
+from .utilities import redis_client
+
+
+class JobQueueFull(Exception):
+    """
+    Raised when the background job queue has no room for another job
+    """
+
+
+def wants_async():
+    """
+    Whether the client asked for the request to be processed in the background,
+    either with ``?async=true`` or a ``Prefer: respond-async`` header.
+    """
+    if request.args.get("async", "").lower() in ("1", "true", "yes"):
+        return True
+    return "respond-async" in request.headers.get("Prefer", "")
+
+
+def submit_job(kind, fn, *args):
+    """
+    Queue a background job for the current user
+    Args:
+        kind: name of the operation, e.g. "detect-image"
+        fn: callable returning the JSON payload of the sync route
+    Returns:
+        tuple: a 202 response pointing at the job status endpoint, or 503
+               when the queue is full
+    """
+    try:
+        job_id = jobs.submit(current_app._get_current_object(), current_user.id, kind, fn, *args)
+    except JobQueueFull:
+        return jsonify(msg="Too many pending jobs, try again later"), 503
+    status_url = url_for("get_job", job_id=job_id)
+    return (
+        jsonify(job_id=job_id, status="queued", status_url=status_url),
+        202,
+        {"Location": status_url},
+    )
+
+
+class JobQueue:
+    """
+    Runs request handlers on a bounded background executor.
+
+    Job state is kept in Redis so any API worker can answer a status poll,
+    whichever worker accepted the job.
+
+    Args:
+        client: redis client created with decode_responses=True
+        max_workers: number of jobs running at the same time
+        max_queued: number of jobs allowed to wait for a free worker
+        ttl: seconds a job's state and result are kept
+    """
+
+    def __init__(self, client, max_workers=2, max_queued=32, ttl=60 * 60 * 24):
+        self.client = client
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._slots = threading.BoundedSemaphore(max_workers + max_queued)
+
+    def submit(self, app, user_id, kind, fn, *args):
+        """
+        Queue ``fn(*args)`` to run in the background inside an app context
+        Args:
+            app: Flask application
+            user_id: id of the user owning the job
+            kind: name of the operation, e.g. "detect-image"
+            fn: callable returning the JSON payload of the sync route
+        Returns:
+            job_id: string
+        Raises:
+            JobQueueFull: when the queue is at capacity
+        """
+        if not self._slots.acquire(blocking=False):
+            raise JobQueueFull()
+        job_id = str(uuid4())
+        try:
+            self._save(job_id, {"id": job_id, "kind": kind, "user_id": user_id, "status": "queued"})
+            self._executor.submit(self._run, app, job_id, fn, args)
+        except Exception:
+            self._slots.release()
+            raise
+        return job_id
+
+    def get(self, job_id):
+        """
+        Get the stored state of a job
+        Returns:
+            dict or None
+        """
+        job = self.client.get(f"job:{job_id}")
+        return json.loads(job) if job is not None else None
+
+    def _save(self, job_id, job):
+        self.client.set(f"job:{job_id}", json.dumps(job, default=str), ex=self.ttl)
+
+    def _run(self, app, job_id, fn, args):
+        # The slot is released even when Redis fails
+        try:
+            job = self.get(job_id)
+            try:
+                job["status"] = "running"
+                self._save(job_id, job)
+                with app.app_context():
+                    job["result"] = fn(*args)
+                job["status"] = "finished"
+            except Exception:
+                traceback.print_exc()
+                job["status"] = "failed"
+            finally:
+                self._save(job_id, job)
+        finally:
+            self._slots.release()
+
+
+jobs = JobQueue(
+    redis_client,
+    max_workers=Config.JOB_WORKERS,
+    max_queued=Config.JOB_QUEUE_SIZE,
+    ttl=Config.JOB_RESULT_TTL,
+)
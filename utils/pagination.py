@@ -0,0 +1,107 @@
+from flask import request, jsonify, current_app, Response, stream_with_context
+
+from settings import Config
+
+
+def list_response(query, id_column, fields, default_fields=None, extras=None, envelope=None):
+    """
+    Build the response of a list endpoint with keyset pagination, field
+    projection and optional streaming
+
+    Query parameters read from the request:
+        limit: page size, at most LIST_MAX_LIMIT. A request with neither a
+            limit nor a cursor gets every row, as before pagination; one with
+            only a cursor gets LIST_DEFAULT_LIMIT rows
+        cursor: the X-Next-Cursor header of the previous page; rows are
+            returned by increasing id after it
+        fields: comma separated names of the fields to return
+        stream: when true, rows are serialized as they are read from the
+            database instead of being buffered. Without a limit, every row
+            after the cursor is streamed
+
+    The body keeps the shape of the unpaginated endpoint, a list (or a
+    ``{envelope: [...]}`` object); the cursor of the next page is sent in the
+    X-Next-Cursor header when there is one.
+    Args:
+        query: query filtered on the rows to list
+        id_column: unique, increasing column used as the cursor
+        fields: dict of field name to column, only the requested columns are selected
+        default_fields: fields returned when the request has no fields
+            parameter, all of them when None
+        extras: dict of field name to callable(list of ids) -> {id: value},
+            for fields computed from other tables. It is called once per
+            chunk of rows
+        envelope: key the list is wrapped in, None for a bare list
+    Returns:
+        tuple: response, status code and headers
+    """
+    extras = extras or {}
+    names = list(fields) + list(extras)
+    try:
+        limit = request.args.get("limit")
+        limit = int(limit) if limit else None
+        cursor = request.args.get("cursor")
+        cursor = int(cursor) if cursor else None
+    except ValueError:
+        return jsonify(msg="limit and cursor must be integers"), 400
+    stream = request.args.get("stream", "").lower() in ("1", "true", "yes")
+    if limit is None and cursor is not None and not stream:
+        limit = Config.LIST_DEFAULT_LIMIT
+    if limit is not None and not 1 <= limit <= Config.LIST_MAX_LIMIT:
+        return jsonify(msg=f"limit must be between 1 and {Config.LIST_MAX_LIMIT}"), 400
+
+    requested = request.args.get("fields")
+    if requested:
+        selected = [name.strip() for name in requested.split(",") if name.strip()]
+        unknown = [name for name in selected if name not in names]
+        if unknown:
+            return jsonify(msg=f"Unknown fields {', '.join(unknown)}. Choose from {', '.join(names)}"), 400
+    else:
+        selected = list(default_fields or names)
+
+    columns = [fields[name] for name in selected if name in fields]
+    query = query.with_entities(id_column, *columns).order_by(id_column)
+    if cursor is not None:
+        query = query.filter(id_column > cursor)
+
+    headers = {}
+    if limit is not None:
+        # The limit-th id bounds the page, and is the next cursor when a row
+        # follows it; both are read from the id index alone
+        boundary = query.with_entities(id_column).offset(limit - 1).limit(2).all()
+        if len(boundary) == 2:
+            last_id = boundary[0][0]
+            query = query.filter(id_column <= last_id)
+            headers["X-Next-Cursor"] = str(last_id)
+
+    def serialize(chunk):
+        ids = [row[0] for row in chunk]
+        computed = {name: extras[name](ids) for name in selected if name in extras}
+        for row in chunk:
+            values = dict(zip((name for name in selected if name in fields), row[1:]))
+            yield {name: values[name] if name in fields else computed[name].get(row[0]) for name in selected}
+
+    def chunks(rows, size=Config.LIST_STREAM_CHUNK_SIZE):
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    if not stream:
+        items = [item for chunk in chunks(query.all()) for item in serialize(chunk)]
+        return jsonify({envelope: items} if envelope else items), 200, headers
+
+    def generate():
+        yield f'{{"{envelope}": [' if envelope else "["
+        first = True
+        for chunk in chunks(query.yield_per(Config.LIST_STREAM_CHUNK_SIZE)):
+            for item in serialize(chunk):
+                yield ("" if first else ",") + current_app.json.dumps(item)
+                first = False
+        yield "]}" if envelope else "]"
+
+    return Response(stream_with_context(generate()), mimetype="application/json"), 200, headers
@@ -0,0 +1,99 @@
+from datetime import datetime, timezone
+
+from flask import request, has_request_context
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+DAYS = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+MONTHS = ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+
+JSON_MIMETYPE = "application/json"
+MSGPACK_MIMETYPE = "application/msgpack"
+MSGPACK_MIMETYPES = (MSGPACK_MIMETYPE, "application/x-msgpack")
+
+
+def negotiated_mimetype():
+    """
+    Body format the request asked for in its Accept header: MessagePack when
+    it prefers it and msgpack is installed, JSON otherwise
+    """
+    if msgpack is None or not has_request_context():
+        return JSON_MIMETYPE
+    best = request.accept_mimetypes.best_match((JSON_MIMETYPE, *MSGPACK_MIMETYPES))
+    return MSGPACK_MIMETYPE if best in MSGPACK_MIMETYPES else JSON_MIMETYPE
+
+
+def encode_default(o):
+    """
+    Encode the values orjson and msgpack leave to the provider, like
+    DefaultJSONProvider.default but formatting datetimes without going
+    through the email module, which dominates the encoding of long lists
+    """
+    if isinstance(o, datetime):
+        if o.tzinfo is not None:
+            o = o.astimezone(timezone.utc)
+        return (
+            f"{DAYS[o.weekday()]}, {o.day:02d} {MONTHS[o.month - 1]} {o.year:04d} "
+            f"{o.hour:02d}:{o.minute:02d}:{o.second:02d} GMT"
+        )
+    return DefaultJSONProvider.default(o)
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """
+    JSON provider encoding with orjson, and answering with MessagePack the
+    requests that ask for it.
+
+    The output decodes to the same values as the default provider's: keys
+    are sorted, dates use the HTTP date format and the body is indented in
+    debug mode, but non-ASCII characters are sent as UTF-8 instead of being
+    escaped. orjson encodes the pages of the list endpoints about three
+    times faster than the json module, see benchmarks/serialization.py, and
+    MessagePack bodies are smaller for service to service callers. Without
+    orjson the json module is used, and MessagePack is only offered when
+    msgpack is installed.
+    """
+
+    def _orjson_options(self):
+        options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            options |= orjson.OPT_SORT_KEYS
+        compact = self.compact if self.compact is not None else not self._app.debug
+        if not compact:
+            options |= orjson.OPT_INDENT_2
+        return options
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=encode_default, option=self._orjson_options()).decode()
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        mimetype = negotiated_mimetype()
+        if mimetype == MSGPACK_MIMETYPE:
+            body = msgpack.packb(obj, default=encode_default, use_bin_type=True)
+        elif orjson is not None:
+            body = orjson.dumps(obj, default=encode_default, option=self._orjson_options()) + b"\n"
+        else:
+            body = f"{super().dumps(obj)}\n"
+
+        response = self._app.response_class(body, mimetype=mimetype)
+        if msgpack is not None:
+            response.vary.add("Accept")
+        return response
@@ -0,0 +1,372 @@
+import io
+import os
+import hashlib
+import mimetypes
+from uuid import uuid4
+
+from flask import send_file, redirect, make_response
+from sqlalchemy import event, update, select, delete
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from settings import Config
+from .utilities import db
+
+
+class MediaBlob(db.Model):
+    """
+    A stored file and the number of database rows referencing it
+    """
+
+    __tablename__ = "media_blobs"
+
+    key = db.Column(db.String(255), primary_key=True)
+    size = db.Column(db.Integer, nullable=False)
+    refcount = db.Column(db.Integer, nullable=False, default=0)
+    created_on = db.Column(db.DateTime, nullable=True, default=db.func.current_timestamp())
+
+
+class LocalBackend:
+    """
+    Stores blobs as files under a root directory.
+
+    Keys are content addressed and sharded by hash prefix
+    (``images/ab/cd/abcd....jpg``) so no directory grows past a few
+    thousand entries. Files are written to a temporary name and renamed into
+    place, so readers never see a partial file.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def location(self, key):
+        return os.path.join(self.root, key)
+
+    def key(self, location):
+        root = os.path.join(self.root, "")
+        return location[len(root):] if location.startswith(root) else None
+
+    def local_path(self, key):
+        return self.location(key)
+
+    def exists(self, key):
+        return os.path.exists(self.location(key))
+
+    def size(self, key):
+        return os.path.getsize(self.location(key))
+
+    def write(self, key, data):
+        path = self.location(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def open(self, key):
+        return open(self.location(key), "rb")
+
+    def delete(self, key):
+        try:
+            os.remove(self.location(key))
+        except FileNotFoundError:
+            pass
+
+
+class S3Backend:
+    """
+    Stores blobs in an S3 compatible bucket.
+
+    Args:
+        client: boto3 S3 client, or anything with the same put_object,
+            get_object, head_object and delete_object methods
+        bucket: bucket name
+        prefix: key prefix inside the bucket
+    """
+
+    def __init__(self, client, bucket, prefix=""):
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+
+    def _object_key(self, key):
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    def location(self, key):
+        return f"s3://{self.bucket}/{self._object_key(key)}"
+
+    def key(self, location):
+        root = self.location("")
+        return location[len(root):] if location.startswith(root) else None
+
+    def local_path(self, key):
+        return None
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._object_key(key))
+        except Exception as e:
+            code = getattr(e, "response", {}).get("Error", {}).get("Code")
+            if code in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+        return True
+
+    def size(self, key):
+        return self.client.head_object(Bucket=self.bucket, Key=self._object_key(key))["ContentLength"]
+
+    def write(self, key, data):
+        # A PUT is atomic, readers see the previous object or the new one
+        self.client.put_object(Bucket=self.bucket, Key=self._object_key(key), Body=data)
+
+    def open(self, key):
+        body = self.client.get_object(Bucket=self.bucket, Key=self._object_key(key))["Body"]
+        return io.BytesIO(body.read())
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self._object_key(key))
+
+    def presigned_url(self, key, expires_in):
+        """
+        Temporary URL downloading the object straight from the bucket, or
+        None when the client cannot sign URLs
+        """
+        if not hasattr(self.client, "generate_presigned_url"):
+            return None
+        return self.client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": self.bucket, "Key": self._object_key(key)},
+            ExpiresIn=expires_in,
+        )
+
+
+class MediaStorage:
+    """
+    Content addressed media storage with reference counted deduplication.
+
+    ``put`` stores the bytes once per content hash and returns their
+    location, which is what the Image and AudioText rows keep in their url
+    columns. Every row referencing a location holds a reference, taken by
+    ``put`` or by ``acquire`` for bytes already stored; ``release`` drops
+    it. Reference counts live in the media_blobs table and change in the
+    caller's transaction, which keeps the blob's row locked until it ends.
+
+    A blob is deleted once the transaction dropping its last reference has
+    committed, by ``sweep`` with the row locked again, so a rolled back
+    deletion keeps its file and a concurrent ``put`` of the same bytes
+    either sees the row before the sweep, which then leaves it, or writes
+    the file again after it.
+
+    Locations that are not in the media_blobs table, such as files written
+    before this storage existed, are readable but never deleted.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def put(self, data, extension, namespace):
+        """
+        Store bytes unless identical bytes are already stored, and take a
+        reference on them for the new database row keeping the location
+        Args:
+            data: bytes
+            extension: file extension, without the dot
+            namespace: top level folder, e.g. "images"
+        Returns:
+            location of the blob
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        key = f"{namespace}/{digest[:2]}/{digest[2:4]}/{digest}.{extension.lower()}"
+        if not self._increment(key):
+            try:
+                with db.session.begin_nested():
+                    db.session.add(MediaBlob(key=key, size=len(data), refcount=1))
+            except IntegrityError:
+                # Another request created the row first
+                self._increment(key)
+        # The reference is held, a sweep can no longer delete the file
+        if not self.backend.exists(key):
+            self.backend.write(key, data)
+        return self.backend.location(key)
+
+    def acquire(self, location):
+        """
+        Take a reference on a stored blob for a new database row
+        Returns:
+            False when the blob is no longer stored
+        """
+        key = self.backend.key(location)
+        if key is None:
+            return self.exists(location)
+        return self._increment(key)
+
+    def release(self, location):
+        """
+        Drop a reference. The blob is deleted after the transaction dropping
+        the last one commits
+        """
+        key = self.backend.key(location)
+        if key is None:
+            return
+        blob = db.session.get(MediaBlob, key, with_for_update=True)
+        if blob is None or blob.refcount <= 0:
+            return
+        blob.refcount -= 1
+        if blob.refcount == 0:
+            db.session.info.setdefault("released_media", []).append((self, key))
+
+    def sweep(self, keys=None):
+        """
+        Delete the blobs left without references, each in its own
+        transaction holding the blob's row lock while the file is deleted
+        Args:
+            keys: blobs to check, every unreferenced blob when None
+        Returns:
+            number of blobs deleted
+        """
+        with db.engine.connect() as connection:
+            if keys is None:
+                with connection.begin():
+                    keys = connection.execute(
+                        select(MediaBlob.key).where(MediaBlob.refcount <= 0)
+                    ).scalars().all()
+            deleted = 0
+            for key in keys:
+                with connection.begin():
+                    refcount = connection.scalar(
+                        select(MediaBlob.refcount).where(MediaBlob.key == key).with_for_update()
+                    )
+                    if refcount is None or refcount > 0:
+                        continue
+                    connection.execute(delete(MediaBlob).where(MediaBlob.key == key))
+                    self.backend.delete(key)
+                    deleted += 1
+        return deleted
+
+    def exists(self, location):
+        key = self.backend.key(location)
+        if key is None:
+            return os.path.exists(location)
+        return self.backend.exists(key)
+
+    def open(self, location):
+        """
+        Binary file object with the content of a location
+        """
+        key = self.backend.key(location)
+        if key is None:
+            return open(location, "rb")
+        return self.backend.open(key)
+
+    def local_path(self, location):
+        """
+        Path of a location on this machine's disk, or None for remote backends
+        """
+        key = self.backend.key(location)
+        if key is None:
+            return location
+        return self.backend.local_path(key)
+
+    def digest(self, location):
+        """
+        sha256 of the content of a content addressed location, None for
+        locations written before the storage existed
+        """
+        key = self.backend.key(location)
+        if key is None:
+            return None
+        return os.path.splitext(os.path.basename(key))[0]
+
+    def _increment(self, key):
+        result = db.session.execute(
+            update(MediaBlob).where(MediaBlob.key == key).values(refcount=MediaBlob.refcount + 1)
+        )
+        return result.rowcount > 0
+
+
+@event.listens_for(Session, "after_commit")
+def _sweep_released_media(session):
+    released = session.info.pop("released_media", None)
+    if not released:
+        return
+    for media_storage, key in released:
+        try:
+            media_storage.sweep([key])
+        except Exception:
+            # Left at refcount 0, a later MediaStorage.sweep() deletes it
+            pass
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_released_media(session):
+    session.info.pop("released_media", None)
+
+
+def send_media(location, version=None):
+    """
+    Response sending a stored file
+
+    Local files go through send_file, which answers Range and conditional
+    requests and lets the WSGI server use sendfile. With
+    MEDIA_ACCEL_REDIRECT_PREFIX set, nginx is asked to send the file with an
+    X-Accel-Redirect header instead, and USE_X_SENDFILE does the same for
+    Apache and lighttpd. Files on S3 are redirected to a presigned URL.
+
+    The ETag is the content hash. When the request's version matches it, the
+    URL can never point at other bytes, so the response is cacheable for a
+    year without revalidation.
+    Args:
+        location: storage location of the file
+        version: the v query parameter of the request
+    Returns:
+        response
+    """
+    digest = storage.digest(location)
+    key = storage.backend.key(location)
+    path = storage.local_path(location)
+    immutable = digest is not None and version == digest
+
+    if path is None:
+        url = storage.backend.presigned_url(key, Config.MEDIA_PRESIGNED_URL_TTL)
+        if url is not None:
+            return redirect(url)
+        response = send_file(
+            storage.open(location),
+            mimetype=mimetypes.guess_type(location)[0] or "application/octet-stream",
+            etag=digest,
+            conditional=True,
+        )
+    elif Config.MEDIA_ACCEL_REDIRECT_PREFIX and key is not None:
+        response = make_response("")
+        response.headers["X-Accel-Redirect"] = Config.MEDIA_ACCEL_REDIRECT_PREFIX.rstrip("/") + "/" + key
+        response.headers["Content-Type"] = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        response.set_etag(digest)
+    else:
+        response = send_file(path, etag=digest or True, conditional=True)
+
+    if immutable:
+        response.headers["Cache-Control"] = f"private, max-age={365 * 24 * 3600}, immutable"
+    else:
+        response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+def build_storage(config):
+    """
+    Create the media storage selected by STORAGE_BACKEND
+    """
+    if config.STORAGE_BACKEND == "local":
+        return MediaStorage(LocalBackend(config.STORAGE_ROOT))
+    if config.STORAGE_BACKEND == "s3":
+        import boto3
+
+        client = boto3.client("s3", endpoint_url=config.STORAGE_S3_ENDPOINT_URL or None)
+        return MediaStorage(S3Backend(client, config.STORAGE_S3_BUCKET, config.STORAGE_S3_PREFIX))
+    raise ValueError(f"Unknown storage backend {config.STORAGE_BACKEND!r}, choose local or s3")
+
+
+storage = build_storage(Config)